@@ -1,23 +1,283 @@
 import os
 import datetime
-from flask import Flask, request, abort, jsonify, redirect, render_template
+import click
+from flask import Flask, Response, request, abort, jsonify, redirect, render_template, g, stream_with_context, send_from_directory
 from flask_cors import CORS
+from sqlalchemy import exc
+from sqlalchemy.orm import load_only
+
+from models import setup_db, bulk_update, Project, Movie, Actor, Token, Job, db
+from auth import requires_auth, check_permissions, auth0_setting, ADMIN_PERMISSION, AuthError
+from schemas import validate, ValidationError, ACTOR_SCHEMA, MOVIE_SCHEMA
+from batch import run_batch, BatchError
+from idempotency import idempotent
+from ratelimit import limiter, shedder, RateLimitExceeded
+from singleflight import flights, SingleFlightTimeout
+from replicas import router, read_only, routed_replica, set_write_cookie
+import changes
+import outbox
+from slowlog import slow_queries
+import profiling
+import tracing
+import startup
+from health import readiness
+import stats
+import documents
+import snapshot
+from readmodel import read_model, READ_MODEL
+import groupcommit
+import schedule
+import jobs
+import audit
+
+def expected_version():
+  '''
+  Reads the row version a client expects from the If-Match header.
+  Returns None when the header is absent or '*', aborts with 412 when it is malformed.
+  '''
+  if 'If-Match' not in request.headers or request.if_match.star_tag:
+    return None
+  tags = request.if_match.as_set()
+  if len(tags) != 1:
+    abort(412)
+  try:
+    return int(tags.pop())
+  except ValueError:
+    abort(412)
+
+def edit_row(model, schema, id):
+  '''
+  Validates a PATCH body and applies it with a single UPDATE ... RETURNING.
+  Aborts with 422 for invalid bodies or unknown rows and 412 for stale versions.
+  '''
+  version = expected_version()
+  try:
+    values = validate(schema, request.get_json(silent=True), partial=True)
+    row = groupcommit.commit(groupcommit.update(model, id, values, version))
+  except groupcommit.GroupCommitTimeout:
+    abort(503)
+  except:
+    abort(422)
+
+  if row is None:
+    if version is not None and model.query.get(id) is not None:
+      abort(412)
+    abort(422)
+
+  return row
+
+def requested_fields(model):
+  '''
+  Parses a sparse fieldset such as ?fields=id,second_name into (column, key) pairs of the model,
+  answered under the keys of its full format. Returns None when no fields were requested
+  and aborts with 422 for unknown ones.
+  '''
+  fields = request.args.get('fields')
+  if fields is None:
+    return None
+  fields = tuple(dict.fromkeys(field.strip() for field in fields.split(',') if field.strip()))
+  if not fields or not set(fields) <= set(model.public_fields):
+    abort(422)
+  return tuple(model.public_fields[field] for field in fields)
+
+def requested_sort(model):
+  '''
+  Parses ?sort=age or ?sort=-age into a (column, descending) pair of the model, ties stay in id order.
+  Returns None when no sort was requested and aborts with 422 for unknown fields.
+  '''
+  sort = request.args.get('sort')
+  if sort is None:
+    return None
+  field = sort.strip().lstrip('-')
+  if field not in model.public_fields:
+    abort(422)
+  return model.public_fields[field][0], sort.strip().startswith('-')
+
+def requested_filters(model):
+  '''
+  Parses filters such as ?gender=Female&age=30 into (column, value) pairs of the model,
+  values converted to the type of the column. Aborts with 422 for values of the wrong type.
+  '''
+  filters = []
+  for field, (column, key) in model.public_fields.items():
+    value = request.args.get(field)
+    if value is None:
+      continue
+    kind = getattr(model, column).type.python_type
+    try:
+      filters.append((column, int(value) if kind is int else datetime.date.fromisoformat(value) if kind is datetime.date else value))
+    except ValueError:
+      abort(422)
+  return tuple(filters)
+
+def filter_rows(model, query, filters):
+  return query.filter(*[getattr(model, column) == value for column, value in filters])
+
+def sort_order(model, sort):
+  if sort is None:
+    return (model.id,)
+  column = getattr(model, sort[0])
+  return (column.desc() if sort[1] else column, model.id)
+
+def row_format(row, fields):
+  return {key: str(value) if isinstance(value, datetime.date) else value
+    for (column, key), value in zip(fields, row)}
+
+def coalesce(key, load):
+  '''
+  Runs load() once for concurrent requests of the same resource,
+  answering 503 when the shared computation takes too long.
+  '''
+  try:
+    return flights.do(key, load)
+  except SingleFlightTimeout:
+    abort(503)
+
+BULK_MAX_ITEMS = 1000
+
+def bulk_edit(model, schema):
+  '''
+  Validates a JSON array of partial updates, each carrying an 'id' and optionally
+  the expected 'version', and applies the valid ones in one transaction.
+  Returns a result per item in request order.
+  '''
+  body = request.get_json(silent=True)
+  if not isinstance(body, list) or not 0 < len(body) <= BULK_MAX_ITEMS:
+    abort(422)
+
+  results = [None] * len(body)
+  updates, positions, seen = [], [], set()
+  for index, item in enumerate(body):
+    try:
+      item = dict(item)
+      id = item.pop('id')
+      version = item.pop('version', None)
+      if isinstance(id, bool) or not isinstance(id, int) or id in seen:
+        raise ValidationError('id', 'Expected a unique integer id.')
+      if version is not None and (isinstance(version, bool) or not isinstance(version, int)):
+        raise ValidationError('version', 'Expected an integer version.')
+      values = validate(schema, item, partial=True)
+    except (TypeError, ValueError, KeyError, ValidationError):
+      results[index] = {'id': body[index].get('id') if isinstance(body[index], dict) else None, 'status': 422}
+      continue
+    seen.add(id)
+    updates.append((id, version, values))
+    positions.append(index)
+
+  if updates:
+    try:
+      outcomes = bulk_update(model, updates)
+    except:
+      abort(422)
+    for index, (id, _, _), (status, version) in zip(positions, updates, outcomes):
+      results[index] = {'id': id, 'status': status, 'version': version}
+
+  return results
+
+# SQLSTATE of a row violating an exclusion constraint, e.g. overlapping shoot dates
+EXCLUSION_VIOLATION = '23P01'
 
-from models import setup_db, Project, Movie, Actor, Token, db
-from auth import requires_auth, AUTH0_DOMAIN, API_AUDIENCE, AuthError
+# what a node serving a snapshot answers, everything else needs the primary
+SNAPSHOT_ENDPOINTS = ('index', 'login', 'show_jwt', 'after_login', 'all_actors', 'detailed_actor',
+                      'all_moviess', 'detailed_movie', 'available_actors', 'metrics', 'slow_query_log', 'profiles',
+                      'download_profile', 'static')
 
 def create_app(test_config=None):
   app = Flask(__name__)
   setup_db(app)
   CORS(app)
 
+  # no threads or connections at import: a preloading server forks after this,
+  # gunicorn_config.py warms each worker up and this covers the other servers
+  @app.before_first_request
+  def start_background_tasks():
+    startup.start_background_tasks(app)
+
+  @app.cli.command('compact-changes')
+  def compact_changes():
+    print(f'Dropped {changes.compact()} changes')
+
+  @app.cli.command('export-snapshot')
+  @click.argument('path')
+  def export_snapshot(path):
+    for table, count in snapshot.export(path).items():
+      print(f'Exported {count} {table}')
+
+  @app.cli.command('run-jobs')
+  @click.option('--processes', default=jobs.JOBS_PROCESSES, help='Worker processes running the chunks of a job.')
+  def run_jobs(processes):
+    print(f'Running jobs on {processes} processes')
+    runner = jobs.JobRunner(app, processes)
+    try:
+      runner.run()
+    finally:
+      runner.shutdown()
+
+  @app.cli.command('drop-audit-partitions')
+  def drop_audit_partitions():
+    for name in audit.drop_expired(db.engine):
+      print(f'Dropped {name}')
+
+  @app.cli.command('rebuild-documents')
+  def rebuild_documents():
+    for kind, count in documents.rebuild_all():
+      print(f'Rebuilt {count} {kind} documents')
+
+############ LOAD SHEDDING, TRACING, PROFILING ###############
+  tracing.init_app(app)
+
+  @app.before_request
+  def enter_request():
+    # probes are never shed, traced or profiled
+    if request.endpoint in ('healthz', 'readyz'):
+      return
+    # a snapshot node serves the read API only, it has no primary to write to
+    if app.config['SNAPSHOT_PATH'] and request.endpoint is not None \
+        and request.endpoint not in SNAPSHOT_ENDPOINTS:
+      abort(405)
+    g.in_flight = shedder.enter()
+    tracing.begin()
+    # admins profile a request with the X-Profile header or ?profile=cprofile|sample
+    profiling.start()
+
+  @app.after_request
+  def store_profile(response):
+    if 'profile' in g:
+      profiling.stop(response)
+    return tracing.end(response)
+
+  # the next reads of a client that wrote go to the primary, whichever worker serves them
+  app.after_request(set_write_cookie)
+
+  @app.teardown_request
+  def leave_request(error):
+    if 'profile' in g:
+      profiling.abandon()
+    tracing.finish(error)
+    if g.pop('in_flight', False):
+      shedder.leave()
+
+######################## HEALTH ##############################
+  @app.route('/healthz')
+  def healthz():
+    return jsonify({'status': 'ok'}), 200
+
+  @app.route('/readyz')
+  def readyz():
+    ready, checks, checked_at = readiness.check()
+    return jsonify({
+      'status': 'ready' if ready else 'unready',
+      'checked_at': datetime.datetime.utcfromtimestamp(checked_at).isoformat() + 'Z',
+      'checks': checks
+    }), 200 if ready else 503
+
 ####################### LOGIN ################################
   @app.route('/')
   def index():
     client_id = os.environ['CLIENT_ID']
     login_url = os.environ['LOGIN_URI']
-    boiler_plate = f'authorize?audience={API_AUDIENCE}&response_type=token&client_id='
-    return redirect(f'https://{AUTH0_DOMAIN}/{boiler_plate}{client_id}&redirect_uri={login_url}', code=302)
+    boiler_plate = f"authorize?audience={auth0_setting('API_AUDIENCE')}&response_type=token&client_id="
+    return redirect(f"https://{auth0_setting('AUTH0_DOMAIN')}/{boiler_plate}{client_id}&redirect_uri={login_url}", code=302)
 
   @app.route('/login')
   def login():
@@ -68,7 +328,11 @@ def create_app(test_config=None):
 
   @app.route('/actors')
   @requires_auth('get:actors')
+  @read_only
   def all_actors(jwt):
+    fields = requested_fields(Actor)
+    sort = requested_sort(Actor)
+    filters = requested_filters(Actor)
     try:
       testing = request.args.get('testing', False, type=bool)
       if testing == True:
@@ -77,58 +341,121 @@ def create_app(test_config=None):
       # pagination
       page = request.args.get('page', 1, type=int)
       start = (page - 1) * 5
-      end = start + 5
       
-      actors = Actor.query.all()
-      total_actors = len(actors)
-      if total_actors + 5 < page * 5:
+      if READ_MODEL:
+        total_actors, actors = read_model.page('actors', max(start, 0), 5, sort, filters)
+      else:
+        total_actors = filter_rows(Actor, db.session.query(db.func.count(Actor.id)), filters).scalar()
+      if page < 1 or total_actors + 5 < page * 5:
         abort(404)
-      actors = [actor.short_format() for actor in actors]
+      if READ_MODEL:
+        # rows of the read model have the attributes of the model
+        actors = [row_format([getattr(actor, column) for column, key in fields], fields) if fields
+                  else Actor.short_format(actor) for actor in actors]
+      elif fields:
+        actors = filter_rows(Actor, db.session.query(*[getattr(Actor, column) for column, key in fields]), filters)\
+          .order_by(*sort_order(Actor, sort)).offset(start).limit(5).all()
+        actors = [row_format(actor, fields) for actor in actors]
+      else:
+        actors = filter_rows(Actor, Actor.query.options(load_only('id', 'firstname', 'surname')), filters)\
+          .order_by(*sort_order(Actor, sort)).offset(start).limit(5).all()
+        actors = [actor.short_format() for actor in actors]
     except:
       abort(404)
     finally:
       db.session.close()
 
     return jsonify({
-      'actors': actors[start:end],
+      'actors': actors,
       'total_actors': total_actors,
       'success': True
       }), 200
 
 
-  @app.route('/actors/<int:id>')
+  @app.route('/actors/available')
   @requires_auth('get:actors')
-  def detailed_actor(jwt, id):
+  def available_actors(jwt):
     try:
-      actor = Actor.query.get(id)
-      actor = actor.format()
-      movies = db.session.query(Actor.surname, Movie.id, Movie.title)\
-        .join(Project, Actor.id == Project.actor_id)\
-          .join(Movie, Project.movie_id == Movie.id)\
-            .filter(Project.actor_id == id).all()
-      movies = [{'movie_title':movie.title, 'movie_id': movie.id} for movie in movies]
+      start = datetime.date.fromisoformat(request.args['from'])
+      end = datetime.date.fromisoformat(request.args['to'])
+      page = request.args.get('page', 1, type=int)
+      if start > end or page < 1:
+        abort(422)
     except:
+      abort(422)
+
+    # answered from the interval trees of this worker, without a query
+    total_available, actors = schedule.index.available(start, end, (page - 1) * 5, 5)
+    if page > 1 and not actors:
       abort(404)
-    finally: 
-      db.session.close()
 
     return jsonify({
+      'actors': [{'id': id, 'name': name} for id, name in actors],
+      'total_available': total_available,
+      'from': str(start),
+      'to': str(end),
+      'success': True
+      }), 200
+
+  @app.route('/actors/<int:id>')
+  @requires_auth('get:actors')
+  @read_only
+  def detailed_actor(jwt, id):
+    fields = requested_fields(Actor)
+    if not fields:
+      # the stored document of the actor, kept current by every write
+      document = documents.fetch('actor', id)
+      if document is not None:
+        response = Response(document.body, mimetype='application/json')
+        response.set_etag(str(document.version))
+        return response, 200
+
+    def load():
+      try:
+        if fields:
+          actor = db.session.query(Actor.version, *[getattr(Actor, column) for column, key in fields])\
+            .filter(Actor.id == id).one()
+          version, actor = actor[0], row_format(actor[1:], fields)
+        else:
+          actor = Actor.query.get(id)
+          version = actor.version
+          actor = actor.format()
+        movies = db.session.query(Actor.surname, Movie.id, Movie.title)\
+          .join(Project, Actor.id == Project.actor_id)\
+            .join(Movie, Project.movie_id == Movie.id)\
+              .filter(Project.actor_id == id).all()
+        movies = [{'movie_title':movie.title, 'movie_id': movie.id} for movie in movies]
+      except:
+        abort(404)
+      finally: 
+        db.session.close()
+      return actor, movies, version
+
+    # requests read from a replica share their load only with those routed to the same one
+    actor, movies, version = coalesce(('actor', id, fields, routed_replica()), load)
+
+    response = jsonify({
       'success': True,
       'actor_details': actor, 
       'movies': movies,
       'movie_count': len(movies)
-    }), 200
+    })
+    response.set_etag(str(version))
+    return response, 200
 
   @app.route('/actors', methods=('GET', 'POST'))
   @requires_auth('post:actors')
+  @idempotent
   def add_actor(jwt):
     try:
       first_name = request.get_json()['first_name'].title()
       second_name = request.get_json()['second_name'].title()
       gender = request.get_json()['gender'].title()
       age = request.get_json()['age']
-      new_actor = Actor(firstname=first_name, surname=second_name, gender=gender, age=age)
-      new_actor.add()
+      new_actor = groupcommit.commit(
+        groupcommit.insert(Actor, firstname=first_name, surname=second_name, gender=gender, age=age))
+    except groupcommit.GroupCommitTimeout:
+      abort(503)
     except:
       abort(422)
 
@@ -140,34 +467,32 @@ def create_app(test_config=None):
       'age': new_actor.age
     }), 201
 
+  @app.route('/actors/bulk', methods=('PATCH',))
+  @requires_auth('patch:actors')
+  def bulk_edit_actors(jwt):
+    results = bulk_edit(Actor, ACTOR_SCHEMA)
+
+    return jsonify({
+      'success': True,
+      'results': results,
+      'updated': sum(result['status'] == 200 for result in results)
+    }), 200
+
   @app.route('/actors/<int:id>', methods=('GET', 'PATCH'))
   @requires_auth('patch:actors')
   def edit_actor(jwt, id):
-    try:
-      actor = Actor.query.get(id)
-      keys = list(request.get_json().keys())
-    
-      actor.firstname = request.get_json()['first_name'].title() \
-        if 'first_name' in keys else actor.firstname
-      actor.surname = request.get_json()['second_name'].title() \
-        if 'second_name' in keys else actor.surname
-      actor.gender = request.get_json()['gender'].title() \
-        if 'gender' in keys else actor.gender
-      actor.age = request.get_json()['age'] \
-        if 'age' in keys else actor.age  
-
-      actor.edit()
-    except:
-      abort(422)
+    actor = edit_row(Actor, ACTOR_SCHEMA, id)
 
-    return jsonify({
+    response = jsonify({
       'id': actor.id,
       'first name': actor.firstname,
       'second name': actor.surname,
       'gender': actor.gender,
       'age': actor.age,
       'success': True,
-    }), 200
+    })
+    response.set_etag(str(actor.version))
+    return response, 200
 
   @app.route('/actors/<int:id>', methods=('GET', 'DELETE'))
   @requires_auth('delete:actors')
@@ -191,7 +516,11 @@ def create_app(test_config=None):
 
   @app.route('/movies')
   @requires_auth('get:movies')
+  @read_only
   def all_moviess(jwt):
+    fields = requested_fields(Movie)
+    sort = requested_sort(Movie)
+    filters = requested_filters(Movie)
     try:
       test = request.args.get('testing', False, type=bool)
       if test == True:
@@ -199,57 +528,92 @@ def create_app(test_config=None):
 
       page = request.args.get('page', 1, type=int)
       start = (page - 1) * 5
-      end = start + 5
       
-      movies = Movie.query.all()
-      total_movies = len(movies)
-      if total_movies + 5 <= page * 5:
+      if READ_MODEL:
+        total_movies, movies = read_model.page('movies', max(start, 0), 5, sort, filters)
+      else:
+        total_movies = filter_rows(Movie, db.session.query(db.func.count(Movie.id)), filters).scalar()
+      if page < 1 or total_movies + 5 <= page * 5:
         abort(404)
-      movies = [movie.format() for movie in movies]
+      if READ_MODEL:
+        movies = [row_format([getattr(movie, column) for column, key in fields], fields) if fields
+                  else Movie.format(movie) for movie in movies]
+      elif fields:
+        movies = filter_rows(Movie, db.session.query(*[getattr(Movie, column) for column, key in fields]), filters)\
+          .order_by(*sort_order(Movie, sort)).offset(start).limit(5).all()
+        movies = [row_format(movie, fields) for movie in movies]
+      else:
+        movies = filter_rows(Movie, Movie.query.options(load_only('id', 'title', 'release_date')), filters)\
+          .order_by(*sort_order(Movie, sort)).offset(start).limit(5).all()
+        movies = [movie.format() for movie in movies]
     except:
       abort(404)
     finally:
       db.session.close()
 
     return jsonify({
-      'movies': movies[start:end],
-      'total_movies': len(movies),
+      'movies': movies,
+      'total_movies': total_movies,
       'success': True
       }), 200
 
 
   @app.route('/movies/<int:id>')
   @requires_auth('get:movies')
+  @read_only
   def detailed_movie(jwt, id):
-    try:
-      movie = Movie.query.get(id)
-      movie = movie.format()
-      actors = db.session.query(Actor.id, Actor.firstname, Actor.surname, Movie.title)\
-        .join(Project, Movie.id == Project.movie_id)\
-          .join(Actor, Project.actor_id == Actor.id)\
-            .filter(Project.movie_id == id).all()
-      actors = [{'actor_name':f'{actor.firstname} {actor.surname}', 'actor_id': actor.id} for actor in actors]
-    except:
-      abort(404)
-    finally: 
-      db.session.close()
+    fields = requested_fields(Movie)
+    if not fields:
+      # the stored document of the movie, kept current by every write
+      document = documents.fetch('movie', id)
+      if document is not None:
+        response = Response(document.body, mimetype='application/json')
+        response.set_etag(str(document.version))
+        return response, 200
+
+    def load():
+      try:
+        if fields:
+          movie = db.session.query(Movie.version, *[getattr(Movie, column) for column, key in fields])\
+            .filter(Movie.id == id).one()
+          version, movie = movie[0], row_format(movie[1:], fields)
+        else:
+          movie = Movie.query.get(id)
+          version = movie.version
+          movie = movie.format()
+        actors = db.session.query(Actor.id, Actor.firstname, Actor.surname, Movie.title)\
+          .join(Project, Movie.id == Project.movie_id)\
+            .join(Actor, Project.actor_id == Actor.id)\
+              .filter(Project.movie_id == id).all()
+        actors = [{'actor_name':f'{actor.firstname} {actor.surname}', 'actor_id': actor.id} for actor in actors]
+      except:
+        abort(404)
+      finally: 
+        db.session.close()
+      return movie, actors, version
 
-    return jsonify({
+    movie, actors, version = coalesce(('movie', id, fields, routed_replica()), load)
+
+    response = jsonify({
       'success': True,
       'movie_details': movie, 
       'actors': actors,
       'actor_count': len(actors)
-    }), 200
+    })
+    response.set_etag(str(version))
+    return response, 200
 
   @app.route('/movies', methods=('GET', 'POST'))
   @requires_auth('post:movies')
+  @idempotent
   def add_movie(jwt):
     try:
       title = request.get_json()['title'].title()
       release_date = request.get_json()['release_date']
       release_date = datetime.datetime.strptime(release_date, '%Y-%m-%d').date()
-      new_movie = Movie(title=title, release_date=release_date)
-      new_movie.add()
+      new_movie = groupcommit.commit(groupcommit.insert(Movie, title=title, release_date=release_date))
+    except groupcommit.GroupCommitTimeout:
+      abort(503)
     except:
       abort(422)
 
@@ -260,29 +624,30 @@ def create_app(test_config=None):
       'release_date': str(new_movie.release_date),
     }), 201
 
-  @app.route('/movies/<int:id>', methods=('GET', 'PATCH'))
+  @app.route('/movies/bulk', methods=('PATCH',))
   @requires_auth('patch:movies')
-  def edit_movie(jwt, id):
-    try:
-      movie = Movie.query.get(id)
-      keys = list(request.get_json().keys())
-    
-      if 'title' in keys:
-        movie.title = request.get_json()['title'].title()
+  def bulk_edit_movies(jwt):
+    results = bulk_edit(Movie, MOVIE_SCHEMA)
 
-      if 'release_date' in keys:
-        movie.release_date = datetime.datetime.strptime(request.get_json()['release_date'], '%Y-%m-%d').date()
+    return jsonify({
+      'success': True,
+      'results': results,
+      'updated': sum(result['status'] == 200 for result in results)
+    }), 200
 
-      # movie.edit()
-    except:
-      abort(422)
+  @app.route('/movies/<int:id>', methods=('GET', 'PATCH'))
+  @requires_auth('patch:movies')
+  def edit_movie(jwt, id):
+    movie = edit_row(Movie, MOVIE_SCHEMA, id)
 
-    return jsonify({
+    response = jsonify({
       'id': movie.id,
       'title': movie.title,
       'release_date': str(movie.release_date),
       'success': True 
-    }), 200
+    })
+    response.set_etag(str(movie.version))
+    return response, 200
 
   @app.route('/movies/<int:id>', methods=('GET', 'DELETE'))
   @requires_auth('delete:movies')
@@ -300,6 +665,235 @@ def create_app(test_config=None):
       'release_date': delete_movie.release_date,
     }), 200
 
+######################## CAST ##############################
+
+  @app.route('/movies/<int:id>/actors', methods=('POST',))
+  @requires_auth('patch:movies')
+  @idempotent
+  def add_cast(jwt, id):
+    try:
+      actor_id = request.get_json()['actor_id']
+      dates = schedule.shoot_dates(request.get_json())
+      if not isinstance(actor_id, int) or Movie.query.get(id) is None \
+          or Actor.query.get(actor_id) is None:
+        abort(422)
+    except:
+      abort(422)
+
+    # concurrent bookings of the actor in this worker wait until this one committed
+    with schedule.index.booking([actor_id] if dates else []):
+      # the actor is already shooting another movie on some of these days
+      if dates and schedule.index.reserve(actor_id, id, *dates):
+        abort(409)
+      try:
+        start, end = dates or (None, None)
+        Project(movie_id=id, actor_id=actor_id, shoot_start=start, shoot_end=end).add()
+      except exc.IntegrityError as error:
+        # the exclusion constraint of PostgreSQL, for a booking of another worker not yet in the index
+        abort(409 if getattr(error.orig, 'pgcode', None) == EXCLUSION_VIOLATION else 422)
+      except:
+        abort(422)
+
+    return jsonify({
+      'success': True,
+      'movie_id': id,
+      'actor_id': actor_id,
+      'shoot_start': start and str(start),
+      'shoot_end': end and str(end)
+    }), 201
+
+  @app.route('/movies/<int:id>/actors/<int:actor_id>', methods=('DELETE',))
+  @requires_auth('patch:movies')
+  def remove_cast(jwt, id, actor_id):
+    try:
+      project = Project.query.get((id, actor_id))
+      project.delete()
+    except:
+      abort(422)
+
+    return jsonify({
+      'success': True,
+      'movie_id': id,
+      'actor_id': actor_id
+    }), 200
+
+######################## BATCH ##############################
+
+  @app.route('/batch', methods=('POST',))
+  @requires_auth()
+  @idempotent
+  def batch(jwt):
+    body = request.get_json(silent=True)
+    try:
+      results = run_batch(body.get('operations') if isinstance(body, dict) else None, jwt)
+    except BatchError as error:
+      return jsonify({
+        'success': False,
+        'error': error.status,
+        'message': error.message,
+        'index': error.index
+      }), error.status
+
+    return jsonify({
+      'success': True,
+      'results': results
+    }), 200
+
+######################## CHANGES ##############################
+
+  @app.route('/changes')
+  @requires_auth('get:actors')
+  def change_feed(jwt):
+    check_permissions('get:movies', jwt)
+    try:
+      since = request.args.get('since', type=int)
+      since = int(request.headers.get('Last-Event-ID', 0)) if since is None else since
+      limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+      timeout = min(max(request.args.get('timeout', 0, type=float), 0), 30)
+    except:
+      abort(422)
+
+    # the connection of the token lookup goes back to the pool while the request waits for changes
+    db.session.close()
+    if request.accept_mimetypes.best == 'text/event-stream':
+      return Response(stream_with_context(changes.stream(since, limit)),
+        mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+    new_changes = changes.poll(since, limit, timeout)
+    return jsonify({
+      'success': True,
+      'changes': [change.format() for change in new_changes],
+      'next': new_changes[-1].id if new_changes else since
+    }), 200
+
+######################## STATS ##############################
+
+  @app.route('/stats/<any(actors, movies, cast, "busiest-actors"):name>')
+  @requires_auth('get:actors')
+  @read_only
+  def statistics(jwt, name):
+    check_permissions('get:movies', jwt)
+    args = {}
+    if name == 'busiest-actors':
+      args['limit'] = request.args.get('limit', 10, type=int)
+      if not 1 <= args['limit'] <= stats.STATS_TOP_ACTORS:
+        abort(422)
+
+    return jsonify(dict(stats.render(name, **args), success=True)), 200
+
+######################## ADMIN ##############################
+
+  @app.route('/metrics')
+  @requires_auth(ADMIN_PERMISSION)
+  def metrics(jwt):
+    return jsonify({
+      'success': True,
+      'single_flight': flights.stats(),
+      'rate_limit': limiter.stats(),
+      'load_shedding': shedder.stats(),
+      'engines': router.stats(),
+      'outbox': outbox.dispatcher.stats() if outbox.dispatcher else None,
+      'slow_queries': slow_queries.stats(),
+      'tracing': tracing.exporter.stats(),
+      'readiness': readiness.stats(),
+      'stats': stats.cache.stats(),
+      'read_model': read_model.stats() if READ_MODEL else None,
+      'group_commit': groupcommit.committer.stats() if groupcommit.committer else None,
+      'schedule': schedule.index.stats(),
+      'jobs': jobs.counts(),
+      'audit': audit.log.stats() if audit.log else None
+    }), 200
+
+  @app.route('/audit')
+  @requires_auth(ADMIN_PERMISSION)
+  def audit_log(jwt):
+    try:
+      since, until = (request.args.get(name) for name in ('since', 'until'))
+      since = datetime.datetime.fromisoformat(since) if since else None
+      until = datetime.datetime.fromisoformat(until) if until else None
+      limit = request.args.get('limit', 100, type=int)
+      if not 1 <= limit <= 1000:
+        abort(422)
+    except:
+      abort(422)
+
+    # events are buffered by each worker, they show up here within AUDIT_FLUSH_INTERVAL
+    return jsonify({
+      'success': True,
+      'events': audit.query(request.args.get('entity'), request.args.get('key'), request.args.get('sub'),
+                            since, until, limit)
+    }), 200
+
+  @app.route('/jobs', methods=('POST',))
+  @requires_auth(ADMIN_PERMISSION)
+  def create_job(jwt):
+    try:
+      body = request.get_json()
+      job = jobs.create(body['kind'], body.get('params', {}))
+    except:
+      abort(422)
+
+    # a `flask run-jobs` process runs it, GET /jobs/<id> reports its progress
+    return jsonify({
+      'success': True,
+      'job': job.format(0)
+    }), 202, {'Location': f'/jobs/{job.id}'}
+
+  @app.route('/jobs/<int:id>')
+  @requires_auth(ADMIN_PERMISSION)
+  def job_status(jwt, id):
+    job = Job.query.get(id)
+    if job is None:
+      abort(404)
+
+    return jsonify({
+      'success': True,
+      'job': job.format(jobs.progress(id))
+    }), 200
+
+  @app.route('/jobs/<int:id>/cancel', methods=('POST',))
+  @requires_auth(ADMIN_PERMISSION)
+  def cancel_job(jwt, id):
+    job = Job.query.filter(Job.id == id).with_for_update().first()
+    if job is None:
+      abort(404)
+    if not jobs.cancel(job):
+      abort(409)
+
+    # a running job stops once the chunks it started are done
+    return jsonify({
+      'success': True,
+      'job': job.format(jobs.progress(id))
+    }), 200 if job.status == 'cancelled' else 202
+
+  @app.route('/slow-queries')
+  @requires_auth(ADMIN_PERMISSION)
+  def slow_query_log(jwt):
+    try:
+      route = request.args.get('route')
+      min_ms = request.args.get('min_ms', 0, type=float)
+      limit = min(max(request.args.get('limit', 50, type=int), 1), 500)
+    except:
+      abort(422)
+
+    return jsonify({
+      'success': True,
+      'queries': slow_queries.entries(route, min_ms, limit)
+    }), 200
+
+  @app.route('/profiles')
+  @requires_auth(ADMIN_PERMISSION)
+  def profiles(jwt):
+    return jsonify({
+      'success': True,
+      'profiles': profiling.store.list()
+    }), 200
+
+  @app.route('/profiles/<name>')
+  @requires_auth(ADMIN_PERMISSION)
+  def download_profile(jwt, name):
+    return send_from_directory(profiling.store.directory, name, as_attachment=True)
+
 ##################  ERROR HANDLER ########################
   @app.errorhandler(404)
   def not_found(error):
@@ -309,6 +903,30 @@ def create_app(test_config=None):
       'message': "resource not found"
     }), 404
 
+  @app.errorhandler(405)
+  def not_allowed(error):
+    return jsonify({
+      'success': False,
+      'error': 405,
+      'message': "method not allowed"
+    }), 405
+
+  @app.errorhandler(409)
+  def conflict(error):
+    return jsonify({
+      'success': False,
+      'error': 409,
+      'message': "conflict"
+    }), 409
+
+  @app.errorhandler(412)
+  def precondition_failed(error):
+    return jsonify({
+      'success': False,
+      'error': 412,
+      'message': "precondition failed"
+    }), 412
+
   @app.errorhandler(422)
   def could_not_process(error):
     return jsonify({
@@ -317,6 +935,24 @@ def create_app(test_config=None):
       'message': "unprocessable"
     }), 422
   
+  @app.errorhandler(503)
+  def unavailable(error):
+    return jsonify({
+      'success': False,
+      'error': 503,
+      'message': "service unavailable"
+    }), 503
+
+  @app.errorhandler(RateLimitExceeded)
+  def rate_limited(error):
+    response = jsonify({
+      'success': False,
+      'error': error.status_code,
+      'message': "too many requests" if error.status_code == 429 else "service unavailable"
+    })
+    response.headers['Retry-After'] = str(max(1, int(error.retry_after + 0.999)))
+    return response, error.status_code
+
   @app.errorhandler(AuthError)
   def auth_error(AuthError):
     error = AuthError.error
@@ -329,7 +965,6 @@ def create_app(test_config=None):
 
   return app
 
-APP = create_app()
-
+# servers build the app in each process with the factory, e.g. gunicorn 'app:create_app()'
 if __name__ == '__main__':
-    APP.run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=8080, debug=True)
\ No newline at end of file
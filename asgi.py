@@ -0,0 +1,322 @@
+'''
+An ASGI variant of the read endpoints of app.py, for an asyncio server:
+
+    uvicorn asgi:app --workers 4
+
+GET /actors, /actors/<id>, /movies and /movies/<id> answer with the same
+bodies, ETags and errors as the Flask app, behind the same token check,
+permissions and rate limits. A worker serves any number of them at once
+while they wait on the database or the JWKS endpoint, where a sync worker
+serves one per thread. Writes and everything else stay on the Flask app.
+
+Queries run on the asyncpg or aiosqlite driver through `databases`, which
+builds them with the SQLAlchemy 1.3 of requirements.txt
+(`pip install -r requirements-async.txt`), otherwise on a pool of
+ASYNC_THREADS threads.
+'''
+import os
+import re
+import asyncio
+import logging
+import datetime
+from urllib.parse import parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import create_engine, select, func
+
+try:
+    import databases
+except ImportError:
+    # the async drivers are optional, see requirements-async.txt
+    databases = None
+
+from models import Actor, Movie, Project, Token, Document
+from auth import parse_auth_header, verify_token, check_permissions, AuthError
+from ratelimit import limiter, RateLimitExceeded
+from documents import encode
+
+# threads running queries when there is no async driver, and decoding tokens
+ASYNC_THREADS = int(os.environ.get('ASYNC_THREADS', 32))
+ASYNC_POOL_SIZE = int(os.environ.get('ASYNC_POOL_SIZE', 20))
+# schemes of DATABASE_URL with an async driver in `databases`
+ASYNC_SCHEMES = ('postgres', 'postgresql', 'sqlite')
+PAGE_SIZE = 5
+MESSAGES = {404: 'resource not found', 405: 'method not allowed', 422: 'unprocessable', 500: 'internal server error'}
+
+logger = logging.getLogger(__name__)
+
+
+class HTTPError(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+## Database
+class Row(tuple):
+    """A record of `databases` with the attribute access of SQLAlchemy's rows,
+    which the format methods of the models use
+    """
+    def __new__(cls, keys, record):
+        row = super().__new__(cls, (record[index] for index in range(len(keys))))
+        row._keys = keys
+        return row
+
+    def __getattr__(self, name):
+        try:
+            return self[self._keys[name]]
+        except KeyError:
+            raise AttributeError(name)
+
+class Database:
+    """Runs Core statements on the async driver of the scheme, or on the
+    threads of a sync engine when `databases` or the driver is not installed
+    """
+    def __init__(self, url):
+        scheme = url.split('://', 1)[0]
+        sqlite = scheme.startswith('sqlite')
+        if databases is not None and scheme in ASYNC_SCHEMES:
+            # asyncpg takes the size of its pool from the url, SQLite connects per query
+            self.backend = databases.Database(url, **({} if sqlite else {'max_size': ASYNC_POOL_SIZE}))
+            self.connecting = asyncio.Lock()
+            self.executor = None
+        else:
+            # SQLite engines get a pool without a size
+            self.engine = create_engine(url, **({} if sqlite else {'pool_size': ASYNC_POOL_SIZE, 'pool_pre_ping': True}))
+            self.executor = ThreadPoolExecutor(ASYNC_THREADS, thread_name_prefix='asgi-db')
+
+    async def connect(self):
+        if self.executor is None and not self.backend.is_connected:
+            async with self.connecting:
+                if not self.backend.is_connected:
+                    await self.backend.connect()
+
+    async def fetch(self, statement):
+        if self.executor is None:
+            await self.connect()
+            keys = {key: index for index, key in enumerate(statement.c.keys())}
+            return [Row(keys, record) for record in await self.backend.fetch_all(statement)]
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.fetch_sync, statement)
+
+    def fetch_sync(self, statement):
+        with self.engine.connect() as connection:
+            return connection.execute(statement).fetchall()
+
+    async def first(self, statement):
+        rows = await self.fetch(statement.limit(1))
+        return rows[0] if rows else None
+
+    async def dispose(self):
+        if self.executor is None:
+            if self.backend.is_connected:
+                await self.backend.disconnect()
+        else:
+            self.engine.dispose()
+            self.executor.shutdown(wait=False)
+
+database = None
+# decodes tokens off the event loop, the JWKS fetch of a cold cache blocks
+decoder = ThreadPoolExecutor(ASYNC_THREADS, thread_name_prefix='asgi-auth')
+
+def get_database():
+    # created on first use, after the server forked its workers
+    global database
+    if database is None:
+        database = Database(os.environ['DATABASE_URL'])
+    return database
+
+
+## Auth
+async def authenticate(headers, permission):
+    """The checks of requires_auth: stored or header token, permission, rate limit
+    """
+    stored_token = await get_database().first(select([Token.__table__.c.jwt]))
+    auth = 'Bearer ' + stored_token.jwt if stored_token is not None else headers.get('authorization')
+    token = parse_auth_header(auth)
+    payload = await asyncio.get_running_loop().run_in_executor(decoder, verify_token, token)
+    check_permissions(permission, payload)
+    limiter.check(payload)
+    return payload
+
+
+## Endpoints
+def requested_fields(model, args):
+    fields = args.get('fields')
+    if fields is None:
+        return None
+    fields = tuple(dict.fromkeys(field.strip() for field in fields.split(',') if field.strip()))
+    if not fields or not set(fields) <= set(model.public_fields):
+        raise HTTPError(422)
+    return tuple(model.public_fields[field] for field in fields)
+
+def requested_sort(model, args):
+    sort = args.get('sort')
+    if sort is None:
+        return None
+    field = sort.strip().lstrip('-')
+    if field not in model.public_fields:
+        raise HTTPError(422)
+    return model.public_fields[field][0], sort.strip().startswith('-')
+
+def requested_filters(model, args):
+    filters = []
+    for field, (column, key) in model.public_fields.items():
+        value = args.get(field)
+        if value is None:
+            continue
+        kind = model.__table__.c[column].type.python_type
+        try:
+            filters.append((column, int(value) if kind is int else datetime.date.fromisoformat(value) if kind is datetime.date else value))
+        except ValueError:
+            raise HTTPError(422)
+    return tuple(filters)
+
+def filter_rows(table, statement, filters):
+    for column, value in filters:
+        statement = statement.where(table.c[column] == value)
+    return statement
+
+def row_format(row, fields):
+    return {key: str(value) if isinstance(value, datetime.date) else value
+        for (column, key), value in zip(fields, row)}
+
+def page_of(args):
+    try:
+        return int(args.get('page', 1))
+    except ValueError:
+        return 1
+
+async def list_page(model, args, short_format, last_page_inclusive):
+    """Returns a page of rows and the row count, aborting like app.py for
+    pages beyond the last one
+    """
+    fields = requested_fields(model, args)
+    sort = requested_sort(model, args)
+    filters = requested_filters(model, args)
+    if args.get('testing'):
+        raise HTTPError(404)
+
+    page = page_of(args)
+    table = model.__table__
+    database = get_database()
+    total = (await database.fetch(filter_rows(table, select([func.count(table.c.id)]), filters)))[0][0]
+    # /movies already answers 404 for the page after a full last page, /actors one page later
+    last_page = total + PAGE_SIZE <= page * PAGE_SIZE if last_page_inclusive else total + PAGE_SIZE < page * PAGE_SIZE
+    if page < 1 or last_page:
+        raise HTTPError(404)
+
+    columns = [table.c[column] for column, key in fields] if fields else list(table.c)
+    order = (table.c.id,) if sort is None else \
+        (table.c[sort[0]].desc() if sort[1] else table.c[sort[0]], table.c.id)
+    rows = await database.fetch(filter_rows(table, select(columns), filters).order_by(*order)
+                                .offset((page - 1) * PAGE_SIZE).limit(PAGE_SIZE))
+    # Core rows carry the attributes the format methods of the models read
+    return [row_format(row, fields) if fields else short_format(row) for row in rows], total
+
+async def all_actors(args):
+    actors, total = await list_page(Actor, args, Actor.short_format, False)
+    return {'actors': actors, 'total_actors': total, 'success': True}, None
+
+async def all_movies(args):
+    movies, total = await list_page(Movie, args, Movie.format, True)
+    return {'movies': movies, 'total_movies': total, 'success': True}, None
+
+async def detail(kind, model, other, args, id):
+    fields = requested_fields(model, args)
+    database = get_database()
+    if not fields:
+        documents = Document.__table__
+        document = await database.first(select([documents.c.body, documents.c.version])
+                                        .where(documents.c.kind == kind).where(documents.c.id == id))
+        if document is not None:
+            return document.body, document.version
+
+    table = model.__table__
+    columns = [table.c.version] + ([table.c[column] for column, key in fields] if fields else list(table.c))
+    row = await database.first(select(columns).where(table.c.id == id))
+    if row is None:
+        raise HTTPError(404)
+    details = row_format(row[1:], fields) if fields else model.format(row)
+
+    projects, others = Project.__table__, other.__table__
+    own, foreign = (projects.c.actor_id, projects.c.movie_id) if model is Actor else (projects.c.movie_id, projects.c.actor_id)
+    related = await database.fetch(select(list(others.c)).select_from(others.join(projects, foreign == others.c.id))
+                                   .where(own == id).order_by(others.c.id))
+    if model is Actor:
+        body = {'actor_details': details, 'movies': [{'movie_title': movie.title, 'movie_id': movie.id} for movie in related],
+                'movie_count': len(related)}
+    else:
+        body = {'movie_details': details, 'actors': [{'actor_name': f'{actor.firstname} {actor.surname}', 'actor_id': actor.id}
+                                                     for actor in related], 'actor_count': len(related)}
+    body['success'] = True
+    return body, row.version
+
+async def detailed_actor(args, id):
+    return await detail('actor', Actor, Movie, args, id)
+
+async def detailed_movie(args, id):
+    return await detail('movie', Movie, Actor, args, id)
+
+# the routes of app.py served here, with the permission requires_auth checks
+ROUTES = [
+    (re.compile(r'/actors'), 'get:actors', all_actors),
+    (re.compile(r'/actors/(\d+)'), 'get:actors', detailed_actor),
+    (re.compile(r'/movies'), 'get:movies', all_movies),
+    (re.compile(r'/movies/(\d+)'), 'get:movies', detailed_movie)
+]
+
+
+## Application
+async def respond(send, status, body, etag=None, head=False, headers=()):
+    body = body if isinstance(body, bytes) else encode(body)
+    headers = [(b'content-type', b'application/json'), (b'content-length', str(len(body)).encode()),
+               (b'access-control-allow-origin', b'*'), *headers]
+    if etag is not None:
+        headers.append((b'etag', f'"{etag}"'.encode()))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': b'' if head else body})
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await get_database().connect()
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            if database is not None:
+                await database.dispose()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def app(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        return await lifespan(receive, send)
+
+    head = scope['method'] == 'HEAD'
+    try:
+        for pattern, permission, handler in ROUTES:
+            match = pattern.fullmatch(scope['path'])
+            if match:
+                break
+        else:
+            raise HTTPError(404)
+        if scope['method'] not in ('GET', 'HEAD'):
+            raise HTTPError(405)
+        headers = {name.decode('latin-1'): value.decode('latin-1') for name, value in scope['headers']}
+        args = {name: values[0] for name, values in parse_qs(scope['query_string'].decode('latin-1')).items()}
+
+        await authenticate(headers, permission)
+        body, etag = await handler(args, *(int(group) for group in match.groups()))
+        await respond(send, 200, body, etag, head)
+    except HTTPError as error:
+        await respond(send, error.status_code, {
+            'success': False, 'error': error.status_code, 'message': MESSAGES[error.status_code]}, head=head)
+    except AuthError as error:
+        await respond(send, error.status_code, {
+            'success': False, 'error': error.status_code, 'message': error.error}, head=head)
+    except RateLimitExceeded as error:
+        await respond(send, error.status_code, {
+            'success': False, 'error': error.status_code,
+            'message': "too many requests" if error.status_code == 429 else "service unavailable"
+        }, head=head, headers=[(b'retry-after', str(max(1, int(error.retry_after + 0.999))).encode())])
+    except Exception:
+        logger.exception('%s %s failed', scope['method'], scope['path'])
+        await respond(send, 500, {'success': False, 'error': 500, 'message': MESSAGES[500]}, head=head)
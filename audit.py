@@ -0,0 +1,287 @@
+import os
+import re
+import json
+import time
+import atexit
+import datetime
+import threading
+from contextlib import contextmanager
+from flask import current_app, g, has_request_context
+from sqlalchemy import event, inspect, MetaData, Table, Column, Index, Integer, String, Text, DateTime
+
+from models import change_listeners, db
+from replicas import RoutingSession
+
+# seconds between two flushes of the buffered events of a worker
+AUDIT_FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL', 1))
+# buffered events that trigger a flush before the interval is over
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 500))
+# events a worker keeps while the database is unreachable, the oldest are dropped beyond
+AUDIT_MAX_BUFFER = int(os.environ.get('AUDIT_MAX_BUFFER', 100000))
+# days an event is kept at least, monthly partitions are dropped once all their events are older
+AUDIT_RETENTION_DAYS = int(os.environ.get('AUDIT_RETENTION_DAYS', 400))
+AUDIT_ENTITIES = ('actors', 'movies', 'projects')
+AUDIT_PURGE_INTERVAL = 3600
+
+PARTITION_NAME = re.compile(r'audit_(\d{4})_(\d{2})')
+
+
+## Who
+'''
+The subject of the token requires_auth verified for the request. Writes run
+elsewhere, e.g. by the group committer or a job, carry it with acting_as.
+'''
+_local = threading.local()
+
+def current_sub():
+    sub = getattr(_local, 'sub', None)
+    if sub is None and has_request_context() and g.get('jwt'):
+        sub = g.jwt.get('sub')
+    return sub
+
+@contextmanager
+def acting_as(sub):
+    previous, _local.sub = getattr(_local, 'sub', None), sub
+    try:
+        yield
+    finally:
+        _local.sub = previous
+
+
+## Recording
+def record(entity, key, op, data):
+    """Remembers an event for each change of an actor, movie or cast, handed
+    to the buffer once the transaction commits
+    """
+    if entity not in AUDIT_ENTITIES:
+        return
+    db.session.info.setdefault('audit', []).append({
+        'occurred_at': datetime.datetime.utcnow(),
+        'sub': current_sub(),
+        'entity': entity,
+        'entity_key': str(key),
+        'op': op,
+        'data': json.dumps(data, default=str)
+    })
+
+change_listeners.append(record)
+
+@event.listens_for(RoutingSession, 'after_commit')
+def buffer_events(session):
+    events = session.info.pop('audit', None)
+    if events:
+        start_flusher(current_app._get_current_object()).add(events)
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_events(session):
+    session.info.pop('audit', None)
+
+
+## Partitions
+'''
+Events are stored in one table per month of their time, audit_2026_10 and
+so on, created when the first event of the month is flushed. A query only
+reads the months of its period, and retention drops whole tables instead of
+deleting rows.
+'''
+partitions_metadata = MetaData()
+# partitions this process knows to exist
+created = set()
+
+def partition_name(moment):
+    return f'audit_{moment.year:04d}_{moment.month:02d}'
+
+def partition_table(name):
+    if name in partitions_metadata.tables:
+        return partitions_metadata.tables[name]
+    return Table(name, partitions_metadata,
+                 Column('id', Integer, primary_key=True),
+                 Column('occurred_at', DateTime, nullable=False, index=True),
+                 Column('sub', String(200), nullable=True),
+                 Column('entity', String(20), nullable=False),
+                 Column('entity_key', String(50), nullable=False),
+                 Column('op', String(10), nullable=False),
+                 Column('data', Text, nullable=False),
+                 Index(f'ix_{name}_entity_key', 'entity', 'entity_key'))
+
+def partitions(engine):
+    """Returns the names of the existing partitions, newest first
+    """
+    return sorted((name for name in inspect(engine).get_table_names() if PARTITION_NAME.fullmatch(name)), reverse=True)
+
+def ensure_partition(engine, name):
+    table = partition_table(name)
+    if name not in created:
+        try:
+            table.create(engine, checkfirst=True)
+        except Exception:
+            # another worker created it first
+            if name not in inspect(engine).get_table_names():
+                raise
+        created.add(name)
+    return table
+
+def month_end(name):
+    year, month = (int(part) for part in PARTITION_NAME.fullmatch(name).groups())
+    return datetime.datetime(year + month // 12, month % 12 + 1, 1)
+
+def drop_expired(engine, now=None):
+    """Drops the partitions whose events are all past retention, returns their names
+    """
+    cutoff = (now or datetime.datetime.utcnow()) - datetime.timedelta(days=AUDIT_RETENTION_DAYS)
+    dropped = []
+    for name in partitions(engine):
+        if month_end(name) <= cutoff:
+            partition_table(name).drop(engine, checkfirst=True)
+            partitions_metadata.remove(partitions_metadata.tables[name])
+            created.discard(name)
+            dropped.append(name)
+    return dropped
+
+def query(entity=None, key=None, sub=None, since=None, until=None, limit=100):
+    """Returns up to limit events matching the filters, newest first, reading
+    only the partitions of the months from since to until
+    """
+    events = []
+    for name in partitions(db.engine):
+        if since is not None and month_end(name) <= since:
+            break
+        if until is not None and name > partition_name(until):
+            continue
+        table = partition_table(name)
+        statement = table.select()
+        for column, value in (('entity', entity), ('entity_key', key), ('sub', sub)):
+            if value is not None:
+                statement = statement.where(table.c[column] == value)
+        if since is not None:
+            statement = statement.where(table.c.occurred_at >= since)
+        if until is not None:
+            statement = statement.where(table.c.occurred_at < until)
+        rows = db.session.execute(statement.order_by(table.c.occurred_at.desc(), table.c.id.desc())
+                                  .limit(limit - len(events))).fetchall()
+        events.extend({
+            'occurred_at': str(row.occurred_at),
+            'sub': row.sub,
+            'entity': row.entity,
+            'key': row.entity_key,
+            'op': row.op,
+            'data': json.loads(row.data)
+        } for row in rows)
+        if len(events) >= limit:
+            break
+    return events
+
+
+## Flusher
+class AuditLog:
+    """Buffers the events committed by this worker and writes them on a
+    background thread, every AUDIT_FLUSH_INTERVAL seconds or as soon as
+    AUDIT_BATCH_SIZE are waiting, one insert per partition and batch. A
+    write pays for appending to a list instead of a second commit. Events of
+    a failed flush are kept for the next one, and whatever is buffered is
+    flushed when the process exits.
+    """
+    def __init__(self, app, interval=AUDIT_FLUSH_INTERVAL, batch_size=AUDIT_BATCH_SIZE, max_buffer=AUDIT_MAX_BUFFER):
+        self.app = app
+        self.pid = os.getpid()
+        self.interval = interval
+        self.batch_size = batch_size
+        self.max_buffer = max_buffer
+        self._buffer = []
+        self._lock = threading.Lock()
+        # one flush at a time, from the thread or at exit
+        self._flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='audit-flusher', daemon=True)
+        self._purged_at = 0
+        self.flushed = 0
+        self.flushes = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def add(self, events, first=False):
+        with self._lock:
+            if first:
+                self._buffer[:0] = events
+            else:
+                self._buffer.extend(events)
+            if len(self._buffer) > self.max_buffer:
+                self.dropped += len(self._buffer) - self.max_buffer
+                del self._buffer[:len(self._buffer) - self.max_buffer]
+            full = len(self._buffer) >= self.batch_size
+        if full and not first:
+            self.wakeup.set()
+
+    def flush(self):
+        """Writes the buffered events, returns how many"""
+        with self._flush_lock:
+            with self._lock:
+                events, self._buffer = self._buffer, []
+            if not events:
+                return 0
+
+            groups = {}
+            for audit_event in events:
+                groups.setdefault(partition_name(audit_event['occurred_at']), []).append(audit_event)
+            try:
+                # no app context of its own: tearing one down would end the session of a request flushing
+                engine = db.get_engine(self.app)
+                tables = {name: ensure_partition(engine, name) for name in groups}
+                with engine.begin() as connection:
+                    for name, rows in groups.items():
+                        connection.execute(tables[name].insert(), rows)
+            except Exception:
+                self.app.logger.exception('Audit flush failed, keeping %d events for the next one', len(events))
+                # a partition may have been dropped by another process
+                created.clear()
+                with self._lock:
+                    self.failed += 1
+                self.add(events, first=True)
+                return 0
+
+            with self._lock:
+                self.flushes += 1
+                self.flushed += len(events)
+            return len(events)
+
+    def purge(self):
+        for name in drop_expired(db.get_engine(self.app)):
+            self.app.logger.info('Dropped audit partition %s', name)
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.interval)
+            self.wakeup.clear()
+            self.flush()
+            if time.monotonic() - self._purged_at > AUDIT_PURGE_INTERVAL:
+                self._purged_at = time.monotonic()
+                try:
+                    self.purge()
+                except Exception:
+                    self.app.logger.exception('Dropping expired audit partitions failed')
+
+    def stats(self):
+        with self._lock:
+            return {'buffered': len(self._buffer), 'flushed': self.flushed, 'flushes': self.flushes,
+                    'failed_flushes': self.failed, 'dropped': self.dropped}
+
+log = None
+_start_lock = threading.Lock()
+
+def start_flusher(app):
+    """Starts the flusher of this process on a daemon thread, once.
+    A forked worker starts its own, the thread of the parent does not survive the fork.
+    """
+    global log
+    with _start_lock:
+        if log is None or not log.thread.is_alive():
+            log = AuditLog(app)
+            log.thread.start()
+    return log
+
+@atexit.register
+def flush():
+    """Writes what this process buffered now, e.g. before a worker exits.
+    A forked process leaves the events its parent buffered to the parent.
+    """
+    return log.flush() if log is not None and log.pid == os.getpid() else 0
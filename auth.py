@@ -1,15 +1,31 @@
 import os
 import json
-from flask import request
+import time
+import threading
+from flask import request, g
 from functools import wraps
 from jose import jwt
 from urllib.request import urlopen
 
 from models import Token
-
-AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = os.environ['ALGORITHMS']
-API_AUDIENCE = os.environ['API_AUDIENCE']
+from ratelimit import limiter
+from tracing import span, traced
+
+# permission guarding the diagnostic endpoints, by default only executive producers hold it
+ADMIN_PERMISSION = os.environ.get('ADMIN_PERMISSION', 'delete:movies')
+# seconds the signing keys of the tenant are cached before they are fetched again
+JWKS_CACHE_SECONDS = int(os.environ.get('JWKS_CACHE_SECONDS', 3600))
+# a token signed with an unknown key refetches the keys at most this often, for key rotation
+JWKS_MIN_REFRESH = 60
+
+def auth0_setting(name):
+    """Returns AUTH0_DOMAIN, ALGORITHMS or API_AUDIENCE from the environment,
+    read on use so that importing the app needs none of them set
+    """
+    value = os.environ.get(name)
+    if not value:
+        raise RuntimeError(f'{name} is not set')
+    return value
 
 ## AuthError Exception
 '''
@@ -23,12 +39,20 @@ class AuthError(Exception):
 
 
 ## Auth Token
+@traced('auth.get_token_auth_header')
 def get_token_auth_header():
     """Obtains the Access Token from the Authorization Header
     """
-    bearer_token = 'Bearer ' + Token.query.one_or_none().jwt
+    with span('auth.token_store_lookup'):
+        stored_token = Token.query.one_or_none()
+    # without a token stored by the browser login, e.g. on a snapshot node, the header is used
+    bearer_token = None if stored_token is None else 'Bearer ' + stored_token.jwt
     auth = request.headers.get("Authorization", None) if bearer_token is None else bearer_token 
+    return parse_auth_header(auth)
 
+def parse_auth_header(auth):
+    """Returns the token of a "Bearer <token>" Authorization value
+    """
     if not auth:
         raise AuthError({"code": "authorization_header_missing",
                         "description":
@@ -67,10 +91,42 @@ def check_permissions(permission, payload):
 
     return True
 
+## JWKS cache
+class JWKSCache:
+    """Keeps the signing keys of the Auth0 tenant for JWKS_CACHE_SECONDS
+    instead of fetching them for every request
+    """
+    def __init__(self, max_age=JWKS_CACHE_SECONDS):
+        self.max_age = max_age
+        self.keys = None
+        self.fetched_at = None
+        self._lock = threading.Lock()
+
+    def fetch(self):
+        url = f"https://{auth0_setting('AUTH0_DOMAIN')}/.well-known/jwks.json"
+        with span('auth.jwks_fetch', **{'http.url': url}):
+            jwks = json.loads(urlopen(url, timeout=10).read())
+        self.keys, self.fetched_at = jwks['keys'], time.monotonic()
+
+    def get(self, kid=None):
+        """Returns the cached keys, fetching them when they are stale or when
+        none of them matches kid and the last fetch is old enough
+        """
+        with self._lock:
+            age = self.age()
+            if age is None or age > self.max_age or \
+                    (kid is not None and age > JWKS_MIN_REFRESH and kid not in (key['kid'] for key in self.keys)):
+                self.fetch()
+            return self.keys
+
+    def age(self):
+        return None if self.fetched_at is None else time.monotonic() - self.fetched_at
+
+jwks_cache = JWKSCache()
+
+
+@traced('auth.verify_decode_jwt')
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
-
     unverified_header = jwt.get_unverified_header(token)
 
     rsa_key = {}
@@ -80,7 +136,7 @@ def verify_decode_jwt(token):
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
+    for key in jwks_cache.get(unverified_header['kid']):
         if key['kid'] == unverified_header['kid']:
             rsa_key = {
                 'kty': key['kty'],
@@ -92,13 +148,14 @@ def verify_decode_jwt(token):
 
     if rsa_key:
         try:
-            payload = jwt.decode(
-                token,
-                rsa_key,
-                algorithms=ALGORITHMS,
-                audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
-            )
+            with span('auth.jwt_decode'):
+                payload = jwt.decode(
+                    token,
+                    rsa_key,
+                    algorithms=auth0_setting('ALGORITHMS'),
+                    audience=auth0_setting('API_AUDIENCE'),
+                    issuer='https://' + auth0_setting('AUTH0_DOMAIN') + '/'
+                )
 
         except jwt.ExpiredSignatureError:
             raise AuthError({
@@ -123,22 +180,42 @@ def verify_decode_jwt(token):
         
         return payload
 
+def decode_token():
+    return verify_token(get_token_auth_header())
+
+def verify_token(token):
+    try:
+        payload = verify_decode_jwt(token)
+    except: 
+        raise AuthError({
+    'code': 'access_denied', 
+    'description': 'Token could not be decoded.'
+    }, 401)
+
+    # rate limits, audit events and read-your-writes are kept per subject
+    if not payload.get('sub'):
+        raise AuthError({
+    'code': 'invalid_claims', 
+    'description': 'Token has no subject.'
+    }, 401)
+
+    return payload
+
 def requires_auth(permission=''):
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            try:
-                payload = verify_decode_jwt(token)
-            except: 
-                raise AuthError({
-            'code': 'access_denied', 
-            'description': 'Token could not be decoded.'
-            }, 401)
+            payload = decode_token()
+            g.jwt = payload
+
+            # an empty permission only authenticates, e.g. /batch checks each sub-operation itself
+            if permission:
+                check_permissions(permission, payload)
 
-            check_permissions(permission, payload)
+            limiter.check(payload)
             
             return f(payload, *args, **kwargs)
 
+        wrapper.permission = permission
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
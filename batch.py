@@ -0,0 +1,230 @@
+import re
+from flask import current_app
+from werkzeug.exceptions import HTTPException
+from sqlalchemy import exc
+
+from models import update_returning, Project, Movie, Actor, db
+from auth import check_permissions, AuthError
+from schemas import validate, ACTOR_SCHEMA, MOVIE_SCHEMA
+from schedule import shoot_dates, index as schedule_index
+
+BATCH_MAX_OPERATIONS = 100
+
+## BatchError Exception
+'''
+BatchError Exception
+Stops a batch and reports which sub-operation failed and why
+'''
+class BatchError(Exception):
+    def __init__(self, status, message, index=None):
+        self.status = status
+        self.message = message
+        self.index = index
+
+
+## Sub-operations
+'''
+Each sub-operation mirrors the route with the same endpoint name, but only flushes
+so that the whole batch commits or rolls back as one transaction.
+They take the matched url arguments, the body and an optional expected version
+and return a (status, result) pair.
+'''
+def _edited(model, row, id, version):
+    if row is None:
+        if version is not None and model.query.get(id) is not None:
+            raise BatchError(412, 'precondition failed')
+        raise BatchError(422, 'unprocessable')
+    return row
+
+def _add_actor(args, body, version):
+    actor = Actor(**validate(ACTOR_SCHEMA, body))
+    actor.add(commit=False)
+    return 201, {
+        'id': actor.id,
+        'name': f'{actor.firstname} {actor.surname}',
+        'gender': actor.gender,
+        'age': actor.age
+    }
+
+def _edit_actor(args, body, version):
+    values = validate(ACTOR_SCHEMA, body, partial=True)
+    actor = _edited(Actor, update_returning(Actor, args['id'], values, version, commit=False),
+                    args['id'], version)
+    return 200, {
+        'id': actor.id,
+        'first name': actor.firstname,
+        'second name': actor.surname,
+        'gender': actor.gender,
+        'age': actor.age,
+        'version': actor.version
+    }
+
+def _delete_actor(args, body, version):
+    actor = Actor.query.get(args['id'])
+    if actor is None:
+        raise BatchError(422, 'unprocessable')
+    actor.delete(commit=False)
+    return 200, {
+        'id': actor.id,
+        'name': f'{actor.firstname} {actor.surname}',
+        'gender': actor.gender,
+        'age': actor.age
+    }
+
+def _add_movie(args, body, version):
+    movie = Movie(**validate(MOVIE_SCHEMA, body))
+    movie.add(commit=False)
+    return 201, {
+        'id': movie.id,
+        'title': movie.title,
+        'release_date': str(movie.release_date)
+    }
+
+def _edit_movie(args, body, version):
+    values = validate(MOVIE_SCHEMA, body, partial=True)
+    movie = _edited(Movie, update_returning(Movie, args['id'], values, version, commit=False),
+                    args['id'], version)
+    return 200, {
+        'id': movie.id,
+        'title': movie.title,
+        'release_date': str(movie.release_date),
+        'version': movie.version
+    }
+
+def _delete_movie(args, body, version):
+    movie = Movie.query.get(args['id'])
+    if movie is None:
+        raise BatchError(422, 'unprocessable')
+    movie.delete(commit=False)
+    return 200, {
+        'id': movie.id,
+        'title': movie.title,
+        'release_date': str(movie.release_date)
+    }
+
+def _add_cast(args, body, version):
+    actor_id = body.get('actor_id')
+    try:
+        dates = shoot_dates(body)
+    except (TypeError, ValueError):
+        raise BatchError(422, 'unprocessable')
+    if not isinstance(actor_id, int) or Movie.query.get(args['id']) is None \
+            or Actor.query.get(actor_id) is None:
+        raise BatchError(422, 'unprocessable')
+    # also against the bookings of the sub-operations before, not committed yet
+    if dates and schedule_index.reserve(actor_id, args['id'], *dates):
+        raise BatchError(409, 'conflict')
+    start, end = dates or (None, None)
+    Project(movie_id=args['id'], actor_id=actor_id, shoot_start=start, shoot_end=end).add(commit=False)
+    return 201, {'movie_id': args['id'], 'actor_id': actor_id,
+                 'shoot_start': start and str(start), 'shoot_end': end and str(end)}
+
+def _remove_cast(args, body, version):
+    project = Project.query.get((args['id'], args['actor_id']))
+    if project is None:
+        raise BatchError(422, 'unprocessable')
+    project.delete(commit=False)
+    return 200, {'movie_id': args['id'], 'actor_id': args['actor_id']}
+
+OPERATIONS = {
+    'add_actor': _add_actor,
+    'edit_actor': _edit_actor,
+    'delete_actor': _delete_actor,
+    'add_movie': _add_movie,
+    'edit_movie': _edit_movie,
+    'delete_movie': _delete_movie,
+    'add_cast': _add_cast,
+    'remove_cast': _remove_cast,
+}
+
+
+## References
+'''
+Sub-operations can refer to ids created earlier in the same batch by the 'ref'
+they were given: '{name}' inside a path and {"$ref": "name"} inside a body.
+'''
+def _resolve_path(path, refs):
+    return re.sub(r'\{(\w+)\}', lambda match: str(refs[match.group(1)]), path)
+
+def _resolve_body(value, refs):
+    if isinstance(value, dict):
+        if list(value) == ['$ref']:
+            return refs[value['$ref']]
+        return {key: _resolve_body(item, refs) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_resolve_body(item, refs) for item in value]
+    return value
+
+
+def run_batch(operations, payload):
+    """Runs the sub-operations in order within one transaction, checking each against
+    the permissions of the route it targets. Returns a result per sub-operation or
+    raises BatchError after rolling everything back.
+    """
+    if not isinstance(operations, list) or not 0 < len(operations) <= BATCH_MAX_OPERATIONS:
+        raise BatchError(422, 'unprocessable')
+
+    # actors created by the batch are invisible to other requests, those given by id are locked until the commit
+    booked = [operation['body']['actor_id'] for operation in operations if isinstance(operation, dict)
+              and isinstance(operation.get('body'), dict) and isinstance(operation['body'].get('actor_id'), int)
+              and operation['body'].get('shoot_start') is not None]
+    with schedule_index.booking(booked):
+        return _run(operations, payload)
+
+def _run(operations, payload):
+    adapter = current_app.url_map.bind('')
+    refs, results = {}, []
+    try:
+        for index, operation in enumerate(operations):
+            try:
+                method = operation['method'].upper()
+                path = _resolve_path(operation['path'], refs)
+                body = _resolve_body(operation.get('body', {}), refs)
+                endpoint, args = adapter.match(path, method)
+            except HTTPException as error:
+                raise BatchError(error.code, error.name.lower(), index)
+            except (TypeError, KeyError, AttributeError):
+                raise BatchError(422, 'unprocessable', index)
+
+            if endpoint not in OPERATIONS:
+                raise BatchError(405, 'method not allowed', index)
+
+            try:
+                check_permissions(current_app.view_functions[endpoint].permission, payload)
+                status, result = OPERATIONS[endpoint](args, body, operation.get('version'))
+            except AuthError as error:
+                raise BatchError(error.status_code, error.error, index)
+            except BatchError as error:
+                error.index = index
+                raise
+            except Exception:
+                raise BatchError(422, 'unprocessable', index)
+
+            if 'ref' in operation:
+                refs[operation['ref']] = result.get('id')
+            results.append({'status': status, 'body': result})
+
+    except:
+        db.session.rollback()
+        raise
+
+    # deferred constraints, serialization failures and the document rebuild only fail here
+    try:
+        db.session.commit()
+    except exc.DBAPIError as error:
+        db.session.rollback()
+        raise BatchError(*commit_error(error))
+    except Exception:
+        db.session.rollback()
+        raise BatchError(422, 'unprocessable')
+
+    return results
+
+# SQLSTATE classes of commit errors a client may retry or fix: integrity violations and serialization failures
+CONFLICT_SQLSTATES = ('23', '40')
+
+def commit_error(error):
+    if isinstance(error, exc.IntegrityError) or \
+            (getattr(error.orig, 'pgcode', None) or '')[:2] in CONFLICT_SQLSTATES:
+        return 409, 'conflict'
+    return 422, 'unprocessable'
@@ -0,0 +1,83 @@
+'''
+Measures the throughput and latency of read endpoints at rising concurrency,
+to compare the Flask app under gunicorn with asgi.py under uvicorn on the
+same machine and database:
+
+    WEB_CONCURRENCY=4 gunicorn -c gunicorn_config.py 'app:create_app()'
+    uvicorn asgi:app --workers 4 --port 8081
+    python benchmark.py http://localhost:8080/actors/1 http://localhost:8081/actors/1 --token $JWT
+
+Each client keeps one connection open and sends its next request as soon as
+the last one was answered.
+'''
+import time
+import asyncio
+import argparse
+from urllib.parse import urlsplit
+
+
+async def client(url, token, deadline, latencies, errors):
+    parts = urlsplit(url)
+    path = parts.path + (f'?{parts.query}' if parts.query else '')
+    request = (f'GET {path} HTTP/1.1\r\nHost: {parts.netloc}\r\n'
+               f'Authorization: Bearer {token}\r\n\r\n').encode()
+    reader = writer = None
+    while time.monotonic() < deadline:
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(parts.hostname, parts.port or 80)
+            started = time.perf_counter()
+            writer.write(request)
+            status = int((await reader.readline()).split()[1])
+            length, close = 0, False
+            while True:
+                line = (await reader.readline()).strip().lower()
+                if not line:
+                    break
+                if line.startswith(b'content-length:'):
+                    length = int(line.split(b':')[1])
+                elif line == b'connection: close':
+                    close = True
+            await reader.readexactly(length)
+            latencies.append(time.perf_counter() - started)
+            if status >= 400:
+                errors.append(status)
+            if close:
+                writer.close()
+                writer = None
+        except (OSError, ValueError, IndexError, asyncio.IncompleteReadError) as error:
+            errors.append(error.__class__.__name__)
+            if writer is not None:
+                writer.close()
+            writer = None
+            await asyncio.sleep(0.01)
+    if writer is not None:
+        writer.close()
+
+async def run(url, token, concurrency, seconds):
+    latencies, errors = [], []
+    deadline = time.monotonic() + seconds
+    await asyncio.gather(*(client(url, token, deadline, latencies, errors) for _ in range(concurrency)))
+    return latencies, errors
+
+def percentile(values, share):
+    return sorted(values)[min(len(values) - 1, int(len(values) * share))] if values else float('nan')
+
+def main():
+    parser = argparse.ArgumentParser(description='Compares read endpoints under concurrent load')
+    parser.add_argument('urls', nargs='+')
+    parser.add_argument('--token', default='', help='JWT sent as bearer token')
+    parser.add_argument('--concurrency', default='1,8,32,128,512', help='comma separated client counts')
+    parser.add_argument('--seconds', type=float, default=10, help='duration of each run')
+    args = parser.parse_args()
+
+    print(f'{"url":<40} {"clients":>7} {"req/s":>9} {"p50 ms":>8} {"p99 ms":>8} {"errors":>7}')
+    for url in args.urls:
+        for concurrency in (int(count) for count in args.concurrency.split(',')):
+            latencies, errors = asyncio.run(run(url, args.token, concurrency, args.seconds))
+            print(f'{url:<40} {concurrency:>7} {len(latencies) / args.seconds:>9.1f} '
+                  f'{percentile(latencies, 0.5) * 1000:>8.1f} {percentile(latencies, 0.99) * 1000:>8.1f} '
+                  f'{len(errors):>7}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,151 @@
+import os
+import json
+import time
+import datetime
+import threading
+from sqlalchemy import event
+
+from models import Change, separate_session, db
+from replicas import RoutingSession
+
+# seconds a change is kept before it is dropped from the log
+CHANGES_RETENTION = int(os.environ.get('CHANGES_RETENTION', 7 * 86400))
+# seconds after which only the latest change of each row is kept
+CHANGES_COMPACT_AFTER = int(os.environ.get('CHANGES_COMPACT_AFTER', 3600))
+# seconds between compaction runs in each worker, 0 disables the schedule
+CHANGES_COMPACT_INTERVAL = int(os.environ.get('CHANGES_COMPACT_INTERVAL', 3600))
+# a missing offset younger than this may still be committed by a concurrent transaction
+CHANGES_GAP_WAIT = 2
+# seconds between polls of the log for changes committed by other workers
+CHANGES_POLL_INTERVAL = 2
+CHANGES_HEARTBEAT = 15
+# seconds an event stream stays open before the client reconnects with Last-Event-ID
+CHANGES_STREAM_SECONDS = 300
+
+
+## Change feed
+class ChangeFeed:
+    """Wakes up the waiting readers of this worker when a transaction that
+    recorded changes commits. Changes committed by other workers are found
+    by polling every CHANGES_POLL_INTERVAL seconds.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self.generation = 0
+
+    def notify(self):
+        with self._condition:
+            self.generation += 1
+            self._condition.notify_all()
+
+    def wait(self, generation, timeout):
+        with self._condition:
+            return self._condition.wait_for(lambda: self.generation != generation, timeout)
+
+feed = ChangeFeed()
+
+@event.listens_for(RoutingSession, 'after_commit')
+def notify_readers(session):
+    if session.info.pop('changed', False):
+        feed.notify()
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_changes(session):
+    session.info.pop('changed', None)
+
+
+def fetch(since, limit):
+    """Returns up to limit changes after the offset since, in offset order.
+    Stops at a recent gap in the offsets: a concurrent transaction may still
+    commit it, and skipping ahead would lose that change for good.
+    """
+    # never the session of the request: fetching may happen in the middle of its transaction
+    with separate_session() as session:
+        changes = session.query(Change).filter(Change.id > since).order_by(Change.id).limit(limit).all()
+
+    recent = datetime.datetime.utcnow() - datetime.timedelta(seconds=CHANGES_GAP_WAIT)
+    settled, expected = [], since + 1
+    for change in changes:
+        if change.id != expected and change.created_at > recent:
+            break
+        settled.append(change)
+        expected = change.id + 1
+    return settled
+
+def poll(since, limit, timeout):
+    """Long polling: waits up to timeout seconds for changes after since
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        generation = feed.generation
+        changes = fetch(since, limit)
+        remaining = deadline - time.monotonic()
+        if changes or remaining <= 0:
+            return changes
+        feed.wait(generation, min(remaining, CHANGES_POLL_INTERVAL))
+
+def stream(since, limit):
+    """Server-sent events: yields every change after since until the stream
+    expires, with comments as heartbeats while the log is quiet.
+    """
+    deadline = time.monotonic() + CHANGES_STREAM_SECONDS
+    quiet_since = time.monotonic()
+    yield 'retry: 2000\n\n'
+    while time.monotonic() < deadline:
+        generation = feed.generation
+        changes = fetch(since, limit)
+        for change in changes:
+            yield f'id: {change.id}\nevent: change\ndata: {json.dumps(change.format())}\n\n'
+        if changes:
+            since = changes[-1].id
+            quiet_since = time.monotonic()
+            continue
+
+        if time.monotonic() - quiet_since >= CHANGES_HEARTBEAT:
+            yield ': keep-alive\n\n'
+            quiet_since = time.monotonic()
+        feed.wait(generation, CHANGES_POLL_INTERVAL)
+
+
+## Compaction and retention
+def compact(now=None):
+    """Drops changes past the retention period, and older changes superseded
+    by a later change of the same row. Returns the number of changes dropped.
+    """
+    now = now or datetime.datetime.utcnow()
+    table = Change.__table__
+    latest = db.select([db.func.max(table.c.id)]).group_by(table.c.entity, table.c.key)
+    expired = table.delete().where(
+        table.c.created_at < now - datetime.timedelta(seconds=CHANGES_RETENTION))
+    superseded = table.delete()\
+        .where(table.c.created_at < now - datetime.timedelta(seconds=CHANGES_COMPACT_AFTER))\
+        .where(table.c.id.notin_(latest))
+
+    try:
+        dropped = db.session.execute(expired).rowcount + db.session.execute(superseded).rowcount
+        db.session.commit()
+    finally:
+        db.session.close()
+    return dropped
+
+_compactor = None
+
+def start_compactor(app, interval=CHANGES_COMPACT_INTERVAL):
+    """Compacts the change log every interval seconds on a daemon thread, once per process.
+    A forked worker starts its own, the thread of the parent does not survive the fork.
+    """
+    global _compactor
+    if not interval or (_compactor is not None and _compactor.is_alive()):
+        return
+
+    def run():
+        while True:
+            time.sleep(interval)
+            with app.app_context():
+                try:
+                    app.logger.info('Compacted %s changes', compact())
+                except Exception:
+                    app.logger.exception('Change log compaction failed')
+
+    _compactor = threading.Thread(target=run, name='change-log-compactor', daemon=True)
+    _compactor.start()
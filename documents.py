@@ -0,0 +1,128 @@
+import json
+import datetime
+from sqlalchemy import event
+
+from models import change_listeners, Actor, Movie, Project, Document, db
+from replicas import RoutingSession
+
+DOCUMENTS_BATCH_SIZE = 500
+
+
+## Marking
+def mark(entity, key, op, data):
+    """Remembers which documents a change makes stale; they are rebuilt
+    right before the transaction commits
+    """
+    stale = db.session.info.setdefault('documents', {'actor': set(), 'movie': set(), 'actor-movies': set(), 'movie-actors': set()})
+    if entity == 'actors':
+        stale['actor'].add(data['id'])
+        # the movie documents list the name of the actor
+        stale['actor-movies'].add(data['id'])
+    elif entity == 'movies':
+        stale['movie'].add(data['id'])
+        stale['movie-actors'].add(data['id'])
+    elif entity == 'projects':
+        stale['actor'].add(data['actor_id'])
+        stale['movie'].add(data['movie_id'])
+
+change_listeners.append(mark)
+
+@event.listens_for(RoutingSession, 'before_commit')
+def rebuild_stale(session):
+    stale = session.info.pop('documents', None)
+    if stale:
+        session.flush()
+        rebuild(session, stale)
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_stale(session):
+    session.info.pop('documents', None)
+
+
+## Building
+def encode(document):
+    # the bytes jsonify would send for the same response
+    return (json.dumps(document, separators=(',', ':'), sort_keys=True) + '\n').encode()
+
+def build_actors(session, ids):
+    movies = {}
+    rows = session.query(Project.actor_id, Movie.id, Movie.title)\
+        .join(Movie, Project.movie_id == Movie.id)\
+        .filter(Project.actor_id.in_(ids)).order_by(Movie.id)
+    for row in rows:
+        movies.setdefault(row.actor_id, []).append({'movie_title': row.title, 'movie_id': row.id})
+
+    # rows loaded earlier in the session may predate updates made through statements
+    for actor in session.query(Actor).filter(Actor.id.in_(ids)).populate_existing():
+        actor_movies = movies.get(actor.id, [])
+        yield actor.id, actor.version, encode({
+            'success': True,
+            'actor_details': actor.format(),
+            'movies': actor_movies,
+            'movie_count': len(actor_movies)
+        })
+
+def build_movies(session, ids):
+    actors = {}
+    rows = session.query(Project.movie_id, Actor.id, Actor.firstname, Actor.surname)\
+        .join(Actor, Project.actor_id == Actor.id)\
+        .filter(Project.movie_id.in_(ids)).order_by(Actor.id)
+    for row in rows:
+        actors.setdefault(row.movie_id, []).append({'actor_name': f'{row.firstname} {row.surname}', 'actor_id': row.id})
+
+    for movie in session.query(Movie).filter(Movie.id.in_(ids)).populate_existing():
+        movie_actors = actors.get(movie.id, [])
+        yield movie.id, movie.version, encode({
+            'success': True,
+            'movie_details': movie.format(),
+            'actors': movie_actors,
+            'actor_count': len(movie_actors)
+        })
+
+BUILDERS = {'actor': build_actors, 'movie': build_movies}
+
+def rebuild(session, stale):
+    """Replaces the documents of the given actor and movie ids, dropping those
+    of deleted rows, in the transaction of the caller
+    """
+    ids = {'actor': set(stale.get('actor', ())), 'movie': set(stale.get('movie', ()))}
+    if stale.get('actor-movies'):
+        ids['movie'].update(movie_id for movie_id, in session.query(Project.movie_id)
+                            .filter(Project.actor_id.in_(stale['actor-movies'])))
+    if stale.get('movie-actors'):
+        ids['actor'].update(actor_id for actor_id, in session.query(Project.actor_id)
+                            .filter(Project.movie_id.in_(stale['movie-actors'])))
+
+    table = Document.__table__
+    now = datetime.datetime.utcnow()
+    for kind, kind_ids in ids.items():
+        kind_ids = sorted(kind_ids)
+        for start in range(0, len(kind_ids), DOCUMENTS_BATCH_SIZE):
+            batch = kind_ids[start:start + DOCUMENTS_BATCH_SIZE]
+            documents = [{'kind': kind, 'id': id, 'version': version, 'body': body, 'updated_at': now}
+                         for id, version, body in BUILDERS[kind](session, batch)]
+            session.execute(table.delete().where(table.c.kind == kind).where(table.c.id.in_(batch)))
+            if documents:
+                session.execute(table.insert(), documents)
+
+def rebuild_all():
+    """Builds the documents of every actor and movie, e.g. after the table was created
+    """
+    for kind, model in (('actor', Actor), ('movie', Movie)):
+        ids = [id for id, in db.session.query(model.id).order_by(model.id)]
+        for start in range(0, len(ids), DOCUMENTS_BATCH_SIZE):
+            rebuild(db.session, {kind: ids[start:start + DOCUMENTS_BATCH_SIZE]})
+            db.session.commit()
+        yield kind, len(ids)
+
+
+## Serving
+def fetch(kind, id):
+    """Returns the stored (body, version) of a document, or None when it was never built
+    """
+    table = Document.__table__
+    try:
+        return db.session.execute(db.select([table.c.body, table.c.version])
+            .where(table.c.kind == kind).where(table.c.id == id)).first()
+    finally:
+        db.session.close()
@@ -0,0 +1,208 @@
+import os
+import time
+import queue
+import threading
+from types import SimpleNamespace
+from flask import current_app, g, has_request_context
+
+from models import update_returning, columns_of, db
+from replicas import router
+from tracing import span
+import audit
+
+# milliseconds a write waits for others to share its commit, 0 commits every write on its own
+GROUP_COMMIT_WINDOW = float(os.environ.get('GROUP_COMMIT_WINDOW', 0)) / 1000
+# writes committed together at most, a full group is committed without waiting for the window
+GROUP_COMMIT_MAX_ITEMS = int(os.environ.get('GROUP_COMMIT_MAX_ITEMS', 50))
+# seconds a request waits for the commit of its group before giving up
+GROUP_COMMIT_TIMEOUT = float(os.environ.get('GROUP_COMMIT_TIMEOUT', 10))
+
+
+## GroupCommitTimeout Exception
+'''
+GroupCommitTimeout Exception
+Raised in a request whose group was not committed in time. The write may
+still commit afterwards, a client retries it with its Idempotency-Key.
+'''
+class GroupCommitTimeout(Exception):
+    pass
+
+
+## Writes
+'''
+A write is a function making one change with commit=False and returning
+what the route answers with. It must not read the request: it may run on
+the thread of the committer, and again when its group is rolled back.
+'''
+def insert(model, **values):
+    def write():
+        row = model(**values)
+        row.add(commit=False)
+        return SimpleNamespace(**columns_of(row))
+    return write
+
+def update(model, id, values, version=None):
+    def write():
+        return update_returning(model, id, values, version, commit=False)
+    return write
+
+
+## Group commit
+# result of a write that has not run yet, writes may return None
+_UNSET = object()
+
+class PendingWrite:
+    def __init__(self, write):
+        self.write = write
+        self.queued_at = time.monotonic()
+        self.done = threading.Event()
+        self.result = _UNSET
+        self.error = None
+        self.group_size = None
+
+class GroupCommitter:
+    """Commits the writes that requests of this worker submit within
+    GROUP_COMMIT_WINDOW of each other in one transaction, so the database
+    syncs its log once per group instead of once per row. A write is delayed
+    by at most the window plus the commit of its group. When any write of a
+    group fails, the group is rolled back and each write is run again in a
+    transaction of its own, so only the failing ones report an error.
+    """
+    def __init__(self, app, window=GROUP_COMMIT_WINDOW, max_items=GROUP_COMMIT_MAX_ITEMS, timeout=GROUP_COMMIT_TIMEOUT):
+        self.app = app
+        self.window = window
+        self.max_items = max_items
+        self.timeout = timeout
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run, name='group-commit', daemon=True)
+        self.groups = 0
+        self.writes = 0
+        self.retried = 0
+        self.largest = 0
+        self.waited = 0
+        self.longest_wait = 0
+        self.timeouts = 0
+
+    def submit(self, write):
+        """Queues a write and waits for its group to commit, returns its result or raises its error
+        """
+        pending = PendingWrite(write)
+        self._queue.put(pending)
+        if not pending.done.wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            raise GroupCommitTimeout()
+        if pending.error is not None:
+            raise pending.error
+        return pending
+
+    def run(self):
+        while True:
+            group = [self._queue.get()]
+            deadline = group[0].queued_at + self.window
+            while len(group) < self.max_items:
+                try:
+                    group.append(self._queue.get(timeout=max(deadline - time.monotonic(), 0)))
+                except queue.Empty:
+                    break
+            try:
+                self.commit(group)
+            except Exception:
+                self.app.logger.exception('Group commit of %d writes failed', len(group))
+
+    def commit(self, group):
+        started = time.monotonic()
+        try:
+            with self.app.app_context():
+                try:
+                    results = [pending.write() for pending in group]
+                    db.session.commit()
+                except Exception:
+                    db.session.rollback()
+                    results = None
+                    self.retried += 1
+
+                if results is None:
+                    for pending in group:
+                        try:
+                            pending.result = pending.write()
+                            db.session.commit()
+                        except Exception as error:
+                            db.session.rollback()
+                            pending.error = error
+                else:
+                    for pending, result in zip(group, results):
+                        pending.result = result
+        except BaseException as error:
+            # e.g. a rollback that failed too: the writes not settled yet report it
+            for pending in group:
+                if pending.result is _UNSET and pending.error is None:
+                    pending.error = error
+            raise
+        finally:
+            with self._lock:
+                self.groups += 1
+                self.writes += len(group)
+                self.largest = max(self.largest, len(group))
+                for pending in group:
+                    wait = started - pending.queued_at
+                    self.waited += wait
+                    self.longest_wait = max(self.longest_wait, wait)
+            # every waiting request wakes up, whatever happened to its group
+            for pending in group:
+                pending.group_size = len(group)
+                pending.done.set()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'groups': self.groups,
+                'writes': self.writes,
+                'retried_groups': self.retried,
+                'mean_group_size': round(self.writes / self.groups, 2) if self.groups else None,
+                'largest_group': self.largest,
+                'mean_wait_ms': round(self.waited / self.writes * 1000, 2) if self.writes else None,
+                'longest_wait_ms': round(self.longest_wait * 1000, 2),
+                'timeouts': self.timeouts
+            }
+
+committer = None
+_start_lock = threading.Lock()
+
+def start_committer(app):
+    """Starts the committer of this process on a daemon thread, once.
+    A forked worker starts its own, the thread of the parent does not survive the fork.
+    """
+    global committer
+    with _start_lock:
+        if committer is None or not committer.thread.is_alive():
+            committer = GroupCommitter(app)
+            committer.thread.start()
+    return committer
+
+def commit(write):
+    """Runs a write and commits it, together with concurrent writes when
+    GROUP_COMMIT_WINDOW is set. Returns what the write returned, raises
+    GroupCommitTimeout when its group did not commit within GROUP_COMMIT_TIMEOUT.
+    """
+    if not GROUP_COMMIT_WINDOW:
+        result = write()
+        db.session.commit()
+        return result
+
+    # the committer thread runs the write outside of the request that audits it
+    sub = audit.current_sub()
+    def write_as(write=write):
+        with audit.acting_as(sub):
+            return write()
+
+    with span('db.group_commit') as group_span:
+        pending = start_committer(current_app._get_current_object()).submit(write_as)
+        group_span.set('db.group_size', pending.group_size)
+    # the commit ran on another thread, which does not know whose write it was
+    if has_request_context():
+        g.last_write = time.time()
+        if g.get('jwt'):
+            router.note_write(g.jwt.get('sub'))
+    return pending.result
@@ -0,0 +1,42 @@
+'''
+Production settings of gunicorn, used by the Procfile:
+
+    gunicorn -c gunicorn_config.py 'app:create_app()'
+
+The app is imported once in the master (preload_app) and shared copy-on-write
+by the workers. The master never keeps a database connection across a fork:
+pools are emptied before each fork, and every worker warms up its own.
+'''
+import os
+import multiprocessing
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8080')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() * 2 + 1))
+# threads keep long polls and event streams of /changes from blocking a whole worker
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+preload_app = True
+
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# recycles workers now and then, staggered so they do not restart together
+max_requests = 2000
+max_requests_jitter = 200
+
+accesslog = '-'
+errorlog = '-'
+
+
+def pre_fork(server, worker):
+    import startup
+    startup.dispose_engines(server.app.wsgi())
+
+def worker_exit(server, worker):
+    import audit
+    audit.flush()
+
+def post_fork(server, worker):
+    import startup
+    app = server.app.wsgi()
+    server.log.info('Worker %s warmed up in %.3fs', worker.pid, startup.warmup(app))
@@ -0,0 +1,126 @@
+import os
+import time
+import threading
+from flask import current_app
+from sqlalchemy.pool import QueuePool
+
+from models import db
+from replicas import router
+from auth import jwks_cache
+from snapshot import info as snapshot_info
+
+# seconds a readiness result is reused, so probes never reach the database more often
+READY_CACHE_SECONDS = float(os.environ.get('READY_CACHE_SECONDS', 5))
+MIGRATIONS_DIRECTORY = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations')
+
+
+def pool_status(engine):
+    """Returns the pool usage, and whether a connection can be had without waiting
+    """
+    pool = engine.pool
+    if not isinstance(pool, QueuePool):
+        return {'available': True}
+    # a negative overflow means the pool never makes callers wait
+    limit = None if pool._max_overflow < 0 else pool.size() + pool._max_overflow
+    return {
+        'available': limit is None or pool.checkedout() < limit,
+        'checked_out': pool.checkedout(),
+        'size': pool.size()
+    }
+
+_head = None
+
+def migration_head():
+    # read from the migration scripts once per process, they only change with a deploy
+    global _head
+    if _head is None:
+        from alembic.config import Config
+        from alembic.script import ScriptDirectory
+        config = Config()
+        config.set_main_option('script_location', MIGRATIONS_DIRECTORY)
+        script = ScriptDirectory.from_config(config)
+        _head = (script.get_current_head(), {revision.revision for revision in script.walk_revisions()})
+    return _head
+
+
+## Readiness probe
+class ReadinessProbe:
+    """Checks the database, the JWKS cache and the schema version, at most
+    once every READY_CACHE_SECONDS per worker. Probes arriving in between, or
+    while a check runs, get the last result.
+    """
+    def __init__(self, max_age=READY_CACHE_SECONDS):
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._result = None
+        self.checks = 0
+        self.cached = 0
+
+    def check_database(self):
+        status = pool_status(db.engine)
+        if not status['available']:
+            return dict(status, ok=False, error='pool exhausted'), None
+
+        started = time.perf_counter()
+        try:
+            with db.engine.connect() as connection:
+                connection.execute('SELECT 1')
+                try:
+                    current = connection.execute('SELECT version_num FROM alembic_version').scalar()
+                except Exception:
+                    current = None
+        except Exception as error:
+            return dict(status, ok=False, error=error.__class__.__name__), None
+        return dict(status, ok=True, ping_ms=round((time.perf_counter() - started) * 1000, 2)), current
+
+    def check_migrations(self, current):
+        head, known = migration_head()
+        # a database ahead of this code (migrated by a newer deploy) can still serve it
+        behind = current is None or (current in known and current != head)
+        return {'ok': not behind, 'current': current, 'head': head}
+
+    def check_jwks(self):
+        age = jwks_cache.age()
+        return {'fresh': age is not None and age <= jwks_cache.max_age,
+                'age': None if age is None else round(age, 1)}
+
+    def run(self):
+        database, current = self.check_database()
+        checks = {
+            'database': database,
+            'migrations': self.check_migrations(current) if database['ok'] else {'ok': False},
+            'jwks': self.check_jwks(),
+            'replicas': {'healthy': sum(replica.down_until <= time.monotonic() for replica in router.replicas),
+                         'total': len(router.replicas)}
+        }
+        if current_app.config['SNAPSHOT_PATH']:
+            checks['snapshot'] = snapshot_info(current_app.config['SNAPSHOT_PATH'])
+        # JWKS and replicas are reported only: keys are fetched on demand, reads fall back to the primary
+        ready = database['ok'] and checks['migrations']['ok']
+        return ready, checks
+
+    def check(self):
+        """Returns (ready, checks, checked_at)
+        """
+        result = self._result
+        if result is not None and time.time() - result[2] < self.max_age:
+            self.cached += 1
+            return result
+
+        # only the first probe waits for a check, later ones get the last result meanwhile
+        if not self._lock.acquire(blocking=result is None):
+            self.cached += 1
+            return result
+        try:
+            if self._result is None or time.time() - self._result[2] >= self.max_age:
+                ready, checks = self.run()
+                self._result = (ready, checks, time.time())
+                self.checks += 1
+            return self._result
+        finally:
+            self._lock.release()
+
+    def stats(self):
+        return {'checks': self.checks, 'cached': self.cached}
+
+readiness = ReadinessProbe()
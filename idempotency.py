@@ -0,0 +1,224 @@
+import os
+import time
+import hashlib
+import datetime
+import threading
+from collections import OrderedDict, namedtuple
+from functools import wraps
+from flask import request, abort, make_response
+from sqlalchemy.exc import IntegrityError
+
+from models import IdempotencyKey, db
+
+IDEMPOTENCY_BACKEND = os.environ.get('IDEMPOTENCY_BACKEND', 'memory')
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+IDEMPOTENCY_MAX_KEYS = int(os.environ.get('IDEMPOTENCY_MAX_KEYS', 10000))
+# how long a duplicate waits for the original request before giving up with 409
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 10))
+# how long an unfinished key is honoured before it is treated as abandoned
+IDEMPOTENCY_LOCK_TIMEOUT = 60
+
+Reply = namedtuple('Reply', ['status_code', 'content_type', 'body'])
+
+## IdempotencyConflict Exception
+'''
+IdempotencyConflict Exception
+Raised when a key is reused with a different request (422)
+or its original request is still running after the wait (409)
+'''
+class IdempotencyConflict(Exception):
+    def __init__(self, status_code):
+        self.status_code = status_code
+
+
+## Stores
+'''
+A store hands a key to exactly one request at a time via claim().
+claim() returns None when the caller owns the key and must run the request,
+or the stored Reply of a completed request. Concurrent duplicates block in
+claim() until the owner calls complete() or release().
+'''
+class _Entry:
+    def __init__(self, fingerprint, expires_at):
+        self.fingerprint = fingerprint
+        self.expires_at = expires_at
+        self.reply = None
+        self.done = threading.Event()
+
+class MemoryStore:
+    def __init__(self, ttl=IDEMPOTENCY_TTL, max_keys=IDEMPOTENCY_MAX_KEYS, wait=IDEMPOTENCY_WAIT):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.wait = wait
+        self._entries = OrderedDict()
+        # the entries holding a reply, in the order they completed, the ones evicted first when full
+        self._completed = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _evict(self, now):
+        # entries are kept in insertion order, so the oldest expire first
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.expires_at > now:
+                break
+            del self._entries[key]
+            self._completed.pop(key, None)
+
+        # keys of requests still running are never evicted
+        while len(self._entries) >= self.max_keys and self._completed:
+            key, entry = self._completed.popitem(last=False)
+            del self._entries[key]
+
+    def claim(self, key, fingerprint):
+        deadline = time.monotonic() + self.wait
+        while True:
+            now = time.monotonic()
+            with self._lock:
+                entry = self._entries.get(key)
+                if entry is None or entry.expires_at <= now:
+                    self._entries.pop(key, None)
+                    self._completed.pop(key, None)
+                    self._evict(now)
+                    self._entries[key] = _Entry(fingerprint, now + self.ttl)
+                    return None
+
+            if entry.fingerprint != fingerprint:
+                raise IdempotencyConflict(422)
+            if entry.reply is not None:
+                return entry.reply
+            if not entry.done.wait(max(0, deadline - time.monotonic())):
+                raise IdempotencyConflict(409)
+
+    def complete(self, key, reply):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.reply = reply
+                self._completed[key] = entry
+                entry.done.set()
+
+    def release(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            self._completed.pop(key, None)
+        if entry is not None:
+            entry.done.set()
+
+class SQLStore:
+    poll_interval = 0.05
+    purge_every = 100
+
+    def __init__(self, ttl=IDEMPOTENCY_TTL, max_keys=IDEMPOTENCY_MAX_KEYS, wait=IDEMPOTENCY_WAIT):
+        self.ttl = ttl
+        self.max_keys = max_keys
+        self.wait = wait
+        self.table = IdempotencyKey.__table__
+        self._claims = 0
+
+    def _purge(self, now):
+        table = self.table
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.expires_at <= now))
+            excess = connection.execute(db.select([db.func.count()]).select_from(table)).scalar() - self.max_keys
+            if excess > 0:
+                oldest = db.select([table.c.key])\
+                    .where(table.c.status_code.isnot(None))\
+                    .order_by(table.c.created_at)\
+                    .limit(excess)
+                connection.execute(table.delete().where(table.c.key.in_(oldest)))
+
+    def claim(self, key, fingerprint):
+        table = self.table
+        deadline = time.monotonic() + self.wait
+        self._claims += 1
+        if self._claims % self.purge_every == 0:
+            self._purge(datetime.datetime.utcnow())
+
+        while True:
+            now = datetime.datetime.utcnow()
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(table.insert().values(
+                        key=key,
+                        fingerprint=fingerprint,
+                        created_at=now,
+                        expires_at=now + datetime.timedelta(seconds=self.ttl)
+                    ))
+                return None
+            except IntegrityError:
+                pass
+
+            row = db.engine.execute(table.select().where(table.c.key == key)).first()
+            if row is None:
+                continue
+            if row.expires_at <= now or (row.status_code is None and
+                    row.created_at <= now - datetime.timedelta(seconds=IDEMPOTENCY_LOCK_TIMEOUT)):
+                # expired, or abandoned by a worker that died mid-request
+                db.engine.execute(table.delete().where(table.c.key == key)
+                    .where(table.c.created_at == row.created_at))
+                continue
+            if row.fingerprint != fingerprint:
+                raise IdempotencyConflict(422)
+            if row.status_code is not None:
+                return Reply(row.status_code, row.content_type, row.body)
+            if time.monotonic() >= deadline:
+                raise IdempotencyConflict(409)
+            time.sleep(self.poll_interval)
+
+    def complete(self, key, reply):
+        table = self.table
+        db.engine.execute(table.update().where(table.c.key == key).values(
+            status_code=reply.status_code,
+            content_type=reply.content_type,
+            body=reply.body
+        ))
+
+    def release(self, key):
+        table = self.table
+        db.engine.execute(table.delete().where(table.c.key == key)
+            .where(table.c.status_code.is_(None)))
+
+store = SQLStore() if IDEMPOTENCY_BACKEND == 'sql' else MemoryStore()
+
+
+## Decorator
+def idempotent(f):
+    """Replays the stored response of a successful request made earlier with the same
+    Idempotency-Key header instead of running the handler again. Keys are scoped to the
+    JWT subject and endpoint, so it must be applied below requires_auth.
+    """
+    @wraps(f)
+    def wrapper(jwt, *args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return f(jwt, *args, **kwargs)
+        if not 0 < len(key) <= 255:
+            abort(422)
+
+        scoped_key = hashlib.sha256(f'{jwt.get("sub", "")}\n{request.endpoint}\n{key}'.encode()).hexdigest()
+        fingerprint = hashlib.sha256(request.method.encode() + request.path.encode() + request.get_data()).hexdigest()
+        try:
+            reply = store.claim(scoped_key, fingerprint)
+        except IdempotencyConflict as error:
+            abort(error.status_code)
+
+        if reply is not None:
+            response = make_response(reply.body, reply.status_code)
+            response.content_type = reply.content_type
+            response.headers['Idempotent-Replayed'] = 'true'
+            return response
+
+        try:
+            response = make_response(f(jwt, *args, **kwargs))
+        except:
+            store.release(scoped_key)
+            raise
+
+        # only successes are replayed, failed requests may be retried
+        if 200 <= response.status_code < 300:
+            store.complete(scoped_key, Reply(response.status_code, response.content_type, response.get_data()))
+        else:
+            store.release(scoped_key)
+        return response
+
+    return wrapper
@@ -0,0 +1,334 @@
+import os
+import json
+import time
+import socket
+import datetime
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+from flask import Flask
+
+from models import setup_db, Actor, Movie, Job, JobChunk, db
+from schemas import validate, ACTOR_SCHEMA, MOVIE_SCHEMA
+import documents
+import snapshot
+import audit
+
+# worker processes running the chunks of a job, one per core by default
+JOBS_PROCESSES = int(os.environ.get('JOBS_PROCESSES', os.cpu_count() or 1))
+# how worker processes are started: fork, spawn or forkserver, the platform default when unset
+JOBS_START_METHOD = os.environ.get('JOBS_START_METHOD') or None
+# rows or ids a chunk works on
+JOBS_CHUNK_SIZE = int(os.environ.get('JOBS_CHUNK_SIZE', 500))
+JOBS_MAX_IMPORT_ROWS = int(os.environ.get('JOBS_MAX_IMPORT_ROWS', 100000))
+# directory export jobs write their files to
+JOBS_EXPORT_DIR = os.environ.get('JOBS_EXPORT_DIR', 'exports')
+# seconds a running job is hidden from other runners, renewed as its chunks finish
+JOBS_LEASE = 60
+JOBS_POLL_INTERVAL = 2
+JOBS_RETENTION = 7 * 86400
+JOBS_PURGE_INTERVAL = 3600
+
+FINISHED = ('succeeded', 'failed', 'cancelled')
+
+
+class JobError(Exception):
+    # what a chunk raised, as text: not every exception survives the trip back from its process
+    pass
+
+
+## Kinds
+'''
+A kind turns the parameters of a job into a list of chunks when the job is
+created, and runs one chunk in a worker process, in a transaction that also
+records the chunk as done. A chunk returns a JSON object; the result of the
+job adds up the numbers and concatenates the lists of its chunks.
+'''
+class RebuildDocuments:
+    name = 'rebuild-documents'
+
+    def plan(self, params):
+        if params:
+            raise ValueError('rebuild-documents takes no parameters')
+        chunks = []
+        for kind, model in (('actor', Actor), ('movie', Movie)):
+            starts = [id for id, in db.session.query(model.id).order_by(model.id)][::JOBS_CHUNK_SIZE]
+            # the last range is open, so it covers the rows created until it runs
+            for index, low in enumerate(starts):
+                high = starts[index + 1] - 1 if index + 1 < len(starts) else None
+                chunks.append({'kind': kind, 'low': low, 'high': high})
+        return chunks
+
+    def run(self, chunk):
+        model = Actor if chunk['kind'] == 'actor' else Movie
+        query = db.session.query(model.id).filter(model.id >= chunk['low'])
+        if chunk['high'] is not None:
+            query = query.filter(model.id <= chunk['high'])
+        ids = [id for id, in query]
+        documents.rebuild(db.session, {chunk['kind']: ids})
+        return {chunk['kind']: len(ids)}
+
+class Import:
+    def __init__(self, entity, model, schema):
+        self.name = f'import-{entity}'
+        self.model = model
+        self.schema = schema
+
+    def plan(self, params):
+        rows = params.get('rows')
+        if set(params) != {'rows'} or not isinstance(rows, list) or not 0 < len(rows) <= JOBS_MAX_IMPORT_ROWS:
+            raise ValueError(f'{self.name} takes a list of up to {JOBS_MAX_IMPORT_ROWS} rows')
+        for row in rows:
+            validate(self.schema, row)
+        return [{'rows': rows[start:start + JOBS_CHUNK_SIZE]} for start in range(0, len(rows), JOBS_CHUNK_SIZE)]
+
+    def run(self, chunk):
+        ids = []
+        for row in chunk['rows']:
+            instance = self.model(**validate(self.schema, row))
+            instance.add(commit=False)
+            ids.append(instance.id)
+        return {'created': len(ids), 'ids': ids}
+
+class ExportSnapshot:
+    name = 'export-snapshot'
+
+    def plan(self, params):
+        name = params.get('name')
+        if set(params) != {'name'} or not isinstance(name, str) or not name \
+                or os.path.basename(name) != name or name.startswith('.'):
+            raise ValueError('export-snapshot takes the file name to write in JOBS_EXPORT_DIR')
+        return [{'path': os.path.join(JOBS_EXPORT_DIR, name)}]
+
+    def run(self, chunk):
+        os.makedirs(os.path.dirname(chunk['path']) or '.', exist_ok=True)
+        return snapshot.export(chunk['path'])
+
+KINDS = {kind.name: kind for kind in (RebuildDocuments(), Import('actors', Actor, ACTOR_SCHEMA),
+                                      Import('movies', Movie, MOVIE_SCHEMA), ExportSnapshot())}
+
+def merge(results):
+    merged = {}
+    for result in results:
+        for key, value in result.items():
+            merged[key] = merged[key] + value if key in merged else value
+    return merged
+
+
+## Jobs
+def create(kind, params):
+    """Plans a job and queues it for a runner. Raises ValueError, or the
+    ValidationError of a row, for unknown kinds or bad parameters.
+    """
+    if kind not in KINDS or not isinstance(params, dict):
+        raise ValueError(f'unknown job kind {kind!r}')
+    chunks = KINDS[kind].plan(params)
+    job = Job(kind=kind, chunks=json.dumps(chunks, default=str), total=len(chunks),
+              status='queued', cancel_requested=False)
+    db.session.add(job)
+    db.session.commit()
+    return job
+
+def progress(job_id):
+    return db.session.query(db.func.count(JobChunk.chunk)).filter(JobChunk.job_id == job_id).scalar()
+
+def cancel(job):
+    """Cancels a queued job at once and asks the runner of a running one to
+    stop after the chunks it already started. Returns False for finished jobs.
+    """
+    if job.status == 'queued':
+        job.status, job.finished_at = 'cancelled', datetime.datetime.utcnow()
+    elif job.status == 'running':
+        job.cancel_requested = True
+    else:
+        return False
+    db.session.commit()
+    return True
+
+def counts():
+    return dict(db.session.query(Job.status, db.func.count(Job.id)).group_by(Job.status).all())
+
+
+## Worker processes
+worker_app = None
+
+def init_worker(database_url):
+    global worker_app
+    worker_app = Flask(__name__)
+    setup_db(worker_app, database_url)
+
+def run_chunk(job_id, kind, index, chunk):
+    """Runs one chunk in a worker process and records it as done in the same transaction
+    """
+    with worker_app.app_context():
+        try:
+            done = JobChunk.query.get((job_id, index))
+            if done is not None:
+                # committed by a runner that stopped before it saw the result
+                return json.loads(done.result)
+            with audit.acting_as(f'job:{job_id}'):
+                result = KINDS[kind].run(chunk)
+                db.session.add(JobChunk(job_id=job_id, chunk=index, result=json.dumps(result, default=str)))
+                db.session.commit()
+            # a pool shutting down ends its processes without running their exit handlers
+            audit.flush()
+            return result
+        except Exception as error:
+            db.session.rollback()
+            raise JobError(f'{error.__class__.__name__}: {error}') from None
+        finally:
+            db.session.remove()
+
+
+## Runner
+class JobRunner:
+    """Runs queued jobs one after the other, the chunks of each in parallel
+    on a pool of worker processes, so a job uses up to `processes` cores
+    without blocking a request worker. A job is leased to its runner while it
+    runs. When the runner stops, another one takes the job over once the
+    lease ran out and runs only the chunks that were not recorded as done.
+    """
+    def __init__(self, app, processes=JOBS_PROCESSES):
+        self.app = app
+        self.processes = processes
+        self.owner = f'{socket.gethostname()}:{os.getpid()}'
+        self.pool = None
+        # chunks of the current job submitted to the pool, cancelled on shutdown
+        self.running = {}
+        self._purged_at = 0
+        self.jobs = 0
+        self.chunks = 0
+
+    def start_pool(self):
+        if self.pool is None:
+            self.pool = ProcessPoolExecutor(
+                self.processes, mp_context=multiprocessing.get_context(JOBS_START_METHOD),
+                initializer=init_worker, initargs=(self.app.config['SQLALCHEMY_DATABASE_URI'],))
+        return self.pool
+
+    def claim(self):
+        """Leases the oldest queued job, or a running one whose runner let its
+        lease run out. Returns (id, kind, chunks, chunks done, cancel requested) or None.
+        """
+        now = datetime.datetime.utcnow()
+        job = Job.query.filter(db.or_(Job.status == 'queued',
+                                      db.and_(Job.status == 'running', Job.lease_until < now)))\
+            .order_by(Job.id).with_for_update(skip_locked=True).first()
+        if job is None:
+            db.session.commit()
+            return None
+
+        job.status, job.owner = 'running', self.owner
+        job.lease_until = now + datetime.timedelta(seconds=JOBS_LEASE)
+        job.started_at = job.started_at or now
+        done = {chunk for chunk, in db.session.query(JobChunk.chunk).filter(JobChunk.job_id == job.id)}
+        claimed = (job.id, job.kind, json.loads(job.chunks), done, job.cancel_requested)
+        db.session.commit()
+        return claimed
+
+    def renew(self, job_id):
+        """Extends the lease of a job. Returns whether it should be cancelled,
+        or None when another runner took it over.
+        """
+        table = Job.__table__
+        result = db.session.execute(table.update()
+            .where(table.c.id == job_id).where(table.c.owner == self.owner)
+            .values(lease_until=datetime.datetime.utcnow() + datetime.timedelta(seconds=JOBS_LEASE)))
+        cancel_requested = db.session.query(Job.cancel_requested).filter(Job.id == job_id).scalar()
+        db.session.commit()
+        return cancel_requested if result.rowcount else None
+
+    def settle(self, job_id, status, error=None):
+        results = [json.loads(result) for result, in db.session.query(JobChunk.result)
+                   .filter(JobChunk.job_id == job_id).order_by(JobChunk.chunk)]
+        table = Job.__table__
+        db.session.execute(table.update()
+            .where(table.c.id == job_id).where(table.c.owner == self.owner)
+            .values(status=status, result=json.dumps(merge(results)), error=error and error[:1000],
+                    lease_until=None, finished_at=datetime.datetime.utcnow()))
+        db.session.commit()
+
+    def run_job(self, job_id, kind, chunks, done, cancel_requested):
+        pending = iter([(index, chunk) for index, chunk in enumerate(chunks) if index not in done])
+        running, error, stop, lost = {}, None, cancel_requested, False
+        self.running = running
+        while True:
+            # keeps every process busy with a chunk and the next one queued
+            while not stop and len(running) < self.processes * 2:
+                item = next(pending, None)
+                if item is None:
+                    break
+                running[self.start_pool().submit(run_chunk, job_id, kind, *item)] = item[0]
+            if not running:
+                break
+
+            finished, _ = wait(running, timeout=JOBS_LEASE / 3, return_when=FIRST_COMPLETED)
+            for future in finished:
+                running.pop(future)
+                if future.cancelled():
+                    continue
+                if future.exception() is not None:
+                    error = error or str(future.exception()) or future.exception().__class__.__name__
+                    if isinstance(future.exception(), BrokenProcessPool):
+                        # a worker died, e.g. out of memory, the next job gets a new pool
+                        if self.pool is not None:
+                            self.pool.shutdown(wait=False)
+                        self.pool = None
+                    stop = True
+                else:
+                    self.chunks += 1
+
+            state = self.renew(job_id)
+            if state is None:
+                stop = lost = True
+            elif state:
+                stop = cancel_requested = True
+            if stop:
+                for future in running:
+                    future.cancel()
+
+        self.jobs += 1
+        if not lost:
+            self.settle(job_id, 'failed' if error else 'cancelled' if cancel_requested else 'succeeded', error)
+
+    def purge(self):
+        table, chunks = Job.__table__, JobChunk.__table__
+        old = db.select([table.c.id]).where(table.c.status.in_(FINISHED))\
+            .where(table.c.finished_at < datetime.datetime.utcnow() - datetime.timedelta(seconds=JOBS_RETENTION))
+        db.session.execute(chunks.delete().where(chunks.c.job_id.in_(old)))
+        db.session.execute(table.delete().where(table.c.id.in_(old)))
+        db.session.commit()
+
+    def run_once(self):
+        """Claims the next job and runs it to its end, returns its id or None when none was due
+        """
+        with self.app.app_context():
+            try:
+                claimed = self.claim()
+                if claimed is not None:
+                    self.run_job(*claimed)
+            finally:
+                db.session.remove()
+        return claimed and claimed[0]
+
+    def run(self):
+        while True:
+            try:
+                job_id = self.run_once()
+                if job_id is None and time.monotonic() - self._purged_at > JOBS_PURGE_INTERVAL:
+                    with self.app.app_context():
+                        self.purge()
+                    self._purged_at = time.monotonic()
+            except Exception:
+                self.app.logger.exception('Job run failed')
+                job_id = None
+            if job_id is None:
+                time.sleep(JOBS_POLL_INTERVAL)
+
+    def shutdown(self):
+        # cancels the queued chunks by hand, shutdown(cancel_futures=True) needs Python 3.9
+        for future in list(self.running):
+            future.cancel()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
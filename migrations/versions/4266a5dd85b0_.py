@@ -0,0 +1,36 @@
+"""add change log
+
+Revision ID: 4266a5dd85b0
+Revises: 26a157bf4aed
+Create Date: 2026-10-19 14:37:52.118409
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '4266a5dd85b0'
+down_revision = '26a157bf4aed'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('changes',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('entity', sa.String(length=20), nullable=False),
+    sa.Column('key', sa.String(length=50), nullable=False),
+    sa.Column('op', sa.String(length=10), nullable=False),
+    sa.Column('data', sa.Text(), nullable=False),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_changes_entity_key', 'changes', ['entity', 'key'], unique=False)
+    op.create_index(op.f('ix_changes_created_at'), 'changes', ['created_at'], unique=False)
+
+
+def downgrade():
+    op.drop_index(op.f('ix_changes_created_at'), table_name='changes')
+    op.drop_index('ix_changes_entity_key', table_name='changes')
+    op.drop_table('changes')
@@ -0,0 +1,34 @@
+"""add shoot dates to projects
+
+Revision ID: 5c1e7a9d2b48
+Revises: 969b517397d3
+Create Date: 2026-10-19 19:02:17.418305
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e7a9d2b48'
+down_revision = '969b517397d3'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('projects', sa.Column('shoot_start', sa.Date(), nullable=True))
+    op.add_column('projects', sa.Column('shoot_end', sa.Date(), nullable=True))
+    if op.get_bind().dialect.name == 'postgresql':
+        # a GiST index over the shoot days of each actor, refusing overlapping bookings of an actor
+        op.execute('CREATE EXTENSION IF NOT EXISTS btree_gist')
+        op.execute("ALTER TABLE projects ADD CONSTRAINT projects_actor_shoot_excl EXCLUDE USING gist "
+                   "(actor_id WITH =, daterange(shoot_start, shoot_end, '[]') WITH &&) "
+                   "WHERE (shoot_start IS NOT NULL AND shoot_end IS NOT NULL)")
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        op.execute('ALTER TABLE projects DROP CONSTRAINT projects_actor_shoot_excl')
+    op.drop_column('projects', 'shoot_end')
+    op.drop_column('projects', 'shoot_start')
@@ -0,0 +1,26 @@
+"""add version columns for optimistic concurrency
+
+Revision ID: 8d6e78cc1aa6
+Revises: 2ab4ba8c5363
+Create Date: 2026-10-19 09:12:41.208313
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8d6e78cc1aa6'
+down_revision = '2ab4ba8c5363'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.add_column('actors', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+    op.add_column('movies', sa.Column('version', sa.Integer(), server_default='1', nullable=False))
+
+
+def downgrade():
+    op.drop_column('movies', 'version')
+    op.drop_column('actors', 'version')
@@ -0,0 +1,32 @@
+"""add actor and movie documents
+
+Revision ID: 969b517397d3
+Revises: d76a6dcb7d25
+Create Date: 2026-10-19 18:12:41.902311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '969b517397d3'
+down_revision = 'd76a6dcb7d25'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # fill it afterwards with `flask rebuild-documents`, the detail endpoints query the tables until then
+    op.create_table('documents',
+    sa.Column('kind', sa.String(length=10), nullable=False),
+    sa.Column('id', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('body', sa.LargeBinary(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('kind', 'id')
+    )
+
+
+def downgrade():
+    op.drop_table('documents')
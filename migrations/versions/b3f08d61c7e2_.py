@@ -0,0 +1,50 @@
+"""add jobs
+
+Revision ID: b3f08d61c7e2
+Revises: 5c1e7a9d2b48
+Create Date: 2026-10-19 19:41:06.275193
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b3f08d61c7e2'
+down_revision = '5c1e7a9d2b48'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('jobs',
+    sa.Column('id', sa.Integer(), nullable=False),
+    sa.Column('kind', sa.String(length=30), nullable=False),
+    sa.Column('chunks', sa.Text(), nullable=False),
+    sa.Column('total', sa.Integer(), nullable=False),
+    sa.Column('status', sa.String(length=20), nullable=False),
+    sa.Column('cancel_requested', sa.Boolean(), nullable=False),
+    sa.Column('owner', sa.String(length=100), nullable=True),
+    sa.Column('lease_until', sa.DateTime(), nullable=True),
+    sa.Column('result', sa.Text(), nullable=True),
+    sa.Column('error', sa.Text(), nullable=True),
+    sa.Column('created_at', sa.DateTime(), nullable=False),
+    sa.Column('started_at', sa.DateTime(), nullable=True),
+    sa.Column('finished_at', sa.DateTime(), nullable=True),
+    sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_jobs_status_lease_until', 'jobs', ['status', 'lease_until'], unique=False)
+    op.create_table('job_chunks',
+    sa.Column('job_id', sa.Integer(), nullable=False),
+    sa.Column('chunk', sa.Integer(), autoincrement=False, nullable=False),
+    sa.Column('result', sa.Text(), nullable=False),
+    sa.Column('finished_at', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['job_id'], ['jobs.id'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('job_id', 'chunk')
+    )
+
+
+def downgrade():
+    op.drop_table('job_chunks')
+    op.drop_index('ix_jobs_status_lease_until', table_name='jobs')
+    op.drop_table('jobs')
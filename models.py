@@ -1,33 +1,170 @@
 import os
+import json
 import datetime
+from contextlib import contextmanager
 from flask_sqlalchemy import SQLAlchemy
-from flask_migrate import Migrate
+from sqlalchemy import orm
 
-database_path = os.environ['DATABASE_URL']
+from replicas import router, RoutingSession, REPLICA_DATABASE_URLS
 
-db = SQLAlchemy()
+class RoutingSQLAlchemy(SQLAlchemy):
+    # sessions can send the reads of read_only handlers to a replica
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
 
-def setup_db(app, database_path=database_path):
-    app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+db = RoutingSQLAlchemy()
+
+def setup_db(app, database_path=None):
+    '''
+    Only configures the app: engines and their pools are created on first use,
+    so a preloading server never hands one connection to several forked workers.
+    '''
+    app.config["SNAPSHOT_PATH"] = None
+    if database_path is None and os.environ.get('SNAPSHOT_PATH'):
+        # a read node serves the read API from a file exported by `flask export-snapshot`
+        import snapshot
+        snapshot.configure(app, os.environ['SNAPSHOT_PATH'])
+    else:
+        app.config["SQLALCHEMY_DATABASE_URI"] = database_path or os.environ['DATABASE_URL']
+        app.config.pop("SQLALCHEMY_ENGINE_OPTIONS", None)
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
     db.app = app
     db.init_app(app)
-    migrate = Migrate(app, db)    
+    # alembic takes a third of the import time and is only used by the flask db commands
+    if os.environ.get('FLASK_RUN_FROM_CLI') == 'true':
+        from flask_migrate import Migrate
+        migrate = Migrate(app, db)
+    router.configure('' if app.config["SNAPSHOT_PATH"] else REPLICA_DATABASE_URLS)
+
+def flush_or_commit(commit=True):
+    # callers running several writes in one transaction (e.g. /batch) only flush
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
+
+@contextmanager
+def separate_session():
+    '''
+    A short-lived session on the engine the request's session reads from, for
+    reads that must neither see nor end the transaction of the request.
+    '''
+    session = orm.Session(bind=db.session.get_bind())
+    try:
+        yield session
+    finally:
+        session.close()
+
+def columns_of(instance):
+    return {column.name: getattr(instance, column.name) for column in instance.__table__.columns}
+
+# called as listener(entity, key, op, data) inside the writing transaction
+change_listeners = []
+
+def record_change(entity, key, op, data):
+    '''
+    Appends a change to the change log in the caller's transaction, so it is only
+    visible to /changes once the write it describes commits.
+    '''
+    db.session.add(Change(entity=entity, key=str(key), op=op, data=json.dumps(data, default=str)))
+    db.session.info['changed'] = True
+    for listener in change_listeners:
+        listener(entity, key, op, data)
+
+def supports_returning():
+    # SQLAlchemy 1.3 only compiles RETURNING for these backends
+    return db.engine.dialect.name in ('postgresql', 'oracle', 'mssql')
+
+def update_returning(model, id, values, version=None, commit=True):
+    '''
+    Applies a partial update to a single row in one statement, bumping its version.
+    When a version is given the row is only updated if it still matches (optimistic concurrency).
+    Returns the updated row, or None when no row matched.
+    '''
+    table = model.__table__
+    statement = table.update().where(table.c.id == id)
+    if version is not None:
+        statement = statement.where(table.c.version == version)
+    statement = statement.values(version=table.c.version + 1, **values)
+
+    if supports_returning():
+        row = db.session.execute(statement.returning(*table.c)).first()
+    else:
+        result = db.session.execute(statement)
+        row = db.session.execute(table.select().where(table.c.id == id)).first() \
+            if result.rowcount else None
+
+    if row is not None:
+        record_change(table.name, id, 'update', dict(row))
+    flush_or_commit(commit)
+    return row
+
+def bulk_update(model, updates, commit=True):
+    '''
+    Applies many partial updates of (id, version, values) in one transaction.
+    Updates changing the same set of columns are sent as a single executemany.
+    Returns a (status, version) pair per update: 200 updated, 404 unknown row, 412 stale version.
+    '''
+    table = model.__table__
+    ids = {id for id, version, values in updates}
+    current = dict(db.session.execute(
+        db.select([table.c.id, table.c.version])
+        .where(table.c.id.in_(ids))
+        .with_for_update()
+    ).fetchall())
+
+    results = []
+    groups = {}
+    for id, version, values in updates:
+        if id not in current:
+            results.append((404, None))
+        elif version is not None and version != current[id]:
+            results.append((412, current[id]))
+        else:
+            current[id] += 1
+            results.append((200, current[id]))
+            groups.setdefault(tuple(sorted(values)), []).append(dict(values, row_id=id))
+
+    for rows in groups.values():
+        statement = table.update()\
+            .where(table.c.id == db.bindparam('row_id'))\
+            .values(version=table.c.version + 1)
+        db.session.execute(statement, rows)
+
+    updated = [id for (status, version), (id, _, _) in zip(results, updates) if status == 200]
+    if updated:
+        for row in db.session.execute(table.select().where(table.c.id.in_(updated))):
+            record_change(table.name, row.id, 'update', dict(row))
+    flush_or_commit(commit)
+    return results
 
 class Project(db.Model):
     __tablename__ = 'projects'
 
     movie_id = db.Column(db.Integer, db.ForeignKey('movies.id'), primary_key=True)
     actor_id = db.Column(db.Integer, db.ForeignKey('actors.id'), primary_key=True)
+    # the days the actor shoots the movie, both ends included, or none when not scheduled
+    shoot_start = db.Column(db.Date, nullable=True)
+    shoot_end = db.Column(db.Date, nullable=True)
     movies = db.relationship('Movie', back_populates='actor')
     actors = db.relationship('Actor', back_populates='movie')
 
     def __repr__(self):
         return f'<Project - MovieID {self.movie_id}, ActorID {self.actor_id}>'
 
-    def add(self):
+    @property
+    def key(self):
+        return f'{self.movie_id}:{self.actor_id}'
+
+    def add(self, commit=True):
         db.session.add(self)
-        db.session.commit()
+        record_change('projects', self.key, 'create', columns_of(self))
+        flush_or_commit(commit)
+
+    def delete(self, commit=True):
+        db.session.delete(self)
+        record_change('projects', self.key, 'delete', columns_of(self))
+        flush_or_commit(commit)
 
 class Movie(db.Model):
     __tablename__ = 'movies'
@@ -35,7 +172,11 @@ class Movie(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String, nullable=False, unique=True)
     release_date = db.Column(db.Date, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     actor = db.relationship('Project', back_populates='movies', cascade='all, delete-orphan', lazy=True)
+    # fields a client may select with ?fields= and sort by with ?sort=, named as in
+    # request bodies, and their column and key in format()
+    public_fields = {'id': ('id', 'id'), 'title': ('title', 'title'), 'release_date': ('release_date', 'release_date')}
     
     def __repr__(self):
       return f'<Movie ID {self.id} and Title {self.title}>'
@@ -47,16 +188,22 @@ class Movie(db.Model):
             'release_date': str(self.release_date)
         }
 
-    def add(self):
+    def add(self, commit=True):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        record_change(self.__tablename__, self.id, 'create', columns_of(self))
+        flush_or_commit(commit)
 
     def edit(self):
         db.session.commit()
 
-    def delete(self):
+    def delete(self, commit=True):
+        # the cast rows go with it through the delete-orphan cascade
+        for project in self.actor:
+            record_change('projects', project.key, 'delete', columns_of(project))
         db.session.delete(self)
-        db.session.commit()
+        record_change(self.__tablename__, self.id, 'delete', columns_of(self))
+        flush_or_commit(commit)
 
 
 class Actor(db.Model):
@@ -67,7 +214,12 @@ class Actor(db.Model):
     surname = db.Column(db.String(120), nullable=False)
     age = db.Column(db.Integer, nullable=False)
     gender = db.Column(db.String(20), nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
     movie = db.relationship('Project', back_populates='actors', cascade='all, delete-orphan', lazy=True)
+    # fields a client may select with ?fields= and sort by with ?sort=, named as in
+    # request bodies, and their column and key in format()
+    public_fields = {'id': ('id', 'id'), 'first_name': ('firstname', 'first name'),
+                     'second_name': ('surname', 'second name'), 'age': ('age', 'age'), 'gender': ('gender', 'gender')}
 
     def __repr__(self):
       return f'<Actor ID {self.id} and Name {self.firstname[0]}. {self.surname}>'
@@ -87,16 +239,22 @@ class Actor(db.Model):
             'name': f'{self.firstname} {self.surname}'
         }
 
-    def add(self):
+    def add(self, commit=True):
         db.session.add(self)
-        db.session.commit()
+        db.session.flush()
+        record_change(self.__tablename__, self.id, 'create', columns_of(self))
+        flush_or_commit(commit)
 
     def edit(self):
         db.session.commit()
 
-    def delete(self):
+    def delete(self, commit=True):
+        # the cast rows go with it through the delete-orphan cascade
+        for project in self.movie:
+            record_change('projects', project.key, 'delete', columns_of(project))
         db.session.delete(self)
-        db.session.commit()
+        record_change(self.__tablename__, self.id, 'delete', columns_of(self))
+        flush_or_commit(commit)
 
 class Token(db.Model):
     __tablename__ = 'jwt_store'
@@ -120,4 +278,121 @@ class Token(db.Model):
 
     def delete_all(self):
         self.query.delete()
-        db.session.commit()
\ No newline at end of file
+        db.session.commit()
+
+class IdempotencyKey(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    key = db.Column(db.String(300), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status_code = db.Column(db.Integer, nullable=True)
+    content_type = db.Column(db.String(100), nullable=True)
+    body = db.Column(db.LargeBinary, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<IdempotencyKey {self.key}, status: {self.status_code}>'
+
+class Change(db.Model):
+    __tablename__ = 'changes'
+    __table_args__ = (db.Index('ix_changes_entity_key', 'entity', 'key'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(20), nullable=False)
+    key = db.Column(db.String(50), nullable=False)
+    op = db.Column(db.String(10), nullable=False)
+    data = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False, index=True)
+
+    def __repr__(self):
+        return f'<Change {self.id}: {self.op} {self.entity} {self.key}>'
+
+    def format(self):
+        return {
+            'id': self.id,
+            'entity': self.entity,
+            'key': self.key,
+            'op': self.op,
+            'data': json.loads(self.data),
+            'created_at': str(self.created_at)
+        }
+
+class OutboxEvent(db.Model):
+    __tablename__ = 'outbox'
+    __table_args__ = (db.Index('ix_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    endpoint = db.Column(db.String(500), nullable=False)
+    event_type = db.Column(db.String(50), nullable=False)
+    payload = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    last_error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    delivered_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<OutboxEvent {self.id}: {self.event_type} to {self.endpoint}, {self.status}>'
+
+class Document(db.Model):
+    __tablename__ = 'documents'
+
+    kind = db.Column(db.String(10), primary_key=True)
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    body = db.Column(db.LargeBinary, nullable=False)
+    version = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<Document {self.kind} {self.id}, version: {self.version}>'
+
+class Job(db.Model):
+    __tablename__ = 'jobs'
+    __table_args__ = (db.Index('ix_jobs_status_lease_until', 'status', 'lease_until'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(30), nullable=False)
+    # the work as a JSON list of chunks, each run by one worker process
+    chunks = db.Column(db.Text, nullable=False)
+    total = db.Column(db.Integer, nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='queued')
+    cancel_requested = db.Column(db.Boolean, nullable=False, default=False)
+    # the runner working on the job, until its lease runs out
+    owner = db.Column(db.String(100), nullable=True)
+    lease_until = db.Column(db.DateTime, nullable=True)
+    result = db.Column(db.Text, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    started_at = db.Column(db.DateTime, nullable=True)
+    finished_at = db.Column(db.DateTime, nullable=True)
+
+    def __repr__(self):
+        return f'<Job {self.id}: {self.kind}, {self.status}>'
+
+    def format(self, done):
+        return {
+            'id': self.id,
+            'kind': self.kind,
+            'status': self.status,
+            'cancel_requested': self.cancel_requested,
+            'progress': {'done': done, 'total': self.total,
+                         'percent': round(done * 100 / self.total, 1) if self.total else 100.0},
+            'result': json.loads(self.result) if self.result is not None else None,
+            'error': self.error,
+            'created_at': str(self.created_at),
+            'started_at': self.started_at and str(self.started_at),
+            'finished_at': self.finished_at and str(self.finished_at)
+        }
+
+class JobChunk(db.Model):
+    __tablename__ = 'job_chunks'
+
+    job_id = db.Column(db.Integer, db.ForeignKey('jobs.id', ondelete='CASCADE'), primary_key=True)
+    chunk = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    result = db.Column(db.Text, nullable=False)
+    finished_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+
+    def __repr__(self):
+        return f'<JobChunk {self.job_id}/{self.chunk}>'
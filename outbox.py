@@ -0,0 +1,205 @@
+import os
+import json
+import uuid
+import random
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.request import Request, urlopen
+from sqlalchemy import event
+
+from models import change_listeners, OutboxEvent, db
+from replicas import RoutingSession
+
+# comma separated urls receiving cast.added and cast.removed events
+WEBHOOK_URLS = [url.strip() for url in os.environ.get('WEBHOOK_URLS', '').split(',') if url.strip()]
+OUTBOX_THREADS = int(os.environ.get('OUTBOX_THREADS', 4))
+OUTBOX_ENDPOINT_CONCURRENCY = int(os.environ.get('OUTBOX_ENDPOINT_CONCURRENCY', 1))
+OUTBOX_BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', 50))
+OUTBOX_MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', 12))
+OUTBOX_TIMEOUT = 10
+OUTBOX_POLL_INTERVAL = 5
+# seconds a claimed event is hidden from other dispatchers while it is delivered
+OUTBOX_LEASE = 60
+OUTBOX_RETENTION = 86400
+
+
+## Enqueueing
+def enqueue(entity, key, op, data):
+    """Adds one outbox event per webhook endpoint for each cast change,
+    in the transaction of the write
+    """
+    if entity != 'projects' or not WEBHOOK_URLS:
+        return
+
+    event_type = 'cast.added' if op == 'create' else 'cast.removed'
+    payload = json.dumps({
+        'id': uuid.uuid4().hex,
+        'type': event_type,
+        'movie_id': data['movie_id'],
+        'actor_id': data['actor_id'],
+        'occurred_at': datetime.datetime.utcnow().isoformat() + 'Z'
+    })
+    for endpoint in WEBHOOK_URLS:
+        db.session.add(OutboxEvent(endpoint=endpoint, event_type=event_type, payload=payload))
+    db.session.info['outbox'] = True
+
+change_listeners.append(enqueue)
+
+@event.listens_for(RoutingSession, 'after_commit')
+def wake_dispatcher(session):
+    if session.info.pop('outbox', False) and dispatcher is not None:
+        dispatcher.wakeup.set()
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_outbox(session):
+    session.info.pop('outbox', None)
+
+
+def backoff(attempts):
+    # exponential with jitter, capped at an hour
+    return min(3600, 2 ** attempts) * random.uniform(0.5, 1.5)
+
+
+## Dispatcher
+class Dispatcher:
+    """Drains the outbox on a background thread and posts batches of events to
+    their endpoints from a bounded thread pool, at most OUTBOX_ENDPOINT_CONCURRENCY
+    batches per endpoint at a time. Delivery is at least once: receivers should
+    ignore event ids they have already seen.
+    """
+    def __init__(self, app, threads=OUTBOX_THREADS, per_endpoint=OUTBOX_ENDPOINT_CONCURRENCY,
+                 batch_size=OUTBOX_BATCH_SIZE):
+        self.app = app
+        self.threads = threads
+        self.per_endpoint = per_endpoint
+        self.batch_size = batch_size
+        self.pool = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='webhook')
+        self.runner = None
+        self.wakeup = threading.Event()
+        self.in_flight = {}
+        self._lock = threading.Lock()
+        self.delivered = 0
+        self.failed = 0
+
+    def claim(self):
+        """Leases the due events into batches, one list of events per endpoint slot
+        """
+        now = datetime.datetime.utcnow()
+        with self._lock:
+            busy = [endpoint for endpoint, count in self.in_flight.items() if count >= self.per_endpoint]
+        query = OutboxEvent.query\
+            .filter(OutboxEvent.status == 'pending', OutboxEvent.next_attempt_at <= now)
+        if busy:
+            query = query.filter(OutboxEvent.endpoint.notin_(busy))
+        events = query.order_by(OutboxEvent.id)\
+            .limit(self.batch_size * self.threads)\
+            .with_for_update(skip_locked=True).all()
+
+        batches, slots = [], {}
+        for outbox_event in events:
+            endpoint = outbox_event.endpoint
+            endpoint_batches = slots.setdefault(endpoint, [])
+            if not endpoint_batches or len(endpoint_batches[-1]) >= self.batch_size:
+                with self._lock:
+                    if self.in_flight.get(endpoint, 0) + len(endpoint_batches) >= self.per_endpoint:
+                        continue
+                endpoint_batches.append([])
+                batches.append((endpoint, endpoint_batches[-1]))
+            endpoint_batches[-1].append(outbox_event)
+            outbox_event.next_attempt_at = now + datetime.timedelta(seconds=OUTBOX_LEASE)
+
+        claimed = [(endpoint, [(e.id, e.attempts, e.payload) for e in batch]) for endpoint, batch in batches]
+        db.session.commit()
+        with self._lock:
+            for endpoint, batch in claimed:
+                self.in_flight[endpoint] = self.in_flight.get(endpoint, 0) + 1
+        return claimed
+
+    def deliver(self, endpoint, batch):
+        body = json.dumps({'events': [json.loads(payload) for _, _, payload in batch]}).encode()
+        try:
+            request = Request(endpoint, data=body, method='POST',
+                              headers={'Content-Type': 'application/json'})
+            with urlopen(request, timeout=OUTBOX_TIMEOUT):
+                error = None
+        except Exception as exception:
+            error = str(exception) or exception.__class__.__name__
+
+        try:
+            with self.app.app_context():
+                self.settle(batch, error)
+        finally:
+            with self._lock:
+                self.in_flight[endpoint] -= 1
+            self.wakeup.set()
+
+    def settle(self, batch, error):
+        table = OutboxEvent.__table__
+        now = datetime.datetime.utcnow()
+        if error is None:
+            db.session.execute(table.update()
+                .where(table.c.id.in_([id for id, _, _ in batch]))
+                .values(status='delivered', delivered_at=now, attempts=table.c.attempts + 1))
+            self.delivered += len(batch)
+        else:
+            db.session.execute(table.update().where(table.c.id == db.bindparam('event_id')), [{
+                'event_id': id,
+                'attempts': attempts + 1,
+                'status': 'dead' if attempts + 1 >= OUTBOX_MAX_ATTEMPTS else 'pending',
+                'next_attempt_at': now + datetime.timedelta(seconds=backoff(attempts + 1)),
+                'last_error': error[:1000]
+            } for id, attempts, _ in batch])
+            self.failed += len(batch)
+        db.session.commit()
+
+    def purge(self):
+        table = OutboxEvent.__table__
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(seconds=OUTBOX_RETENTION)
+        db.session.execute(table.delete()
+            .where(table.c.status == 'delivered').where(table.c.delivered_at < cutoff))
+        db.session.commit()
+
+    def run_once(self):
+        """Claims due events and hands their batches to the pool, returning the futures
+        """
+        with self.app.app_context():
+            try:
+                batches = self.claim()
+            finally:
+                db.session.remove()
+        return [self.pool.submit(self.deliver, endpoint, batch) for endpoint, batch in batches]
+
+    def run(self):
+        runs = 0
+        while True:
+            self.wakeup.clear()
+            try:
+                futures = self.run_once()
+                runs += 1
+                if runs % 1000 == 0:
+                    with self.app.app_context():
+                        self.purge()
+            except Exception:
+                self.app.logger.exception('Outbox dispatch failed')
+                futures = []
+            if not futures:
+                self.wakeup.wait(OUTBOX_POLL_INTERVAL)
+
+    def stats(self):
+        with self._lock:
+            in_flight = dict(self.in_flight)
+        return {'delivered': self.delivered, 'failed': self.failed, 'in_flight': in_flight}
+
+dispatcher = None
+
+def start_dispatcher(app):
+    """Starts the dispatcher of this process on a daemon thread, once, when webhooks are configured.
+    A forked worker starts its own, the threads of the parent do not survive the fork.
+    """
+    global dispatcher
+    if not WEBHOOK_URLS or (dispatcher is not None and dispatcher.runner.is_alive()):
+        return
+    dispatcher = Dispatcher(app)
+    dispatcher.runner = threading.Thread(target=dispatcher.run, name='outbox-dispatcher', daemon=True)
+    dispatcher.runner.start()
@@ -0,0 +1,160 @@
+import os
+import sys
+import time
+import uuid
+import cProfile
+import tempfile
+import threading
+from collections import Counter
+from flask import current_app, request, g, abort
+
+from auth import decode_token, check_permissions, ADMIN_PERMISSION
+
+# directory the profiles of this host are written to
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'casting-profiles'))
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 50))
+# seconds between two stack samples of the sampling profiler
+PROFILE_SAMPLE_INTERVAL = 0.005
+
+# profiler modes and the extension of the file each one writes
+MODES = {'cprofile': 'prof', 'sample': 'collapsed'}
+
+
+## Sampling profiler
+class Sampler(threading.Thread):
+    """Samples the stack of one thread every PROFILE_SAMPLE_INTERVAL seconds and
+    counts the collapsed stacks, in the format read by flamegraph.pl and speedscope
+    """
+    def __init__(self, target, interval=PROFILE_SAMPLE_INTERVAL):
+        threading.Thread.__init__(self, name='profile-sampler', daemon=True)
+        self.target = target
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def dump(self, path):
+        with open(path, 'w') as output:
+            for stack, count in self.stacks.most_common():
+                output.write(f'{stack} {count}\n')
+
+
+## Profile store
+class ProfileStore:
+    """Keeps the latest PROFILE_MAX_FILES profiles in a local directory
+    """
+    def __init__(self, directory=PROFILE_DIR, max_files=PROFILE_MAX_FILES):
+        self.directory = directory
+        self.max_files = max_files
+
+    def path_for(self, mode):
+        os.makedirs(self.directory, exist_ok=True)
+        endpoint = (request.endpoint or 'unknown').replace('.', '-')
+        name = f'{int(time.time() * 1000)}-{request.method}-{endpoint}-{uuid.uuid4().hex[:8]}.{MODES[mode]}'
+        return name, os.path.join(self.directory, name)
+
+    def list(self):
+        if not os.path.isdir(self.directory):
+            return []
+        entries = sorted(os.scandir(self.directory), key=lambda entry: entry.name, reverse=True)
+        return [{
+            'name': entry.name,
+            'mode': 'cprofile' if entry.name.endswith('.prof') else 'sample',
+            'size': entry.stat().st_size,
+            'created': entry.stat().st_mtime
+        } for entry in entries if entry.is_file()]
+
+    def evict(self):
+        for profile in self.list()[self.max_files:]:
+            try:
+                os.remove(os.path.join(self.directory, profile['name']))
+            except OSError:
+                pass
+
+store = ProfileStore()
+
+
+## Request hooks
+# one profiled request per worker at a time, the interpreter allows a single active cProfile
+_profiling = threading.Lock()
+
+def requested_mode():
+    """Returns the profiler asked for with the X-Profile header or the profile
+    query flag, or None for the usual unprofiled request
+    """
+    mode = request.headers.get('X-Profile') or request.args.get('profile')
+    if not mode:
+        return None
+    return 'cprofile' if mode in ('1', 'true') else mode
+
+def start():
+    mode = requested_mode()
+    if mode is None:
+        return
+    if mode not in MODES:
+        abort(422)
+    check_permissions(ADMIN_PERMISSION, decode_token())
+    if not _profiling.acquire(blocking=False):
+        abort(409)
+
+    try:
+        if mode == 'cprofile':
+            profiler = cProfile.Profile()
+            profiler.enable()
+        else:
+            profiler = Sampler(threading.get_ident())
+            profiler.start()
+    except:
+        _profiling.release()
+        raise
+    g.profile = (mode, profiler, time.perf_counter())
+
+def stop(response):
+    """Stops the profiler of the request and stores its profile. A profile
+    that could not be stored leaves the response as it was
+    """
+    mode, profiler, started = g.pop('profile')
+    try:
+        if mode == 'cprofile':
+            profiler.disable()
+        else:
+            profiler.stop()
+        name, path = store.path_for(mode)
+        if mode == 'cprofile':
+            profiler.dump_stats(path)
+        else:
+            profiler.dump(path)
+        response.headers['X-Profile-Id'] = name
+        response.headers['X-Profile-Duration'] = f'{(time.perf_counter() - started) * 1000:.1f}'
+        store.evict()
+    except Exception:
+        current_app.logger.exception('Storing the profile of %s %s failed', request.method, request.path)
+    finally:
+        _profiling.release()
+    return response
+
+def abandon():
+    """Stops the profiler of a request that failed before its response was made
+    """
+    mode, profiler, _ = g.pop('profile')
+    try:
+        if mode == 'cprofile':
+            profiler.disable()
+        else:
+            profiler.stop()
+    finally:
+        _profiling.release()
@@ -0,0 +1,159 @@
+import os
+import time
+import itertools
+import threading
+
+# tokens per second / burst size for each permission tier
+RATE_LIMITS = os.environ.get('RATE_LIMITS', 'assistant=10/50,director=20/100,executive=40/200')
+RATE_LIMIT_REDIS_URL = os.environ.get('RATE_LIMIT_REDIS_URL')
+# requests a worker may have in flight before new ones are shed, 0 disables shedding
+MAX_IN_FLIGHT = int(os.environ.get('MAX_IN_FLIGHT', 0))
+
+## RateLimitExceeded Exception
+'''
+RateLimitExceeded Exception
+Raised when a token has used up its bucket (429) or the worker is overloaded (503)
+'''
+class RateLimitExceeded(Exception):
+    def __init__(self, status_code, retry_after):
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+def parse_limits(limits):
+    tiers = {}
+    for tier in limits.split(','):
+        name, limit = tier.strip().split('=')
+        rate, burst = limit.split('/')
+        tiers[name] = (float(rate), float(burst))
+    return tiers
+
+def tier_for(payload):
+    # mirrors the three roles, each of which holds a permission the one below lacks
+    permissions = payload.get('permissions', [])
+    if 'delete:movies' in permissions:
+        return 'executive'
+    if 'post:actors' in permissions:
+        return 'director'
+    return 'assistant'
+
+
+## Backends
+'''
+A backend keeps one token bucket per key. take() removes a token and returns 0,
+or returns the seconds until a token will be available.
+'''
+class MemoryBackend:
+    def __init__(self, stripes=64, max_keys=100000, prune_every=1000):
+        # buckets are spread over several locks so unrelated tokens never contend
+        self._locks = [threading.Lock() for _ in range(stripes)]
+        self._buckets = {}
+        self.max_keys = max_keys
+        # above max_keys, full buckets are dropped once every prune_every takes, by one thread at a time
+        self.prune_every = prune_every
+        self._takes = itertools.count(1)
+        self._pruning = threading.Lock()
+
+    def _prune(self, now):
+        if not self._pruning.acquire(blocking=False):
+            return
+        try:
+            for key, (tokens, last, full_after) in list(self._buckets.items()):
+                if now >= full_after:
+                    self._buckets.pop(key, None)
+        finally:
+            self._pruning.release()
+
+    def take(self, key, rate, burst):
+        now = time.monotonic()
+        if next(self._takes) % self.prune_every == 0 and len(self._buckets) > self.max_keys:
+            self._prune(now)
+
+        with self._locks[hash(key) % len(self._locks)]:
+            tokens, last, _ = self._buckets.get(key, (burst, now, now))
+            tokens = min(burst, tokens + (now - last) * rate)
+            wait = 0 if tokens >= 1 else (1 - tokens) / rate
+            if not wait:
+                tokens -= 1
+            self._buckets[key] = (tokens, now, now + (burst - tokens) / rate)
+        return wait
+
+class RedisBackend:
+    script = '''
+    local rate, burst, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3])
+    local state = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+    local tokens = tonumber(state[1]) or burst
+    local last = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - last) * rate)
+    local wait = 0
+    if tokens >= 1 then tokens = tokens - 1 else wait = (1 - tokens) / rate end
+    redis.call('HSET', KEYS[1], 'tokens', tokens, 'last', now)
+    redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+    return tostring(wait)
+    '''
+
+    def __init__(self, url):
+        # redis is only required when a shared backend is configured
+        import redis
+        self._take = redis.Redis.from_url(url).register_script(self.script)
+
+    def take(self, key, rate, burst):
+        return float(self._take(keys=[f'ratelimit:{key}'], args=[rate, burst, time.time()]))
+
+
+## Rate limiter
+class RateLimiter:
+    def __init__(self, limits=RATE_LIMITS, backend=None):
+        self.tiers = parse_limits(limits)
+        self.backend = backend or MemoryBackend()
+        self.allowed = 0
+        self.limited = 0
+        self._lock = threading.Lock()
+
+    def check(self, payload):
+        """Takes a token from the bucket of the JWT subject, sized by its permission tier.
+        Tokens without a subject are refused by verify_token before they get here.
+        """
+        rate, burst = self.tiers[tier_for(payload)]
+        wait = self.backend.take(payload['sub'], rate, burst)
+        with self._lock:
+            if wait:
+                self.limited += 1
+            else:
+                self.allowed += 1
+        if wait:
+            raise RateLimitExceeded(429, wait)
+
+    def stats(self):
+        with self._lock:
+            return {'allowed': self.allowed, 'limited': self.limited}
+
+
+## Load shedding
+class LoadShedder:
+    def __init__(self, max_in_flight=MAX_IN_FLIGHT):
+        self.max_in_flight = max_in_flight
+        self._slots = threading.BoundedSemaphore(max_in_flight) if max_in_flight else None
+        self.shed = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """Claims an in-flight slot without blocking, returning False when the request was not counted
+        """
+        if self._slots is None:
+            return False
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.shed += 1
+            raise RateLimitExceeded(503, 1)
+        return True
+
+    def leave(self):
+        self._slots.release()
+
+    def stats(self):
+        return {'max_in_flight': self.max_in_flight, 'shed': self.shed}
+
+
+limiter = RateLimiter(backend=RedisBackend(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else None)
+shedder = LoadShedder()
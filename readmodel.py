@@ -0,0 +1,266 @@
+import os
+import sys
+import json
+import time
+import bisect
+import datetime
+import threading
+from array import array
+from collections import namedtuple
+from flask import current_app
+
+try:
+    import numpy
+except ImportError:
+    # filters then loop over the arrays in Python
+    numpy = None
+
+from models import Actor, Movie, Change, db
+import changes
+
+# 'true' serves /actors and /movies from columns kept in each worker instead of querying
+READ_MODEL = os.environ.get('READ_MODEL', '').lower() == 'true'
+# seconds between two looks at the change log for writes of other workers
+READ_MODEL_SYNC_INTERVAL = float(os.environ.get('READ_MODEL_SYNC_INTERVAL', 2))
+# pending changes above which loading the tables again is cheaper than applying them
+READ_MODEL_MAX_DELTA = 5000
+
+
+## Columns
+'''
+A table is kept as one array per column, in id order: integers and dates
+(as day numbers) in typed arrays of 8 bytes a value, text in lists of
+interned strings, so repeated values such as genders are stored once. A row
+is found by bisecting the ids, and each sortable column has a permutation of
+the ids in its order, computed on load and kept sorted by bisection as rows
+are written. Filters compare whole columns at once, with NumPy when it is
+installed.
+'''
+class ColumnTable:
+    def __init__(self, model):
+        self.model = model
+        self.names = [column.name for column in model.__table__.columns]
+        self.kinds = {column.name: 'date' if column.type.python_type is datetime.date else
+                      'int' if column.type.python_type is int else 'text'
+                      for column in model.__table__.columns}
+        self.Row = namedtuple(f'{model.__name__}Row', self.names)
+        self.clear()
+
+    def clear(self):
+        self.columns = {name: [] if kind == 'text' else array('q') for name, kind in self.kinds.items()}
+        self.orders = {}
+
+    def __len__(self):
+        return len(self.columns['id'])
+
+    def encode(self, name, value):
+        kind = self.kinds[name]
+        if kind == 'date':
+            # the change log has dates as text
+            return (value if isinstance(value, datetime.date) else datetime.date.fromisoformat(value[:10])).toordinal()
+        return sys.intern(value) if kind == 'text' else value
+
+    def decode(self, name, value):
+        return datetime.date.fromordinal(value) if self.kinds[name] == 'date' else value
+
+    def position(self, id):
+        return bisect.bisect_left(self.columns['id'], id)
+
+    def upsert(self, values):
+        ids = self.columns['id']
+        position = self.position(values['id'])
+        exists = position < len(ids) and ids[position] == values['id']
+        encoded = {name: self.encode(name, values[name]) for name in self.names}
+        changed = [key for key in self.orders
+                   if not exists or self.columns[key[0]][position] != encoded[key[0]]]
+        for key in changed:
+            if exists:
+                self.unorder(key, position)
+        for name in self.names:
+            if exists:
+                self.columns[name][position] = encoded[name]
+            else:
+                self.columns[name].insert(position, encoded[name])
+        for key in changed:
+            self.reorder(key, position)
+
+    def delete(self, id):
+        ids = self.columns['id']
+        position = self.position(id)
+        if position < len(ids) and ids[position] == id:
+            for key in self.orders:
+                self.unorder(key, position)
+            for column in self.columns.values():
+                del column[position]
+
+    def order(self, field, descending):
+        # ties stay in id order both ways, like ORDER BY field, id
+        key = (field, descending)
+        if key not in self.orders:
+            column, ids = self.columns[field], self.columns['id']
+            self.orders[key] = array('q', (ids[position] for position in
+                                           sorted(range(len(self)), key=column.__getitem__, reverse=descending)))
+        return self.orders[key]
+
+    def bisect(self, key, position):
+        """Returns the index of the row at position in the order of key, where
+        it is or would be inserted, comparing the current values of the columns
+        """
+        (field, descending), order = key, self.orders[key]
+        column = self.columns[field]
+        value, id = column[position], self.columns['id'][position]
+        low, high = 0, len(order)
+        while low < high:
+            middle = (low + high) // 2
+            other_id = order[middle]
+            other = column[self.position(other_id)]
+            if (other > value if descending else other < value) or (other == value and other_id < id):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def unorder(self, key, position):
+        del self.orders[key][self.bisect(key, position)]
+
+    def reorder(self, key, position):
+        self.orders[key].insert(self.bisect(key, position), self.columns['id'][position])
+
+    def vector(self, name):
+        column = self.columns[name]
+        if self.kinds[name] == 'text':
+            return numpy.array(column, dtype=object)
+        # a view of the array, dropped before the array changes again
+        return numpy.frombuffer(column, dtype=numpy.int64) if len(column) else numpy.empty(0, numpy.int64)
+
+    def matching(self, filters):
+        """Returns the positions of the rows equal to all (field, value) filters, in id order
+        """
+        if numpy is not None:
+            mask = numpy.ones(len(self), dtype=bool)
+            for name, value in filters:
+                mask &= self.vector(name) == self.encode(name, value)
+            return numpy.flatnonzero(mask)
+        positions = range(len(self))
+        for name, value in filters:
+            column, value = self.columns[name], self.encode(name, value)
+            positions = [position for position in positions if column[position] == value]
+        return positions
+
+    def page(self, start, limit, sort=None, filters=()):
+        """Returns the count of the rows matching filters and up to limit of
+        them from start, in id order or sorted by a (field, descending) pair
+        """
+        if not filters:
+            total = len(self)
+            positions = range(start, min(start + limit, total)) if sort is None else \
+                [self.position(id) for id in self.order(*sort)[start:start + limit]]
+        else:
+            matching = self.matching(filters)
+            total = len(matching)
+            if sort is None:
+                positions = matching[start:start + limit]
+            elif numpy is not None:
+                order = numpy.frombuffer(self.order(*sort), dtype=numpy.int64) if len(self) else numpy.empty(0, numpy.int64)
+                ordered = order[numpy.isin(order, self.vector('id')[matching])]
+                positions = [self.position(int(id)) for id in ordered[start:start + limit]]
+            else:
+                ids = self.columns['id']
+                matched = {ids[position] for position in matching}
+                ordered = [id for id in self.order(*sort) if id in matched]
+                positions = [self.position(id) for id in ordered[start:start + limit]]
+        return total, [self.Row(*(self.decode(name, self.columns[name][position]) for name in self.names))
+                       for position in positions]
+
+    def size(self):
+        # the bytes of the columns, counting each distinct string once
+        size = 0
+        for name, column in self.columns.items():
+            size += sys.getsizeof(column)
+            if self.kinds[name] == 'text':
+                size += sum(sys.getsizeof(value) for value in {id(value): value for value in column}.values())
+        return size
+
+
+## Read model
+class ReadModel:
+    """Keeps actors and movies as columns in this worker and folds the change
+    log into them, so a list page is a slice of arrays instead of a COUNT and
+    a SELECT. Changes committed by this worker are applied before its next
+    read, those of others every READ_MODEL_SYNC_INTERVAL seconds.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.tables = {'actors': ColumnTable(Actor), 'movies': ColumnTable(Movie)}
+        # offset of the last change applied, None until loaded
+        self.offset = None
+        self._generation = None
+        self._synced_at = 0
+        self.loads = 0
+        self.applied = 0
+
+    def load(self):
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        try:
+            # changes committing during the load are applied again, which upserts and deletes tolerate
+            offset = db.session.query(db.func.coalesce(db.func.max(Change.id), 0)).scalar() \
+                if not current_app.config['SNAPSHOT_PATH'] else 0
+            for table in self.tables.values():
+                table.clear()
+                model = table.model.__table__
+                for row in db.session.execute(model.select().order_by(model.c.id)):
+                    table.upsert(row)
+                for column, key in table.model.public_fields.values():
+                    table.order(column, False)
+        finally:
+            db.session.close()
+        self.offset, self._generation, self._synced_at = offset, changes.feed.generation, time.monotonic()
+        self.loads += 1
+
+    def sync(self):
+        now = time.monotonic()
+        if current_app.config['SNAPSHOT_PATH'] or \
+                (changes.feed.generation == self._generation and now - self._synced_at < READ_MODEL_SYNC_INTERVAL):
+            return
+        if now - self._synced_at > changes.CHANGES_COMPACT_AFTER:
+            # compaction may have dropped changes that were never applied
+            return self._load()
+        self._generation, self._synced_at = changes.feed.generation, now
+
+        pending = changes.fetch(self.offset, READ_MODEL_MAX_DELTA)
+        if len(pending) == READ_MODEL_MAX_DELTA:
+            return self._load()
+        for change in pending:
+            table = self.tables.get(change.entity)
+            if table is not None:
+                data = json.loads(change.data)
+                if change.op == 'delete':
+                    table.delete(data['id'])
+                else:
+                    table.upsert(data)
+                self.applied += 1
+            self.offset = change.id
+
+    def page(self, name, start, limit, sort=None, filters=()):
+        """Returns the count of the rows of the table matching filters and up
+        to limit of them from start, in id order or sorted by a (field, descending) pair
+        """
+        with self._lock:
+            if self.offset is None:
+                self._load()
+            else:
+                self.sync()
+            return self.tables[name].page(start, limit, sort, filters)
+
+    def stats(self):
+        return {
+            'loads': self.loads,
+            'applied': self.applied,
+            'rows': {name: len(table) for name, table in self.tables.items()},
+            'bytes': {name: table.size() for name, table in self.tables.items()}
+        }
+
+read_model = ReadModel()
@@ -0,0 +1,192 @@
+import os
+import time
+import threading
+from functools import wraps
+from flask import g, request, has_app_context, has_request_context
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.dml import UpdateBase
+
+# comma separated database urls of read replicas, read endpoints use the primary when unset
+REPLICA_DATABASE_URLS = os.environ.get('REPLICA_DATABASE_URLS', '')
+# seconds a subject keeps reading from the primary after one of its writes
+REPLICA_READ_YOUR_WRITES = float(os.environ.get('REPLICA_READ_YOUR_WRITES', 5))
+# seconds a failed replica is left out before it is tried again
+REPLICA_RETRY_AFTER = float(os.environ.get('REPLICA_RETRY_AFTER', 30))
+# cookie carrying the time of the last write of a client to the workers serving its next reads
+REPLICA_WRITE_COOKIE = 'last_write'
+
+
+class _Replica:
+    def __init__(self, engine):
+        self.engine = engine
+        self.down_until = 0
+
+class ReplicaRouter:
+    """Hands out healthy replica engines round-robin and remembers which
+    subjects wrote recently so they keep reading their own writes. The
+    subjects are only known to the worker that served the write, other
+    workers and hosts rely on the last_write cookie the client sends back.
+    """
+    def __init__(self):
+        self.replicas = []
+        self.queries = {}
+        self.errors = {}
+        self._next = 0
+        self._writes = {}
+        self._lock = threading.Lock()
+
+    def configure(self, urls=REPLICA_DATABASE_URLS):
+        self.replicas = []
+        for url in filter(None, (url.strip() for url in urls.split(','))):
+            self.replicas.append(_Replica(create_engine(url, pool_pre_ping=True)))
+
+    def count_query(self, engine):
+        with self._lock:
+            self.queries[engine] = self.queries.get(engine, 0) + 1
+
+    def count_error(self, engine, error):
+        with self._lock:
+            self.errors[engine] = self.errors.get(engine, 0) + 1
+        replica = next((replica for replica in self.replicas if replica.engine is engine), None)
+        if replica is not None and isinstance(error, exc.OperationalError):
+            replica.down_until = time.monotonic() + REPLICA_RETRY_AFTER
+            if has_app_context():
+                g.replica_failed = True
+
+    def pick(self):
+        now = time.monotonic()
+        with self._lock:
+            for _ in range(len(self.replicas)):
+                replica = self.replicas[self._next % len(self.replicas)]
+                self._next += 1
+                if replica.down_until <= now:
+                    return replica
+        return None
+
+    def note_write(self, subject):
+        now = time.monotonic()
+        with self._lock:
+            self._writes[subject] = now
+            if len(self._writes) > 10000:
+                for key, wrote_at in list(self._writes.items()):
+                    if now - wrote_at > REPLICA_READ_YOUR_WRITES:
+                        self._writes.pop(key, None)
+
+    def wrote_recently(self, subject):
+        return time.monotonic() - self._writes.get(subject, float('-inf')) < REPLICA_READ_YOUR_WRITES
+
+    def stats(self):
+        now = time.monotonic()
+        health = {replica.engine: replica.down_until <= now for replica in self.replicas}
+        with self._lock:
+            queries, errors = dict(self.queries), dict(self.errors)
+        engines = list(queries) + [engine for engine in errors if engine not in queries]
+        engines += [engine for engine in health if engine not in engines]
+        return [{
+            'url': repr(engine.url),
+            'role': 'replica' if engine in health else 'primary',
+            'healthy': health.get(engine, True),
+            'queries': queries.get(engine, 0),
+            'errors': errors.get(engine, 0)
+        } for engine in engines]
+
+router = ReplicaRouter()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def count_query(connection, cursor, statement, parameters, context, executemany):
+    router.count_query(connection.engine)
+
+@event.listens_for(Engine, 'handle_error')
+def count_error(context):
+    router.count_error(context.engine, context.sqlalchemy_exception)
+
+
+def routed_replica():
+    """Returns the replica the reads of the request go to, None for the primary
+    """
+    return g.get('read_replica') if has_app_context() else None
+
+class RoutingSession(SignallingSession):
+    """Sends reads made inside a read_only handler to the replica picked for the
+    request. Flushes and INSERT/UPDATE/DELETE statements always use the primary.
+    """
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase):
+            # statements executed without a flush, e.g. bulk updates, are writes too
+            self.info['wrote'] = True
+        replica = routed_replica()
+        if replica is not None and not self._flushing and not isinstance(clause, UpdateBase):
+            return replica.engine
+        return SignallingSession.get_bind(self, mapper, clause)
+
+@event.listens_for(RoutingSession, 'after_flush')
+def flushed(session, flush_context):
+    session.info['wrote'] = True
+
+@event.listens_for(RoutingSession, 'after_commit')
+def remember_write(session):
+    # commits of sessions that only read leave the subject on the replicas
+    if not session.info.pop('wrote', False):
+        return
+    if has_app_context() and g.get('jwt'):
+        router.note_write(g.jwt.get('sub'))
+    if has_request_context():
+        g.last_write = time.time()
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_write(session):
+    session.info.pop('wrote', None)
+
+
+## Read-your-writes cookie
+'''
+A response to a request that committed a write sets the last_write cookie to
+the wall clock time of the commit, for as long as the read-your-writes window.
+Any worker, on any host with a synchronised clock, then sends the reads of
+that client to the primary. Clients that drop cookies only read their writes
+on the worker that served them, for the subjects it remembers.
+'''
+def set_write_cookie(response):
+    wrote_at = g.pop('last_write', None)
+    if wrote_at is not None:
+        response.set_cookie(REPLICA_WRITE_COOKIE, f'{wrote_at:.3f}', max_age=max(1, int(REPLICA_READ_YOUR_WRITES + 0.999)),
+                            httponly=True, samesite='Lax')
+    return response
+
+def client_wrote_recently():
+    try:
+        wrote_at = float(request.cookies.get(REPLICA_WRITE_COOKIE, ''))
+    except ValueError:
+        return False
+    return time.time() - wrote_at < REPLICA_READ_YOUR_WRITES
+
+
+def read_only(f):
+    """Routes the queries of a handler to a read replica, unless none is healthy or
+    the subject or its client wrote within the read-your-writes window. A handler that fails
+    because its replica went away is run again on the primary.
+    Apply below requires_auth.
+    """
+    @wraps(f)
+    def wrapper(jwt, *args, **kwargs):
+        if not router.replicas or router.wrote_recently(jwt.get('sub')) or client_wrote_recently():
+            return f(jwt, *args, **kwargs)
+
+        replica = router.pick()
+        if replica is None:
+            return f(jwt, *args, **kwargs)
+
+        g.read_replica = replica
+        try:
+            return f(jwt, *args, **kwargs)
+        except Exception:
+            if not g.pop('replica_failed', False):
+                raise
+        finally:
+            g.read_replica = None
+
+        return f(jwt, *args, **kwargs)
+
+    return wrapper
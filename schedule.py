@@ -0,0 +1,264 @@
+import os
+import json
+import time
+import datetime
+import threading
+from contextlib import contextmanager
+from flask import current_app
+from sqlalchemy import event
+
+from models import Actor, Project, Change, separate_session, db
+from replicas import RoutingSession
+import changes
+
+# seconds between two looks at the change log for cast changes of other workers
+SCHEDULE_SYNC_INTERVAL = float(os.environ.get('SCHEDULE_SYNC_INTERVAL', 2))
+# pending changes above which loading the bookings again is cheaper than applying them
+SCHEDULE_MAX_DELTA = 5000
+
+
+def shoot_dates(body):
+    """Returns the (start, end) shoot dates of a cast assignment body, or None when it has none.
+    Raises ValueError unless both are ISO dates with start on or before end.
+    """
+    start, end = body.get('shoot_start'), body.get('shoot_end')
+    if start is None and end is None:
+        return None
+    start, end = datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)
+    if start > end:
+        raise ValueError('shoot_start is after shoot_end')
+    return start, end
+
+
+## Interval tree
+class IntervalTree:
+    """Closed intervals (start, end, value) sorted by start, seen as a
+    balanced tree whose root is the middle interval. Each node keeps the
+    latest end of its subtree, so an overlap query skips every subtree that
+    ends before the query starts and, right of a node starting after the
+    query ends, everything: O(log n + matches).
+    """
+    def __init__(self, intervals=()):
+        self.intervals = sorted(intervals)
+        self.latest_end = [None] * len(self.intervals)
+        self._build(0, len(self.intervals))
+
+    def _build(self, low, high):
+        if low >= high:
+            return None
+        middle = (low + high) // 2
+        latest = self.intervals[middle][1]
+        for child in (self._build(low, middle), self._build(middle + 1, high)):
+            if child is not None and child > latest:
+                latest = child
+        self.latest_end[middle] = latest
+        return latest
+
+    def __len__(self):
+        return len(self.intervals)
+
+    def overlapping(self, start, end):
+        """Returns the values of the intervals sharing a day with [start, end]
+        """
+        found = []
+        stack = [(0, len(self.intervals))]
+        while stack:
+            low, high = stack.pop()
+            if low >= high:
+                continue
+            middle = (low + high) // 2
+            if self.latest_end[middle] < start:
+                continue
+            stack.append((low, middle))
+            interval_start, interval_end, value = self.intervals[middle]
+            if interval_start <= end:
+                if interval_end >= start:
+                    found.append(value)
+                stack.append((middle + 1, high))
+        return found
+
+
+## Schedule index
+class ScheduleIndex:
+    """Keeps the dated bookings of this worker in memory: an interval tree
+    per actor for conflict checks, and one over all bookings for the actors
+    busy in a period. Trees are rebuilt on the next query after a booking
+    changes. Cast changes committed by this worker are applied before its
+    next query, those of others every SCHEDULE_SYNC_INTERVAL seconds;
+    PostgreSQL also refuses overlapping bookings of an actor by constraint.
+    The index reads with sessions of its own, never the one of a request in
+    the middle of its transaction.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # actor id -> lock held from the conflict check of a booking until its commit
+        self._actor_locks = {}
+        # actor id -> name, and actor id -> {movie id: (start, end)} as day numbers
+        self.actors = {}
+        self.bookings = {}
+        self._trees = {}
+        self._all = None
+        # actor ids in order, rebuilt when actors come or go
+        self._roster = None
+        self.offset = None
+        self._generation = None
+        self._synced_at = 0
+        self.loads = 0
+
+    def load(self):
+        with self._lock:
+            self._load()
+
+    def _load(self):
+        with separate_session() as session:
+            offset = session.query(db.func.coalesce(db.func.max(Change.id), 0)).scalar() \
+                if not current_app.config['SNAPSHOT_PATH'] else 0
+            self.actors = {row.id: f'{row.firstname} {row.surname}' for row in
+                           session.query(Actor.id, Actor.firstname, Actor.surname)}
+            self.bookings = {}
+            for row in session.query(Project.actor_id, Project.movie_id, Project.shoot_start, Project.shoot_end)\
+                    .filter(Project.shoot_start.isnot(None)):
+                self.book(row.actor_id, row.movie_id, row.shoot_start, row.shoot_end)
+        self._trees, self._all, self._roster = {}, None, None
+        self.offset, self._generation, self._synced_at = offset, changes.feed.generation, time.monotonic()
+        self.loads += 1
+
+    def book(self, actor_id, movie_id, start, end):
+        if isinstance(start, str):
+            start, end = datetime.date.fromisoformat(start), datetime.date.fromisoformat(end)
+        self.bookings.setdefault(actor_id, {})[movie_id] = (start.toordinal(), end.toordinal())
+        self._trees.pop(actor_id, None)
+        self._all = None
+
+    def cancel(self, actor_id, movie_id):
+        if self.bookings.get(actor_id, {}).pop(movie_id, None) is not None:
+            self._trees.pop(actor_id, None)
+            self._all = None
+
+    def apply(self, change):
+        data = json.loads(change.data)
+        if change.entity == 'actors':
+            # the cast of a deleted actor is in the log as project deletes
+            if change.op == 'delete':
+                self.actors.pop(data['id'], None)
+                self._roster = None
+            else:
+                if data['id'] not in self.actors:
+                    self._roster = None
+                self.actors[data['id']] = f"{data['firstname']} {data['surname']}"
+        elif change.entity == 'projects':
+            if change.op == 'delete':
+                self.cancel(data['actor_id'], data['movie_id'])
+            elif data.get('shoot_start') is not None:
+                self.book(data['actor_id'], data['movie_id'], data['shoot_start'], data['shoot_end'])
+
+    def sync(self):
+        now = time.monotonic()
+        if current_app.config['SNAPSHOT_PATH'] or \
+                (changes.feed.generation == self._generation and now - self._synced_at < SCHEDULE_SYNC_INTERVAL):
+            return
+        if now - self._synced_at > changes.CHANGES_COMPACT_AFTER:
+            # compaction may have dropped changes that were never applied
+            return self._load()
+        self._generation, self._synced_at = changes.feed.generation, now
+
+        pending = changes.fetch(self.offset, SCHEDULE_MAX_DELTA)
+        if len(pending) == SCHEDULE_MAX_DELTA:
+            return self._load()
+        for change in pending:
+            self.apply(change)
+            self.offset = change.id
+
+    def _current(self):
+        if self.offset is None:
+            self._load()
+        else:
+            self.sync()
+
+    def conflicts(self, actor_id, start, end):
+        """Returns the ids of the movies the actor shoots on any day from start to end
+        """
+        with self._lock:
+            self._current()
+            tree = self._trees.get(actor_id)
+            if tree is None:
+                tree = self._trees[actor_id] = IntervalTree(
+                    (interval[0], interval[1], movie_id) for movie_id, interval in self.bookings.get(actor_id, {}).items())
+            return sorted(tree.overlapping(start.toordinal(), end.toordinal()))
+
+    @contextmanager
+    def booking(self, actor_ids):
+        """Holds the locks of the actors, in id order, while a request checks
+        their bookings and commits them, so two requests of this worker never
+        both pass the check for overlapping days
+        """
+        with self._lock:
+            locks = [self._actor_locks.setdefault(actor_id, threading.Lock()) for actor_id in sorted(set(actor_ids))]
+        for lock in locks:
+            lock.acquire()
+        try:
+            yield
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def reserve(self, actor_id, movie_id, start, end):
+        """Checks a booking against the committed ones and those made earlier in
+        the transaction of the request, which the index cannot see yet, and
+        remembers it for that transaction. Returns the ids of the conflicting movies.
+        """
+        pending = db.session.info.setdefault('bookings', [])
+        conflicts = self.conflicts(actor_id, start, end) + [
+            booked_movie for booked_actor, booked_movie, booked_start, booked_end in pending
+            if booked_actor == actor_id and booked_start <= end and booked_end >= start]
+        if not conflicts:
+            pending.append((actor_id, movie_id, start, end))
+        return sorted(conflicts)
+
+    def commit_bookings(self, bookings):
+        # ahead of the change log, which may still stop at a gap before them
+        with self._lock:
+            for actor_id, movie_id, start, end in bookings:
+                self.book(actor_id, movie_id, start, end)
+
+    def available(self, start, end, offset=0, limit=None):
+        """Returns the number of actors shooting no movie on any day from start
+        to end, and the (id, name) of up to limit of them from offset, by id
+        """
+        with self._lock:
+            self._current()
+            if self._all is None:
+                self._all = IntervalTree((interval[0], interval[1], actor_id)
+                                         for actor_id, bookings in self.bookings.items()
+                                         for interval in bookings.values())
+            if self._roster is None:
+                self._roster = sorted(self.actors)
+            busy = set(self._all.overlapping(start.toordinal(), end.toordinal())) & self.actors.keys()
+
+            page = []
+            for actor_id in self._roster:
+                if limit is not None and len(page) == limit:
+                    break
+                if actor_id in busy:
+                    continue
+                if offset:
+                    offset -= 1
+                    continue
+                page.append((actor_id, self.actors[actor_id]))
+            return len(self.actors) - len(busy), page
+
+    def stats(self):
+        return {'loads': self.loads, 'actors': len(self.actors),
+                'bookings': sum(len(bookings) for bookings in self.bookings.values())}
+
+index = ScheduleIndex()
+
+@event.listens_for(RoutingSession, 'after_commit')
+def commit_bookings(session):
+    bookings = session.info.pop('bookings', None)
+    if bookings:
+        index.commit_bookings(bookings)
+
+@event.listens_for(RoutingSession, 'after_rollback')
+def forget_bookings(session):
+    session.info.pop('bookings', None)
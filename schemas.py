@@ -0,0 +1,72 @@
+import datetime
+
+## ValidationError Exception
+'''
+ValidationError Exception
+Raised when a request body does not match the schema of the resource
+'''
+class ValidationError(Exception):
+    def __init__(self, field, description):
+        self.field = field
+        self.description = description
+
+
+## Field parsers
+def _name(max_length=None):
+    def parse(field, value):
+        if not isinstance(value, str) or not value.strip():
+            raise ValidationError(field, 'Expected a non-empty string.')
+        if max_length and len(value) > max_length:
+            raise ValidationError(field, f'Expected at most {max_length} characters.')
+        return value.strip().title()
+    return parse
+
+def _age(field, value):
+    if isinstance(value, bool) or not isinstance(value, int) or not 0 <= value <= 150:
+        raise ValidationError(field, 'Expected an integer between 0 and 150.')
+    return value
+
+def _date(field, value):
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except (TypeError, ValueError):
+        raise ValidationError(field, 'Expected a date formatted as YYYY-MM-DD.')
+
+
+## Schemas
+'''
+Each schema maps a request field onto its column name and parser
+'''
+ACTOR_SCHEMA = {
+    'first_name': ('firstname', _name(120)),
+    'second_name': ('surname', _name(120)),
+    'gender': ('gender', _name(20)),
+    'age': ('age', _age),
+}
+
+MOVIE_SCHEMA = {
+    'title': ('title', _name()),
+    'release_date': ('release_date', _date),
+}
+
+def validate(schema, body, partial=False):
+    """Maps a request body onto column values, rejecting unknown, missing or malformed fields
+    """
+    if not isinstance(body, dict):
+        raise ValidationError(None, 'Expected a JSON object.')
+
+    unknown = set(body) - set(schema)
+    if unknown:
+        raise ValidationError(sorted(unknown)[0], 'Unknown field.')
+
+    values = {}
+    for field, (column, parse) in schema.items():
+        if field in body:
+            values[column] = parse(field, body[field])
+        elif not partial:
+            raise ValidationError(field, 'Missing field.')
+
+    if not values:
+        raise ValidationError(None, 'No fields to update.')
+
+    return values
@@ -0,0 +1,153 @@
+import os
+import re
+import time
+import random
+import datetime
+import threading
+from collections import deque
+from flask import request, has_app_context, has_request_context, current_app
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# milliseconds a statement may run before it is recorded, negative disables the log
+SLOW_QUERY_THRESHOLD = float(os.environ.get('SLOW_QUERY_THRESHOLD', 200))
+# share of slow SELECT statements run again under EXPLAIN ANALYZE to capture their plan
+SLOW_QUERY_EXPLAIN_RATE = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0.1))
+SLOW_QUERY_LOG_SIZE = int(os.environ.get('SLOW_QUERY_LOG_SIZE', 500))
+SLOW_QUERY_MAX_VALUE = 100
+
+
+def normalize(parameters):
+    """Makes the bound parameters of a statement safe to keep: long values are
+    cut short, binary values reduced to their size, and only the first row of
+    an executemany is kept along with the number of rows.
+    """
+    def value(value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return f'<{len(value)} bytes>'
+        if isinstance(value, (int, float, bool)) or value is None:
+            return value
+        value = str(value)
+        return value if len(value) <= SLOW_QUERY_MAX_VALUE else value[:SLOW_QUERY_MAX_VALUE] + '...'
+
+    def row(parameters):
+        if isinstance(parameters, dict):
+            return {key: value(parameter) for key, parameter in parameters.items()}
+        return [value(parameter) for parameter in parameters]
+
+    if isinstance(parameters, list):
+        return {'rows': len(parameters), 'first': row(parameters[0]) if parameters else None}
+    return row(parameters or ())
+
+def explain(connection, statement, parameters):
+    """Runs a SELECT again under EXPLAIN on a raw cursor of the same connection,
+    inside a savepoint rolled back afterwards: whatever EXPLAIN ANALYZE did,
+    locked or failed is undone, and the transaction that ran the statement
+    carries on as if the plan had never been captured
+    """
+    dialect = connection.dialect.name
+    if dialect == 'postgresql':
+        prefix = 'EXPLAIN (ANALYZE, BUFFERS) '
+    elif dialect == 'sqlite':
+        prefix = 'EXPLAIN QUERY PLAN '
+    else:
+        return None
+
+    cursor = connection.connection.cursor()
+    try:
+        cursor.execute('SAVEPOINT slow_query_explain')
+        try:
+            cursor.execute(prefix + statement, parameters)
+            return '\n'.join(' '.join(str(column) for column in row) for row in cursor.fetchall())
+        finally:
+            cursor.execute('ROLLBACK TO SAVEPOINT slow_query_explain')
+            cursor.execute('RELEASE SAVEPOINT slow_query_explain')
+    except Exception as error:
+        return f'EXPLAIN failed: {error}'
+    finally:
+        cursor.close()
+
+
+## Slow query log
+class SlowQueryLog:
+    """Keeps the latest slow statements in a ring buffer of SLOW_QUERY_LOG_SIZE
+    entries, each with the route that ran it and, for a sample of the SELECT
+    statements, the plan the database chose.
+    """
+    def __init__(self, threshold=SLOW_QUERY_THRESHOLD, explain_rate=SLOW_QUERY_EXPLAIN_RATE,
+                 size=SLOW_QUERY_LOG_SIZE):
+        self.threshold = threshold
+        self.explain_rate = explain_rate
+        self._entries = deque(maxlen=size)
+        self._lock = threading.Lock()
+        self._next_id = 1
+        self.recorded = 0
+        self.explained = 0
+
+    def record(self, connection, statement, parameters, duration, executemany):
+        plan = None
+        if not executemany and re.match(r'\s*SELECT\b', statement, re.IGNORECASE) \
+                and random.random() < self.explain_rate:
+            plan = explain(connection, statement, parameters)
+
+        if has_request_context():
+            route = f'{request.method} {request.url_rule.rule if request.url_rule else request.path}'
+        else:
+            route = threading.current_thread().name
+
+        with self._lock:
+            entry = {
+                'id': self._next_id,
+                'at': datetime.datetime.utcnow().isoformat() + 'Z',
+                'duration_ms': round(duration * 1000, 3),
+                'route': route,
+                'statement': ' '.join(statement.split()),
+                'parameters': normalize(parameters),
+                'plan': plan
+            }
+            self._next_id += 1
+            self._entries.append(entry)
+            self.recorded += 1
+            if plan is not None:
+                self.explained += 1
+
+        if has_app_context():
+            current_app.logger.warning('Slow query (%.1f ms) in %s: %s', entry['duration_ms'], route, entry['statement'][:200])
+
+    def entries(self, route=None, min_ms=0, limit=None):
+        """Returns the recorded statements, newest first
+        """
+        with self._lock:
+            entries = list(reversed(self._entries))
+        entries = [entry for entry in entries
+                   if entry['duration_ms'] >= min_ms and (route is None or entry['route'] == route)]
+        return entries[:limit]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'threshold_ms': self.threshold,
+            'recorded': self.recorded,
+            'explained': self.explained,
+            'kept': len(self._entries)
+        }
+
+slow_queries = SlowQueryLog()
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_timer(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault('query_start_time', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_slow_query(connection, cursor, statement, parameters, context, executemany):
+    duration = time.perf_counter() - connection.info['query_start_time'].pop()
+    if 0 <= slow_queries.threshold <= duration * 1000:
+        slow_queries.record(connection, statement, parameters, duration, executemany)
+
+@event.listens_for(Engine, 'handle_error')
+def stop_timer(context):
+    if context.connection is not None and context.connection.info.get('query_start_time'):
+        context.connection.info['query_start_time'].pop()
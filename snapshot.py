@@ -0,0 +1,101 @@
+import os
+import time
+import sqlite3
+import functools
+from sqlalchemy import create_engine
+from sqlalchemy.pool import QueuePool
+
+from models import Actor, Movie, Project, Document, Token, db
+
+# bytes of the snapshot each connection maps into memory instead of reading through the page cache
+SNAPSHOT_MMAP_SIZE = int(os.environ.get('SNAPSHOT_MMAP_SIZE', 256 * 2**20))
+# kibibytes of pages each connection caches
+SNAPSHOT_CACHE_SIZE = int(os.environ.get('SNAPSHOT_CACHE_SIZE', 16 * 1024))
+SNAPSHOT_BATCH_SIZE = 1000
+# the read API needs these, the token store is exported empty so authentication falls back to the header
+SNAPSHOT_TABLES = (Actor.__table__, Movie.__table__, Project.__table__, Document.__table__)
+# indexes the primary keys do not cover, for the joins of the detail routes
+SNAPSHOT_INDEXES = ('CREATE INDEX ix_projects_actor_id ON projects (actor_id)',)
+
+
+## Export
+def export(path):
+    """Writes the actors, movies and cast of the database to a SQLite file at
+    path, read in one transaction so they are consistent with each other.
+    The file is written aside and moved into place, nodes serving the
+    previous snapshot keep reading it until they restart. Returns the rows
+    copied per table.
+    """
+    temporary = f'{path}.tmp'
+    if os.path.exists(temporary):
+        os.remove(temporary)
+    target = create_engine(f'sqlite:///{temporary}')
+    db.metadata.create_all(target, tables=SNAPSHOT_TABLES + (Token.__table__,))
+
+    counts = {}
+    # a repeatable read transaction sees every table as of the same moment
+    options = {'isolation_level': 'REPEATABLE READ'} if db.engine.dialect.name == 'postgresql' else {}
+    with db.engine.connect().execution_options(**options) as source, source.begin():
+        with target.begin() as connection:
+            for table in SNAPSHOT_TABLES:
+                counts[table.name] = 0
+                rows = source.execute(table.select().order_by(*table.primary_key.columns))
+                while True:
+                    batch = rows.fetchmany(SNAPSHOT_BATCH_SIZE)
+                    if not batch:
+                        break
+                    connection.execute(table.insert(), [dict(row) for row in batch])
+                    counts[table.name] += len(batch)
+
+            # the schema version of the source, so readiness probes can tell an outdated snapshot
+            try:
+                revision = source.execute('SELECT version_num FROM alembic_version').scalar()
+            except Exception:
+                revision = None
+            connection.execute('CREATE TABLE alembic_version (version_num VARCHAR(32) NOT NULL PRIMARY KEY)')
+            if revision is not None:
+                connection.execute('INSERT INTO alembic_version VALUES (?)', (revision,))
+
+            for statement in SNAPSHOT_INDEXES:
+                connection.execute(statement)
+
+    with target.connect() as connection:
+        connection.execute('ANALYZE')
+        connection.execute('VACUUM')
+    target.dispose()
+
+    os.replace(temporary, path)
+    return counts
+
+
+## Serving
+'''
+A snapshot never changes once exported, so it is opened immutable: SQLite
+then takes no locks and keeps no journal or WAL index, and any number of
+threads and workers read it side by side without coordinating.
+'''
+def connect(path):
+    connection = sqlite3.connect(f'file:{path}?mode=ro&immutable=1', uri=True, check_same_thread=False)
+    connection.execute(f'PRAGMA mmap_size = {SNAPSHOT_MMAP_SIZE}')
+    connection.execute(f'PRAGMA cache_size = -{SNAPSHOT_CACHE_SIZE}')
+    connection.execute('PRAGMA temp_store = MEMORY')
+    connection.execute('PRAGMA query_only = 1')
+    return connection
+
+def configure(app, path):
+    """Points the app at the snapshot at path instead of DATABASE_URL
+    """
+    path = os.path.abspath(path)
+    if not os.path.exists(path):
+        raise FileNotFoundError(f'No snapshot at {path}, export one with `flask export-snapshot {path}`')
+    app.config['SNAPSHOT_PATH'] = path
+    app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{path}'
+    # sqlite file databases default to a connection per checkout, these are kept open instead
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'creator': functools.partial(connect, path),
+        'poolclass': QueuePool
+    }
+
+def info(path):
+    exported_at = os.path.getmtime(path)
+    return {'path': path, 'exported_at': exported_at, 'age': round(time.time() - exported_at, 1)}
@@ -0,0 +1,88 @@
+import os
+import time
+from sqlalchemy import event, exc
+from sqlalchemy.pool import Pool
+
+from models import db
+from replicas import router
+from auth import jwks_cache
+import changes
+import outbox
+import audit
+from readmodel import read_model, READ_MODEL
+import schedule
+
+# pool connections each worker opens to the primary and every replica before it serves
+WARMUP_CONNECTIONS = int(os.environ.get('WARMUP_CONNECTIONS', 2))
+
+
+## Fork safety
+'''
+A pooled connection remembers the process that opened it. Checked out in
+another process, e.g. a worker forked after the master used the pool, it is
+dropped and replaced instead of sharing the socket of the parent.
+'''
+@event.listens_for(Pool, 'connect')
+def remember_pid(dbapi_connection, connection_record):
+    connection_record.info['pid'] = os.getpid()
+
+@event.listens_for(Pool, 'checkout')
+def check_pid(dbapi_connection, connection_record, connection_proxy):
+    if connection_record.info.get('pid', os.getpid()) != os.getpid():
+        connection_record.connection = connection_proxy.connection = None
+        raise exc.DisconnectionError('Connection belongs to another process')
+
+
+def engines(app):
+    with app.app_context():
+        return [db.engine] + [replica.engine for replica in router.replicas]
+
+def dispose_engines(app):
+    """Closes the pooled connections of this process, run in the master before it forks
+    """
+    for engine in engines(app):
+        engine.dispose()
+
+
+## Startup
+def start_background_tasks(app):
+    """Starts the threads of this process: change log compaction, webhook delivery and audit flushing
+    """
+    if app.config['SNAPSHOT_PATH']:
+        # a snapshot has no change log or outbox
+        return
+    changes.start_compactor(app)
+    outbox.start_dispatcher(app)
+    audit.start_flusher(app)
+
+def warmup(app, connections=WARMUP_CONNECTIONS):
+    """Readies a freshly forked worker so its first requests do not pay for
+    the JWKS fetch, connection setup or loading the schedule and read model. Returns the seconds it took.
+    """
+    started = time.perf_counter()
+    start_background_tasks(app)
+
+    try:
+        jwks_cache.get()
+    except Exception:
+        app.logger.exception('Could not prefetch the JWKS, the first request will fetch it')
+
+    with app.app_context():
+        schedule.index.load()
+        if READ_MODEL:
+            read_model.load()
+
+    for engine in engines(app):
+        opened = []
+        try:
+            for _ in range(connections):
+                connection = engine.connect()
+                opened.append(connection)
+                connection.execute('SELECT 1')
+        except Exception:
+            app.logger.exception('Could not open pool connections to %r', engine.url)
+        finally:
+            for connection in opened:
+                connection.close()
+
+    return time.perf_counter() - started
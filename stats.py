@@ -0,0 +1,202 @@
+import os
+import time
+import json
+import threading
+from sqlalchemy import extract
+
+from models import Actor, Movie, Project, Change, db
+import changes
+
+# seconds between two looks at the change log for writes of other workers
+STATS_SYNC_INTERVAL = float(os.environ.get('STATS_SYNC_INTERVAL', 5))
+# seconds after which a statistic is computed again from scratch, bounding any drift
+STATS_MAX_AGE = float(os.environ.get('STATS_MAX_AGE', 900))
+# pending changes above which recomputing is cheaper than applying them one by one
+STATS_MAX_DELTA = 5000
+STATS_TOP_ACTORS = 50
+
+
+## Statistics
+'''
+Each statistic is computed by one query and kept as a small state, the totals
+and running totals are derived from it when rendered. apply() folds a change
+of the log into the state and returns True, or returns False when the change
+cannot be applied exactly and the statistic must be computed again.
+'''
+def age_band(age):
+    return age // 10 * 10
+
+class ActorStats:
+    name = 'actors'
+    entities = ('actors',)
+
+    def compute(self):
+        band = (Actor.age / 10 * 10).label('band')
+        rows = db.session.query(Actor.gender, band, db.func.count().label('count'))\
+            .group_by(Actor.gender, band).all()
+        return {(row.gender, row.band): row.count for row in rows}
+
+    def apply(self, state, change):
+        if change.op == 'update':
+            return False
+        data = json.loads(change.data)
+        key = (data['gender'], age_band(data['age']))
+        state[key] = state.get(key, 0) + (1 if change.op == 'create' else -1)
+        if not state[key]:
+            del state[key]
+        return True
+
+    def render(self, state):
+        genders = {}
+        for (gender, band), count in sorted(state.items()):
+            genders.setdefault(gender, []).append({'band': f'{band}-{band + 9}', 'count': count})
+        return {
+            'total': sum(state.values()),
+            'genders': [{'gender': gender, 'count': sum(band['count'] for band in bands), 'age_bands': bands}
+                        for gender, bands in genders.items()]
+        }
+
+class MovieStats:
+    name = 'movies'
+    entities = ('movies',)
+
+    def compute(self):
+        year = extract('year', Movie.release_date).label('year')
+        rows = db.session.query(year, db.func.count().label('count')).group_by(year).all()
+        return {int(row.year): row.count for row in rows}
+
+    def apply(self, state, change):
+        if change.op == 'update':
+            return False
+        year = int(json.loads(change.data)['release_date'][:4])
+        state[year] = state.get(year, 0) + (1 if change.op == 'create' else -1)
+        if not state[year]:
+            del state[year]
+        return True
+
+    def render(self, state):
+        years, running_total = [], 0
+        for year, count in sorted(state.items()):
+            running_total += count
+            years.append({'year': year, 'count': count, 'running_total': running_total})
+        return {'total': running_total, 'years': years}
+
+class CastStats:
+    name = 'cast'
+    entities = ('movies', 'projects')
+
+    def compute(self):
+        row = db.session.query(
+            db.session.query(db.func.count(Movie.id)).as_scalar().label('movies'),
+            db.session.query(db.func.count()).select_from(Project).as_scalar().label('entries')).one()
+        return {'movies': row.movies, 'entries': row.entries}
+
+    def apply(self, state, change):
+        if change.op != 'update':
+            field = 'movies' if change.entity == 'movies' else 'entries'
+            state[field] += 1 if change.op == 'create' else -1
+        return True
+
+    def render(self, state):
+        return {
+            'movies': state['movies'],
+            'cast_entries': state['entries'],
+            'average_cast_size': round(state['entries'] / state['movies'], 2) if state['movies'] else 0
+        }
+
+class BusiestActorStats:
+    name = 'busiest-actors'
+    entities = ('actors', 'projects')
+
+    def compute(self):
+        movies = db.func.count(Project.movie_id)
+        rows = db.session.query(Actor.id, Actor.firstname, Actor.surname, movies.label('movies'),
+                                db.func.rank().over(order_by=movies.desc()).label('rank'))\
+            .join(Project, Project.actor_id == Actor.id)\
+            .group_by(Actor.id, Actor.firstname, Actor.surname)\
+            .order_by(movies.desc(), Actor.id).limit(STATS_TOP_ACTORS).all()
+        return [{'rank': row.rank, 'id': row.id, 'name': f'{row.firstname} {row.surname}', 'movies': row.movies}
+                for row in rows]
+
+    def apply(self, state, change):
+        # a new actor has no movies yet, any other change may reorder the ranking
+        if change.entity == 'actors':
+            data = json.loads(change.data)
+            return change.op == 'create' or all(actor['id'] != data['id'] for actor in state)
+        return False
+
+    def render(self, state, limit=10):
+        return {'actors': state[:limit]}
+
+STATS = {stat.name: stat for stat in (ActorStats(), MovieStats(), CastStats(), BusiestActorStats())}
+
+
+## Cache
+class StatsCache:
+    """Keeps the computed statistics of this worker and folds the change log
+    into them, so a view costs a cache lookup and a write costs an addition
+    instead of a GROUP BY over the whole table. A statistic a change cannot be
+    applied to is dropped and computed again on its next view.
+    Changes committing while a statistic is computed may be counted twice or
+    missed; recomputing every STATS_MAX_AGE seconds bounds that drift.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        # name -> (state, computed_at, offset of the last change in the state)
+        self._states = {}
+        self._generation = None
+        self._synced_at = 0
+        self.computed = 0
+        self.applied = 0
+        self.hits = 0
+
+    def sync(self):
+        # changes committed by this worker are applied at once, those of others every STATS_SYNC_INTERVAL
+        now = time.monotonic()
+        if changes.feed.generation == self._generation and now - self._synced_at < STATS_SYNC_INTERVAL:
+            return
+        if now - self._synced_at > changes.CHANGES_COMPACT_AFTER:
+            # compaction may have dropped changes that were never applied
+            self._states.clear()
+        self._generation, self._synced_at = changes.feed.generation, now
+        if not self._states:
+            return
+
+        pending = changes.fetch(min(offset for _, _, offset in self._states.values()), STATS_MAX_DELTA)
+        if len(pending) == STATS_MAX_DELTA:
+            self._states.clear()
+            return
+
+        for change in pending:
+            for name, (state, computed_at, offset) in list(self._states.items()):
+                if change.id <= offset or change.entity not in STATS[name].entities:
+                    continue
+                if STATS[name].apply(state, change):
+                    self.applied += 1
+                else:
+                    del self._states[name]
+        if pending:
+            for name, (state, computed_at, offset) in self._states.items():
+                self._states[name] = (state, computed_at, max(offset, pending[-1].id))
+
+    def get(self, name):
+        with self._lock:
+            self.sync()
+            cached = self._states.get(name)
+            if cached is not None and time.monotonic() - cached[1] < STATS_MAX_AGE:
+                self.hits += 1
+                return cached[0]
+
+            offset = db.session.query(db.func.coalesce(db.func.max(Change.id), 0)).scalar()
+            state = STATS[name].compute()
+            self._states[name] = (state, time.monotonic(), offset)
+            self.computed += 1
+            return state
+
+    def stats(self):
+        return {'computed': self.computed, 'applied': self.applied, 'hits': self.hits, 'cached': sorted(self._states)}
+
+cache = StatsCache()
+
+def render(name, **args):
+    return STATS[name].render(cache.get(name), **args)
@@ -1,12 +1,38 @@
 
 import os
+import time
+import datetime
+import asyncio
+import tempfile
 import unittest
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
 import json
+from flask import Flask, g
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, exc
 
 from app import create_app
-from models import setup_db, Movie, Actor, Token, db
-from auth import verify_decode_jwt, check_permissions
+from models import setup_db, Movie, Actor, Token, OutboxEvent, Job, JobChunk, db
+import auth
+from auth import verify_decode_jwt, verify_token, check_permissions, JWKSCache, AuthError
+from replicas import ReplicaRouter, RoutingSession, router
+from outbox import Dispatcher
+from idempotency import MemoryStore, Reply
+from ratelimit import RateLimiter, RateLimitExceeded, MemoryBackend, LoadShedder, limiter, shedder, parse_limits
+from slowlog import slow_queries, explain
+from singleflight import SingleFlight, SingleFlightTimeout
+import tracing
+import profiling
+import documents
+import snapshot
+from health import ReadinessProbe, readiness, migration_head
+import asgi
+from readmodel import ColumnTable, ReadModel
+from groupcommit import GroupCommitter, GroupCommitTimeout, PendingWrite, insert
+from schedule import IntervalTree, ScheduleIndex, index as schedule_index
+import jobs
+import audit
 
 # run tests in order of definition
 unittest.sortTestMethodsUsing = None
@@ -30,6 +56,7 @@ def get_user_access():
     
 # prompt tester for a valid JWT for provided access level to run the test
 def get_valid_jwt():
+    global unique_movie
     user_access = get_user_access()
     
     test_token = input('Please provide a valid JWT for the choosen access level: ')
@@ -136,6 +163,29 @@ class TestActors(unittest.TestCase):
             self.assertEqual(data['gender'], self.new_actor['gender'])
             self.assertEqual(data['age'], self.new_actor['age'])
 
+    def test_replay_new_actor_with_idempotency_key(self):
+        headers = dict(self.headers, **{'Idempotency-Key': f'test-{os.getpid()}'})
+        first = self.client().post('/actors', headers=headers, json=self.new_actor)
+        actor_count = len(Actor.query.all())
+        second = self.client().post('/actors', headers=headers, json=self.new_actor)
+
+        self.assertEqual(second.status_code, first.status_code)
+        if accesses['user_type'] != 'assistant':
+            self.assertEqual(json.loads(second.data), json.loads(first.data))
+            self.assertEqual(second.headers.get('Idempotent-Replayed'), 'true')
+            self.assertEqual(len(Actor.query.all()), actor_count)
+
+    def test_idempotency_keys_evicted_oldest_completed_first(self):
+        store = MemoryStore(max_keys=2)
+        self.assertIsNone(store.claim('running', 'a'))
+        self.assertIsNone(store.claim('done', 'b'))
+        store.complete('done', Reply(201, 'application/json', b'{}'))
+        self.assertIsNone(store.claim('next', 'c'))
+
+        # the running request keeps its key, a duplicate of the completed one runs again
+        self.assertEqual(list(store._entries), ['running', 'next'])
+        self.assertIsNone(store.claim('done', 'b'))
+
     def test_422_add_actor_with_missing_values(self):
         new_actor={'first_name': 'John Doe'}
         response = self.client().post('/actors', headers=self.headers, json=new_actor)
@@ -165,6 +215,49 @@ class TestActors(unittest.TestCase):
         self.assertTrue(data['total_actors'])
         self.assertEqual(data['total_actors'], actor_count)
 
+    def test_get_actors_with_sparse_fieldset(self):
+        response = self.client().get('/actors?fields=id,second_name', headers=self.headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertTrue(data['actors'])
+        self.assertTrue(all(set(actor) == {'id', 'second name'} for actor in data['actors']))
+
+    def test_sparse_actor_is_subset_of_full_actor(self):
+        actor_id = Actor.query.order_by(Actor.id).first().id
+        full = json.loads(self.client().get(f'/actors/{actor_id}', headers=self.headers).data)['actor_details']
+        response = self.client().get(f'/actors/{actor_id}?fields=first_name,second_name,age', headers=self.headers)
+        sparse = json.loads(response.data)['actor_details']
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sparse, {key: full[key] for key in ('first name', 'second name', 'age')})
+
+    def test_422_get_actors_with_unknown_field(self):
+        response = self.client().get('/actors?fields=id,password', headers=self.headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(data['success'])
+        self.assertEqual(data['message'], 'unprocessable')
+
+        # fields are named as in request bodies, not after the columns
+        response = self.client().get('/actors?fields=id,surname', headers=self.headers)
+        self.assertEqual(response.status_code, 422)
+
+    def test_get_actors_filtered(self):
+        actor = Actor.query.order_by(Actor.id).first()
+        response = self.client().get(f'/actors?gender={actor.gender}&age={actor.age}&fields=id,age,gender', headers=self.headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_actors'], Actor.query.filter_by(gender=actor.gender, age=actor.age).count())
+        self.assertIn({'id': actor.id, 'age': actor.age, 'gender': actor.gender}, data['actors'])
+        self.assertTrue(all(row['gender'] == actor.gender and row['age'] == actor.age for row in data['actors']))
+
+        response = self.client().get('/actors?age=old', headers=self.headers)
+        self.assertEqual(response.status_code, 422)
+
     def test_404_no_actors_returned_from_db(self):
         response = self.client().get('/actors?testing=True', headers=self.headers)
         data = json.loads(response.data)
@@ -228,6 +321,23 @@ class TestActors(unittest.TestCase):
             self.assertEqual(data['gender'], gender)
             self.assertEqual(data['age'], age)
 
+    def test_412_edit_actor_with_stale_version(self):
+        actor = Actor.query.order_by(db.desc(Actor.id)).first()
+        headers = dict(self.headers, **{'If-Match': f'"{actor.version - 1}"'})
+        response = self.client().patch(f'/actors/{actor.id}', headers=headers, \
+            json={'age': actor.age + 1})
+        data = json.loads(response.data)
+
+        if accesses['user_type'] == 'assistant':
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message']['code'], 'forbidden_access')
+        else:
+            self.assertEqual(response.status_code, 412)
+            self.assertFalse(data['success'])
+            self.assertEqual(data['message'], 'precondition failed')
+            self.assertEqual(Actor.query.get(actor.id).age, actor.age)
+
     def test_422_edit_actor_not_in_db(self):
         response = self.client().patch('/actors/1000', headers=self.headers, \
             json={'first_name': 'foo'})
@@ -245,6 +355,24 @@ class TestActors(unittest.TestCase):
             self.assertEqual(data['message'], 'unprocessable')
 
 
+    def test_bulk_edit_actors(self):
+        actor = Actor.query.order_by(db.desc(Actor.id)).first()
+        version = actor.version
+        response = self.client().patch('/actors/bulk', headers=self.headers, \
+            json=[{'id': actor.id, 'age': actor.age + 1}, {'id': 1000, 'age': 40}, {'id': actor.id, 'bogus': 1}])
+        data = json.loads(response.data)
+
+        if accesses['user_type'] == 'assistant':
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(data['success'], False)
+            self.assertEqual(data['message']['code'], 'forbidden_access')
+        else:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['success'], True)
+            self.assertEqual(data['updated'], 1)
+            self.assertEqual([result['status'] for result in data['results']], [200, 404, 422])
+            self.assertEqual(data['results'][0]['version'], version + 1)
+
     def test_delete_actor(self):
         actor = Actor.query.order_by(db.desc(Actor.id)).first()
         actor_id = actor.id
@@ -451,5 +579,1271 @@ class TestMovies(unittest.TestCase):
         if not user_check:
             self.assertEqual(data['message']['description'], 'Incorrect claims. Please, check the permissions.')
 
+class TestBatch(unittest.TestCase):
+    """This class represents the batch test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+
+        with self.app.app_context():
+            self.db = SQLAlchemy()
+            self.db.init_app(self.app)
+            self.db.create_all()
+
+        self.operations = [
+            {'method': 'POST', 'path': '/actors', 'ref': 'actor',
+                'body': {'first_name': 'Mark', 'second_name': 'Wahlberg', 'gender': 'Male', 'age': 49}},
+            {'method': 'POST', 'path': '/movies/1/actors', 'body': {'actor_id': {'$ref': 'actor'}}},
+        ]
+
+        self.headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+
+    def test_batch_creates_and_links_actor(self):
+        actor_count = len(Actor.query.all())
+        response = self.client().post('/batch', headers=self.headers, json={'operations': self.operations})
+        data = json.loads(response.data)
+
+        if accesses['user_type'] == 'assistant':
+            self.assertEqual(response.status_code, 403)
+            self.assertFalse(data['success'])
+            self.assertEqual(data['index'], 0)
+            self.assertEqual(data['message']['code'], 'forbidden_access')
+            self.assertEqual(len(Actor.query.all()), actor_count)
+        else:
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data['success'])
+            self.assertEqual([result['status'] for result in data['results']], [201, 201])
+            self.assertEqual(data['results'][1]['body']['actor_id'], data['results'][0]['body']['id'])
+
+    def test_batch_rolls_back_on_failure(self):
+        actor_count = len(Actor.query.all())
+        self.operations[1]['path'] = '/movies/1000/actors'
+        response = self.client().post('/batch', headers=self.headers, json={'operations': self.operations})
+        data = json.loads(response.data)
+
+        self.assertFalse(data['success'])
+        self.assertEqual(len(Actor.query.all()), actor_count)
+        if accesses['user_type'] == 'assistant':
+            self.assertEqual(response.status_code, 403)
+        else:
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(data['index'], 1)
+
+    def test_batch_commit_failure_is_structured(self):
+        # e.g. a deferred constraint, only checked when the transaction commits
+        def fail(session):
+            raise exc.IntegrityError('COMMIT', {}, Exception('deferred constraint violated'))
+        actor_count = len(Actor.query.all())
+        event.listen(RoutingSession, 'before_commit', fail)
+        try:
+            response = self.client().post('/batch', headers=self.headers, json={'operations': self.operations[:1]})
+        finally:
+            event.remove(RoutingSession, 'before_commit', fail)
+        data = json.loads(response.data)
+
+        self.assertFalse(data['success'])
+        self.assertEqual(len(Actor.query.all()), actor_count)
+        if accesses['user_type'] == 'assistant':
+            self.assertEqual(response.status_code, 403)
+        else:
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(data['message'], 'conflict')
+            self.assertIsNone(data['index'])
+
+    def test_batch_books_actor_it_creates(self):
+        # the schedule index loads in the middle of the transaction of the batch, which goes on
+        schedule_index.offset = None
+        self.operations[1]['body'].update({'shoot_start': '1800-01-01', 'shoot_end': '1800-01-10'})
+        response = self.client().post('/batch', headers=self.headers, json={'operations': self.operations})
+        data = json.loads(response.data)
+
+        if accesses['user_type'] == 'assistant':
+            self.assertEqual(response.status_code, 403)
+        else:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual([result['status'] for result in data['results']], [201, 201])
+            with self.app.app_context():
+                actor = Actor.query.get(data['results'][0]['body']['id'])
+                self.assertIsNotNone(actor)
+                self.assertEqual([(project.movie_id, project.shoot_start) for project in actor.movie],
+                                 [(1, datetime.date(1800, 1, 1))])
+                actor.delete()
+
+    def test_409_batch_bookings_overlap(self):
+        movie_ids = [movie.id for movie in Movie.query.order_by(Movie.id).limit(2)]
+        self.operations[1:] = [{'method': 'POST', 'path': f'/movies/{movie_id}/actors',
+                                'body': {'actor_id': {'$ref': 'actor'}, 'shoot_start': start, 'shoot_end': end}}
+                               for movie_id, (start, end) in zip(movie_ids, (('1800-02-01', '1800-02-10'),
+                                                                             ('1800-02-10', '1800-02-20')))]
+        actor_count = len(Actor.query.all())
+        response = self.client().post('/batch', headers=self.headers, json={'operations': self.operations})
+        data = json.loads(response.data)
+
+        self.assertFalse(data['success'])
+        self.assertEqual(len(Actor.query.all()), actor_count)
+        if accesses['user_type'] == 'assistant':
+            self.assertEqual(response.status_code, 403)
+        else:
+            self.assertEqual(response.status_code, 409)
+            self.assertEqual(data['message'], 'conflict')
+            self.assertEqual(data['index'], 2)
+
+class TestChanges(unittest.TestCase):
+    """This class represents the change feed test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+
+        with self.app.app_context():
+            self.db = SQLAlchemy()
+            self.db.init_app(self.app)
+            self.db.create_all()
+
+        self.headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+
+    def test_get_changes_after_offset(self):
+        response = self.client().get('/changes?since=0&limit=5', headers=self.headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertLessEqual(len(data['changes']), 5)
+        self.assertEqual(data['next'], data['changes'][-1]['id'] if data['changes'] else 0)
+        self.assertEqual([change['id'] for change in data['changes']], sorted(change['id'] for change in data['changes']))
+
+    def test_stream_changes_as_server_sent_events(self):
+        headers = dict(self.headers, Accept='text/event-stream')
+        response = self.client().get('/changes', headers=headers, buffered=False)
+        first_event = next(response.response)
+        response.close()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'text/event-stream')
+        self.assertIn(b'retry:', first_event)
+
+class TestReplicaRouter(unittest.TestCase):
+    """This class represents the read replica routing test case"""
+
+    def setUp(self):
+        self.router = ReplicaRouter()
+        self.router.configure('sqlite://, sqlite:////nonexistent/directory/replica.db')
+
+    def test_pick_replicas_round_robin(self):
+        picked = [self.router.pick().engine for _ in range(4)]
+
+        self.assertEqual(picked[0], picked[2])
+        self.assertEqual(picked[1], picked[3])
+        self.assertNotEqual(picked[0], picked[1])
+
+    def test_skip_failed_replica(self):
+        broken = self.router.replicas[1]
+        try:
+            broken.engine.connect()
+        except Exception as error:
+            self.router.count_error(broken.engine, error)
+
+        picked = {self.router.pick().engine for _ in range(4)}
+
+        self.assertEqual(picked, {self.router.replicas[0].engine})
+
+    def test_read_your_writes_window(self):
+        self.router.note_write('auth0|writer')
+
+        self.assertTrue(self.router.wrote_recently('auth0|writer'))
+        self.assertFalse(self.router.wrote_recently('auth0|reader'))
+
+    def test_only_commits_that_wrote_remembered(self):
+        app = create_app()
+        setup_db(app, os.environ.get('TEST_DATABASE_URL'))
+        router._writes.clear()
+        with app.test_request_context():
+            g.jwt = {'sub': 'auth0|reader'}
+            Actor.query.first()
+            db.session.commit()
+
+            self.assertFalse(router.wrote_recently('auth0|reader'))
+            self.assertIsNone(g.get('last_write'))
+
+            db.session.execute(Actor.__table__.update().where(Actor.id == -1).values(age=1))
+            db.session.commit()
+
+            self.assertTrue(router.wrote_recently('auth0|reader'))
+            self.assertIsNotNone(g.get('last_write'))
+        router._writes.clear()
+
+    def test_route_reads_and_writes_across_databases(self):
+        app = create_app()
+        setup_db(app, os.environ.get('TEST_DATABASE_URL'))
+        headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+        with tempfile.TemporaryDirectory() as directory:
+            router.configure(f'sqlite:///{directory}/replica.db')
+            replica = router.replicas[0].engine
+            db.metadata.create_all(replica)
+            replica.execute(Actor.__table__.insert(), {'firstname': 'Replica', 'surname': 'Only', 'age': 30, 'gender': 'Female'})
+            actor_id = None
+            try:
+                # forget the writes of the tests before
+                router._writes.clear()
+                client = app.test_client()
+                response = client.get('/actors', headers=headers)
+                self.assertEqual(json.loads(response.data)['total_actors'], 1)
+                # reads are no writes, the next reads still go to the replica
+                self.assertNotIn('Set-Cookie', response.headers)
+                self.assertEqual(router._writes, {})
+                if accesses['user_type'] == 'assistant':
+                    return
+
+                response = client.post('/actors', headers=headers,
+                                       json={'first_name': 'Read', 'second_name': 'Mywrites', 'age': 40, 'gender': 'Male'})
+                actor_id = json.loads(response.data)['id']
+                self.assertEqual(response.status_code, 201)
+                self.assertIn('last_write=', response.headers['Set-Cookie'])
+
+                # another worker does not know the subject wrote, the cookie tells it
+                router._writes.clear()
+                data = json.loads(client.get(f'/actors/{actor_id}?fields=id', headers=headers).data)
+                self.assertEqual(data['actor_details'], {'id': actor_id})
+
+                # a client without the cookie reads from the replica
+                queries = router.queries.get(replica, 0)
+                response = app.test_client().get(f'/actors/{actor_id}?fields=id', headers=headers)
+                self.assertEqual(response.status_code, 404)
+                self.assertGreater(router.queries.get(replica, 0), queries)
+            finally:
+                router.configure('')
+                replica.dispose()
+                if actor_id is not None:
+                    with app.app_context():
+                        Actor.query.get(actor_id).delete()
+
+class TestSlowQueries(unittest.TestCase):
+    """This class represents the slow query log test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+
+        with self.app.app_context():
+            self.db = SQLAlchemy()
+            self.db.init_app(self.app)
+            self.db.create_all()
+
+        self.headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+        self.threshold, self.explain_rate = slow_queries.threshold, slow_queries.explain_rate
+        slow_queries.threshold, slow_queries.explain_rate = 0, 1
+
+    def tearDown(self):
+        slow_queries.threshold, slow_queries.explain_rate = self.threshold, self.explain_rate
+
+    def test_get_slow_queries_of_route(self):
+        self.client().get('/actors/1', headers=self.headers)
+        response = self.client().get('/slow-queries?route=GET /actors/<int:id>&limit=5', headers=self.headers)
+        data = json.loads(response.data)
+
+        if accesses['user_type'] != 'executive':
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(data['message']['code'], 'forbidden_access')
+        else:
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(data['success'])
+            self.assertTrue(data['queries'])
+            self.assertLessEqual(len(data['queries']), 5)
+            self.assertTrue(all(query['route'] == 'GET /actors/<int:id>' for query in data['queries']))
+            self.assertTrue(any(query['plan'] for query in data['queries']))
+
+    def test_explain_leaves_transaction_of_statement(self):
+        with self.app.app_context():
+            connection = db.engine.connect()
+            transaction = connection.begin()
+            try:
+                connection.execute(Actor.__table__.insert(), {'firstname': 'Explain', 'surname': 'Savepoint', 'age': 30, 'gender': 'Female'})
+                select = "SELECT id FROM actors WHERE surname = 'Savepoint'"
+
+                self.assertTrue(explain(connection, select, ()))
+                # a failing EXPLAIN aborts no more than its savepoint
+                self.assertTrue(explain(connection, 'SELECT missing FROM actors', ()).startswith('EXPLAIN failed'))
+                self.assertEqual(len(connection.execute(select).fetchall()), 1)
+            finally:
+                transaction.rollback()
+            # releasing the savepoint did not commit the insert
+            self.assertEqual(connection.execute(select).fetchall(), [])
+            connection.close()
+
+class TestProfiling(unittest.TestCase):
+    """This class represents the request profiling test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+
+        with self.app.app_context():
+            self.db = SQLAlchemy()
+            self.db.init_app(self.app)
+            self.db.create_all()
+
+        self.headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+
+    def test_profile_request_and_list_profiles(self):
+        response = self.client().get('/actors?page=1&profile=cprofile', headers=self.headers)
+        profile_id = response.headers.get('X-Profile-Id')
+        listing = self.client().get('/profiles', headers=self.headers)
+        data = json.loads(listing.data)
+
+        if accesses['user_type'] != 'executive':
+            self.assertEqual(response.status_code, 403)
+            self.assertIsNone(profile_id)
+            self.assertEqual(listing.status_code, 403)
+        else:
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(profile_id.endswith('.prof'))
+            self.assertEqual(listing.status_code, 200)
+            self.assertIn(profile_id, [profile['name'] for profile in data['profiles']])
+
+    def test_profile_not_stored_keeps_response(self):
+        if accesses['user_type'] != 'executive':
+            return
+        def path_for(mode):
+            raise OSError('no space left on device')
+        profiling.store.path_for = path_for
+        try:
+            response = self.client().get('/actors?page=1&profile=cprofile', headers=self.headers)
+        finally:
+            del profiling.store.path_for
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-Id', response.headers)
+        # the profiler was released for the next request
+        response = self.client().get('/actors?page=1&profile=cprofile', headers=self.headers)
+        self.assertIn('X-Profile-Id', response.headers)
+
+    def test_unprofiled_request_stores_no_profile(self):
+        response = self.client().get('/actors?page=1', headers=self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('X-Profile-Id', response.headers)
+
+class TestTracing(unittest.TestCase):
+    """This class represents the tracing test case"""
+
+    def setUp(self):
+        self.app = create_app()
+
+    def test_parse_traceparent(self):
+        parent = tracing.parse_traceparent('00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01')
+
+        self.assertEqual(parent, ('0af7651916cd43dd8448eb211c80319c', 'b7ad6b7169203331', True))
+        self.assertIsNone(tracing.parse_traceparent('00-not-a-trace-01'))
+        self.assertIsNone(tracing.parse_traceparent(None))
+
+    def test_nested_spans(self):
+        with self.app.test_request_context('/actors'):
+            trace = tracing.g.trace = tracing.Trace(parent_id='b7ad6b7169203331')
+            with tracing.span('outer') as outer:
+                with tracing.span('inner'):
+                    pass
+            spans = [span.encode() for span in trace.spans]
+
+        self.assertEqual([span['name'] for span in spans], ['inner', 'outer'])
+        self.assertEqual(spans[0]['parentSpanId'], outer.span_id)
+        self.assertEqual(spans[1]['parentSpanId'], 'b7ad6b7169203331')
+        self.assertEqual({span['traceId'] for span in spans}, {trace.trace_id})
+
+    def test_no_span_outside_sampled_request(self):
+        with self.app.test_request_context('/actors'):
+            self.assertIs(tracing.span('unsampled'), tracing.NO_SPAN)
+
+class TestDocuments(unittest.TestCase):
+    """This class represents the stored actor and movie documents test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+
+        with self.app.app_context():
+            self.db = SQLAlchemy()
+            self.db.init_app(self.app)
+            self.db.create_all()
+            list(documents.rebuild_all())
+
+        self.headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+
+    def test_get_actor_from_document(self):
+        actor = Actor.query.order_by(Actor.id).first()
+        response = self.client().get(f'/actors/{actor.id}', headers=self.headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, documents.fetch('actor', actor.id).body)
+        self.assertEqual(data['actor_details']['id'], actor.id)
+        self.assertEqual(data['movie_count'], len(data['movies']))
+
+    def test_document_follows_movie_edit(self):
+        movie = Movie.query.order_by(db.desc(Movie.id)).first()
+        movie_id, title = movie.id, movie.title
+        response = self.client().patch(f'/movies/{movie_id}', headers=self.headers, json={'title': title + ' Redux'})
+        data = json.loads(self.client().get(f'/movies/{movie_id}', headers=self.headers).data)
+
+        if accesses['user_type'] == 'assistant':
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(data['movie_details']['title'], title)
+        else:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['movie_details']['title'], title + ' Redux')
+            self.client().patch(f'/movies/{movie_id}', headers=self.headers, json={'title': title})
+
+class TestStats(unittest.TestCase):
+    """This class represents the roster statistics test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+
+        with self.app.app_context():
+            self.db = SQLAlchemy()
+            self.db.init_app(self.app)
+            self.db.create_all()
+
+        self.headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+
+    def test_get_actor_stats(self):
+        response = self.client().get('/stats/actors', headers=self.headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(data['success'])
+        self.assertEqual(data['total'], Actor.query.count())
+        self.assertEqual(sum(gender['count'] for gender in data['genders']), data['total'])
+
+    def test_get_cast_stats(self):
+        response = self.client().get('/stats/cast', headers=self.headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['movies'], Movie.query.count())
+
+    def test_422_get_busiest_actors_with_invalid_limit(self):
+        response = self.client().get('/stats/busiest-actors?limit=0', headers=self.headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertFalse(data['success'])
+
+class TestHealth(unittest.TestCase):
+    """This class represents the health and readiness test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+
+    def test_healthz(self):
+        response = self.client().get('/healthz')
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['status'], 'ok')
+
+    def test_healthz_ok_while_unready_and_shedding(self):
+        result, slots = readiness._result, shedder._slots
+        readiness._result = (False, {'database': {'ok': False}}, time.time())
+        shedder._slots = threading.BoundedSemaphore(1)
+        shedder._slots.acquire()
+        try:
+            response = self.client().get('/healthz')
+            ready = self.client().get('/readyz')
+        finally:
+            readiness._result, shedder._slots = result, slots
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(json.loads(response.data)['status'], 'ok')
+        # probes are never shed, readiness answers its last result
+        self.assertEqual(ready.status_code, 503)
+        self.assertEqual(json.loads(ready.data)['checks'], {'database': {'ok': False}})
+
+    def readyz(self, app):
+        # without a first request, which would start the background threads of the process on this app
+        with app.test_request_context('/readyz'):
+            return app.view_functions['readyz']()
+
+    def test_readyz_follows_migrations(self):
+        head = migration_head()[0]
+        result = readiness._result
+        with tempfile.TemporaryDirectory() as directory:
+            # a schema made by create_all, without the alembic version of a migrated one
+            app = create_app()
+            setup_db(app, f'sqlite:///{directory}/health.db')
+            with app.app_context():
+                db.create_all()
+            try:
+                readiness._result = None
+                response, status = self.readyz(app)
+                data = json.loads(response.data)
+
+                self.assertEqual(status, 503)
+                self.assertEqual(data['status'], 'unready')
+                self.assertTrue(data['checks']['database']['ok'])
+                self.assertEqual(data['checks']['migrations'], {'ok': False, 'current': None, 'head': head})
+                self.assertEqual(set(data['checks']), {'database', 'migrations', 'jwks', 'replicas'})
+
+                with app.app_context():
+                    db.engine.execute('CREATE TABLE alembic_version (version_num VARCHAR(32) NOT NULL)')
+                    db.engine.execute('INSERT INTO alembic_version VALUES (?)', head)
+                    db.engine.dispose()
+                readiness._result = None
+                response, status = self.readyz(app)
+                data = json.loads(response.data)
+
+                self.assertEqual(status, 200)
+                self.assertEqual(data['status'], 'ready')
+                self.assertEqual(data['checks']['migrations'], {'ok': True, 'current': head, 'head': head})
+            finally:
+                readiness._result = result
+                with app.app_context():
+                    db.engine.dispose()
+
+    def test_readiness_probe_reuses_result(self):
+        runs = []
+        probe = ReadinessProbe(max_age=60)
+        probe.run = lambda: runs.append(1) or (True, {'runs': len(runs)})
+
+        first = probe.check()
+        self.assertIs(probe.check(), first)
+        self.assertEqual((probe.checks, probe.cached, len(runs)), (1, 1, 1))
+
+        # a probe arriving while another one checks gets the last result without waiting
+        probe.max_age = 0
+        with probe._lock:
+            self.assertIs(probe.check(), first)
+        self.assertEqual(len(runs), 1)
+
+        second = probe.check()
+        self.assertEqual(second[1], {'runs': 2})
+        self.assertEqual((probe.checks, probe.cached), (2, 2))
+
+class TestSnapshot(unittest.TestCase):
+    """This class represents the read-only snapshot node test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'snapshot.db')
+
+        with self.app.app_context():
+            self.counts = snapshot.export(self.path)
+
+        os.environ['SNAPSHOT_PATH'] = self.path
+        try:
+            self.client = create_app().test_client
+        finally:
+            del os.environ['SNAPSHOT_PATH']
+
+        self.headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_read_from_snapshot(self):
+        response = self.client().get('/actors', headers=self.headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['total_actors'], self.counts['actors'])
+
+    def test_writes_disabled(self):
+        response = self.client().post('/actors', headers=self.headers, json={'first_name': 'Read', 'last_name': 'Only', 'age': 40, 'gender': 'Female'})
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 405)
+        self.assertEqual(data['success'], False)
+
+class TestAsgi(unittest.TestCase):
+    """This class represents the ASGI read endpoints test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+        asgi.database = asgi.Database(self.database_path)
+
+        self.headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+
+    def tearDown(self):
+        asyncio.run(asgi.database.dispose())
+        asgi.database = None
+
+    def get(self, path, query=''):
+        sent = []
+        async def receive():
+            return {'type': 'http.request', 'body': b''}
+        async def send(message):
+            sent.append(message)
+        scope = {'type': 'http', 'method': 'GET', 'path': path, 'query_string': query.encode(),
+                 'headers': [(name.lower().encode(), value.encode()) for name, value in self.headers.items()]}
+        asyncio.run(asgi.app(scope, receive, send))
+        return sent[0]['status'], dict(sent[0]['headers']), sent[1]['body']
+
+    def test_same_responses_as_flask(self):
+        movie_id = Movie.query.order_by(Movie.id).first().id
+        for path, query in (('/actors', ''), ('/actors', 'fields=id,second_name&sort=-second_name'), ('/movies', 'page=0'),
+                            ('/actors', 'gender=Female&sort=age'),
+                            (f'/movies/{movie_id}', ''), (f'/movies/{movie_id}', 'fields=title'), ('/actors/0', '')):
+            status, headers, body = self.get(path, query)
+            response = self.client().get(f'{path}?{query}', headers=self.headers)
+
+            self.assertEqual(status, response.status_code)
+            self.assertEqual(body, response.data)
+            self.assertEqual(headers.get(b'etag', b'').decode(), response.headers.get('ETag', ''))
+
+    def test_only_reads_served(self):
+        status, headers, body = self.get('/changes')
+
+        self.assertEqual(status, 404)
+        self.assertEqual(json.loads(body)['success'], False)
+
+class TestReadModel(unittest.TestCase):
+    """This class represents the columnar read model test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+
+    def test_columns_upsert_delete_and_sort(self):
+        table = ColumnTable(Actor)
+        for id, age in ((3, 40), (1, 30), (2, 40)):
+            table.upsert({'id': id, 'firstname': 'First', 'surname': f'Surname{id}', 'age': age, 'gender': 'Female', 'version': 1})
+        table.upsert({'id': 1, 'firstname': 'First', 'surname': 'Surname1', 'age': 50, 'gender': 'Female', 'version': 2})
+        table.delete(3)
+
+        self.assertEqual(len(table), 2)
+        self.assertEqual([row.id for row in table.page(0, 5)[1]], [1, 2])
+        self.assertEqual([row.age for row in table.page(0, 5, ('age', True))[1]], [50, 40])
+        self.assertEqual(table.page(0, 1)[1][0].version, 2)
+
+    def test_orders_kept_through_writes(self):
+        table = ColumnTable(Actor)
+        for id in range(1, 21):
+            table.upsert({'id': id, 'firstname': 'First', 'surname': f'Surname{id % 7}', 'age': id % 5, 'gender': 'Female', 'version': 1})
+        for key in (('age', False), ('age', True), ('surname', False)):
+            table.order(*key)
+        for id, age in ((4, 9), (25, 2), (11, 0), (7, 2)):
+            table.upsert({'id': id, 'firstname': 'First', 'surname': 'Surname9', 'age': age, 'gender': 'Female', 'version': 2})
+        table.delete(13)
+        table.delete(2)
+
+        for key in (('age', False), ('age', True), ('surname', False)):
+            kept = list(table.orders.pop(key))
+            self.assertEqual(kept, list(table.order(*key)))
+
+    def test_filters(self):
+        table = ColumnTable(Actor)
+        for id, age, gender in ((1, 30, 'Female'), (2, 40, 'Male'), (3, 50, 'Female'), (4, 30, 'Female')):
+            table.upsert({'id': id, 'firstname': 'First', 'surname': f'Surname{id}', 'age': age, 'gender': gender, 'version': 1})
+
+        total, rows = table.page(0, 5, filters=(('gender', 'Female'),))
+        self.assertEqual((total, [row.id for row in rows]), (3, [1, 3, 4]))
+        total, rows = table.page(1, 1, ('age', True), (('gender', 'Female'),))
+        self.assertEqual((total, [row.id for row in rows]), (3, [1]))
+        total, rows = table.page(0, 5, filters=(('gender', 'Female'), ('age', 30)))
+        self.assertEqual((total, [row.id for row in rows]), (2, [1, 4]))
+
+    def test_pages_match_database(self):
+        with self.app.app_context():
+            total, movies = ReadModel().page('movies', 0, 5, ('title', False))
+            expected = Movie.query.order_by(Movie.title, Movie.id).limit(5).all()
+
+            self.assertEqual(total, Movie.query.count())
+            self.assertEqual([Movie.format(movie) for movie in movies], [movie.format() for movie in expected])
+
+class TestGroupCommit(unittest.TestCase):
+    """This class represents the group commit test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+        self.committer = GroupCommitter(self.app, window=0.2, max_items=4)
+        self.committer.thread.start()
+
+    def submit_all(self, writes):
+        results = [None] * len(writes)
+        def submit(index):
+            try:
+                results[index] = self.committer.submit(writes[index]).result
+            except Exception as error:
+                results[index] = error
+        threads = [threading.Thread(target=submit, args=(index,)) for index in range(len(writes))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def test_concurrent_writes_share_commits(self):
+        results = self.submit_all([insert(Actor, firstname='Group', surname=f'Commit{index}', age=30, gender='Female')
+                                   for index in range(4)])
+
+        self.assertEqual(len({result.id for result in results}), 4)
+        self.assertEqual(self.committer.stats()['groups'], 1)
+        with self.app.app_context():
+            for result in results:
+                Actor.query.get(result.id).delete()
+
+    def test_failing_write_does_not_fail_its_group(self):
+        with self.app.app_context():
+            title = Movie.query.first().title
+        results = self.submit_all([insert(Movie, title=title, release_date=datetime.date(2000, 1, 1)),
+                                   insert(Actor, firstname='Group', surname='Survivor', age=30, gender='Male')])
+
+        self.assertIsInstance(results[0], Exception)
+        self.assertEqual(results[1].surname, 'Survivor')
+        with self.app.app_context():
+            Actor.query.get(results[1].id).delete()
+
+    def test_waiting_write_times_out(self):
+        committer, release = GroupCommitter(self.app, window=0, timeout=0.05), threading.Event()
+        committer.thread.start()
+        try:
+            with self.assertRaises(GroupCommitTimeout):
+                committer.submit(lambda: release.wait(5))
+        finally:
+            release.set()
+        self.assertEqual(committer.stats()['timeouts'], 1)
+        self.assertTrue(committer.submit(lambda: True).result)
+
+    def test_failed_group_wakes_its_writes(self):
+        # an app without a database fails outside of the writes
+        pending = PendingWrite(lambda: 1 / 0)
+        with self.assertRaises(Exception):
+            GroupCommitter(Flask(__name__)).commit([pending])
+
+        self.assertTrue(pending.done.is_set())
+        self.assertIsNotNone(pending.error)
+
+    def test_interrupted_group_keeps_settled_writes(self):
+        class Interrupted(BaseException):
+            pass
+        calls = []
+        def interrupted():
+            # fails the group, then interrupts its retry
+            calls.append(1)
+            raise ValueError() if len(calls) == 1 else Interrupted()
+
+        settled, interrupting = PendingWrite(lambda: None), PendingWrite(interrupted)
+        with self.assertRaises(Interrupted):
+            GroupCommitter(self.app).commit([settled, interrupting])
+
+        self.assertIsNone(settled.error)
+        self.assertIsNone(settled.result)
+        self.assertIsInstance(interrupting.error, Interrupted)
+
+class TestSchedule(unittest.TestCase):
+    """This class represents the shoot schedule test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+
+        self.headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+
+    def test_interval_tree_overlaps(self):
+        intervals = [(start, start + length, index) for index, (start, length) in
+                     enumerate(((11, 3), (2, 0), (7, 9), (20, 1), (0, 4), (15, 2), (9, 1)))]
+        tree = IntervalTree(intervals)
+        for start, end in ((0, 0), (5, 6), (8, 12), (17, 19), (22, 30), (0, 30)):
+            expected = sorted(value for low, high, value in intervals if low <= end and high >= start)
+            self.assertEqual(sorted(tree.overlapping(start, end)), expected)
+
+    def test_conflicts_and_available(self):
+        with self.app.app_context():
+            index = ScheduleIndex()
+            index.load()
+            actor_id = min(index.actors)
+            index.book(actor_id, 0, datetime.date(1900, 1, 10), datetime.date(1900, 1, 20))
+
+            self.assertEqual(index.conflicts(actor_id, datetime.date(1900, 1, 20), datetime.date(1900, 2, 1)), [0])
+            self.assertEqual(index.conflicts(actor_id, datetime.date(1900, 1, 21), datetime.date(1900, 2, 1)), [])
+            total, actors = index.available(datetime.date(1900, 1, 1), datetime.date(1900, 1, 10))
+            self.assertEqual(total, Actor.query.count() - 1)
+            self.assertNotIn(actor_id, [id for id, name in actors])
+
+    def test_409_booking_overlaps(self):
+        movie_ids = [movie.id for movie in Movie.query.order_by(Movie.id).limit(2)]
+        with self.app.app_context():
+            actor = Actor(firstname='Double', surname='Booked', age=40, gender='Female')
+            actor.add()
+            actor_id = actor.id
+        try:
+            first = self.client().post(f'/movies/{movie_ids[0]}/actors', headers=self.headers,
+                                       json={'actor_id': actor_id, 'shoot_start': '1800-03-01', 'shoot_end': '1800-03-10'})
+            second = self.client().post(f'/movies/{movie_ids[1]}/actors', headers=self.headers,
+                                        json={'actor_id': actor_id, 'shoot_start': '1800-03-10', 'shoot_end': '1800-03-12'})
+            data = json.loads(second.data)
+
+            if accesses['user_type'] == 'assistant':
+                self.assertEqual(first.status_code, 403)
+                self.assertEqual(second.status_code, 403)
+            else:
+                self.assertEqual(first.status_code, 201)
+                self.assertEqual(second.status_code, 409)
+                self.assertEqual(data['message'], 'conflict')
+                self.assertEqual([project.movie_id for project in Actor.query.get(actor_id).movie], movie_ids[:1])
+        finally:
+            with self.app.app_context():
+                Actor.query.get(actor_id).delete()
+
+    def test_bookings_of_actor_wait_for_each_other(self):
+        index, order = ScheduleIndex(), []
+        def book():
+            with index.booking([7, 3]):
+                order.append('second')
+
+        with index.booking([7]):
+            thread = threading.Thread(target=book)
+            thread.start()
+            time.sleep(0.1)
+            order.append('first')
+        thread.join()
+
+        self.assertEqual(order, ['first', 'second'])
+
+    def test_available_actors(self):
+        response = self.client().get('/actors/available?from=1900-01-01&to=1900-01-31', headers=self.headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['success'], True)
+        self.assertEqual(data['total_available'], Actor.query.count())
+        self.assertTrue(len(data['actors']) <= 5)
+
+    def test_422_available_actors_without_period(self):
+        response = self.client().get('/actors/available?from=1900-01-31&to=1900-01-01', headers=self.headers)
+        data = json.loads(response.data)
+
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(data['success'], False)
+
+class TestJobs(unittest.TestCase):
+    """This class represents the background jobs test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+        self.runner = jobs.JobRunner(self.app, processes=2)
+        self.chunk_size, jobs.JOBS_CHUNK_SIZE = jobs.JOBS_CHUNK_SIZE, 2
+
+        self.headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+        self.rows = [{'first_name': 'Job', 'second_name': f'Import{index}', 'gender': 'female', 'age': 30}
+                     for index in range(5)]
+
+    def tearDown(self):
+        jobs.JOBS_CHUNK_SIZE = self.chunk_size
+        self.runner.shutdown()
+
+    def test_import_runs_in_chunks(self):
+        with self.app.app_context():
+            job_id = jobs.create('import-actors', {'rows': self.rows}).id
+        self.assertEqual(self.runner.run_once(), job_id)
+
+        with self.app.app_context():
+            job = Job.query.get(job_id).format(jobs.progress(job_id))
+            self.assertEqual(job['status'], 'succeeded')
+            self.assertEqual(job['progress'], {'done': 3, 'total': 3, 'percent': 100.0})
+            self.assertEqual(job['result']['created'], 5)
+            for id in job['result']['ids']:
+                Actor.query.get(id).delete()
+
+    def test_resume_skips_done_chunks(self):
+        with self.app.app_context():
+            job = jobs.create('import-actors', {'rows': self.rows[:4]})
+            job_id, job.status, job.owner = job.id, 'running', 'stopped:1'
+            job.lease_until = datetime.datetime.utcnow() - datetime.timedelta(seconds=1)
+            db.session.add(JobChunk(job_id=job_id, chunk=0, result=json.dumps({'created': 2, 'ids': []})))
+            db.session.commit()
+            actors = Actor.query.count()
+        self.runner.run_once()
+
+        with self.app.app_context():
+            job = Job.query.get(job_id)
+            self.assertEqual(job.status, 'succeeded')
+            self.assertEqual(json.loads(job.result)['created'], 4)
+            self.assertEqual(Actor.query.count(), actors + 2)
+            for id in json.loads(job.result)['ids']:
+                Actor.query.get(id).delete()
+
+    def test_create_and_cancel_job(self):
+        response = self.client().post('/jobs', headers=self.headers, json={'kind': 'rebuild-documents'})
+        data = json.loads(response.data)
+
+        if accesses['user_type'] != 'executive':
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(data['message']['code'], 'forbidden_access')
+        else:
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(data['job']['status'], 'queued')
+            response = self.client().post(f"/jobs/{data['job']['id']}/cancel", headers=self.headers)
+            self.assertEqual(json.loads(response.data)['job']['status'], 'cancelled')
+            response = self.client().get(f"/jobs/{data['job']['id']}", headers=self.headers)
+            self.assertEqual(json.loads(response.data)['job']['status'], 'cancelled')
+
+    def test_422_create_job_of_unknown_kind(self):
+        response = self.client().post('/jobs', headers=self.headers, json={'kind': 'defragment'})
+
+        self.assertEqual(response.status_code, 422 if accesses['user_type'] == 'executive' else 403)
+
+class TestRateLimit(unittest.TestCase):
+    """This class represents the rate limiting and load shedding test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+
+        self.headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+
+    def test_burst_per_permission_tier(self):
+        limiter = RateLimiter('assistant=0.01/2,director=0.01/3,executive=0.01/5')
+        tiers = {'assistant': ['get:actors', 'get:movies'],
+                 'director': ['get:actors', 'post:actors'],
+                 'executive': ['post:actors', 'delete:movies']}
+        for tier, permissions in tiers.items():
+            payload = {'sub': f'test|{tier}', 'permissions': permissions}
+            allowed = 0
+            with self.assertRaises(RateLimitExceeded) as raised:
+                while True:
+                    limiter.check(payload)
+                    allowed += 1
+            self.assertEqual(allowed, limiter.tiers[tier][1])
+            self.assertEqual(raised.exception.status_code, 429)
+            self.assertGreater(raised.exception.retry_after, 50)
+
+    def test_bucket_refills(self):
+        backend = MemoryBackend()
+        self.assertEqual(backend.take('test|refill', 50, 1), 0)
+        wait = backend.take('test|refill', 50, 1)
+        self.assertTrue(0 < wait <= 0.02)
+        time.sleep(wait + 0.005)
+        self.assertEqual(backend.take('test|refill', 50, 1), 0)
+
+    def test_prune_full_buckets_every_n_takes(self):
+        backend = MemoryBackend(max_keys=2, prune_every=4)
+        for key in ('test|a', 'test|b', 'test|c'):
+            backend.take(key, 1000, 1)
+        time.sleep(0.01)
+        self.assertEqual(len(backend._buckets), 3)
+
+        # the fourth take finds every bucket full again and drops them
+        backend.take('test|d', 1000, 1)
+        self.assertEqual(set(backend._buckets), {'test|d'})
+
+    def test_401_token_without_subject(self):
+        decode = auth.verify_decode_jwt
+        auth.verify_decode_jwt = lambda token: {'permissions': ['get:actors']}
+        try:
+            with self.assertRaises(AuthError) as raised:
+                verify_token('token')
+        finally:
+            auth.verify_decode_jwt = decode
+
+        self.assertEqual(raised.exception.status_code, 401)
+        self.assertEqual(raised.exception.error['code'], 'invalid_claims')
+
+    def test_429_with_retry_after(self):
+        # a fresh backend, so the buckets the other tests use stay as they are
+        backend, tiers = limiter.backend, limiter.tiers
+        limiter.backend, limiter.tiers = MemoryBackend(), parse_limits('assistant=0.5/1,director=0.5/1,executive=0.5/1')
+        try:
+            responses = [self.client().get('/actors', headers=self.headers) for _ in range(2)]
+        finally:
+            limiter.backend, limiter.tiers = backend, tiers
+
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(responses[1].status_code, 429)
+        self.assertEqual(json.loads(responses[1].data)['message'], 'too many requests')
+        self.assertEqual(responses[1].headers['Retry-After'], '2')
+
+    def test_503_beyond_max_in_flight(self):
+        self.assertFalse(LoadShedder(0).enter())
+        max_in_flight, slots = shedder.max_in_flight, shedder._slots
+        shedder.max_in_flight, shedder._slots = 1, threading.BoundedSemaphore(1)
+        try:
+            # the one slot is held by a request still in flight
+            self.assertTrue(shedder.enter())
+            response = self.client().get('/actors', headers=self.headers)
+            shedder.leave()
+            self.assertEqual(self.client().get('/actors', headers=self.headers).status_code, 200)
+        finally:
+            shedder.max_in_flight, shedder._slots = max_in_flight, slots
+
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(json.loads(response.data)['message'], 'service unavailable')
+        self.assertEqual(response.headers['Retry-After'], '1')
+
+class TestSingleFlight(unittest.TestCase):
+    """This class represents the single-flight test case"""
+
+    def concurrently(self, flight, compute, callers=8):
+        outcomes = [None] * callers
+        started = threading.Barrier(callers)
+
+        def call(index):
+            started.wait()
+            try:
+                outcomes[index] = flight.do('key', compute)
+            except Exception as error:
+                outcomes[index] = error
+
+        threads = [threading.Thread(target=call, args=(index,)) for index in range(callers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return outcomes
+
+    def test_concurrent_callers_share_one_result(self):
+        flight, runs = SingleFlight(timeout=5), []
+
+        def compute():
+            runs.append(1)
+            time.sleep(0.2)
+            return {'count': 1}
+
+        outcomes = self.concurrently(flight, compute)
+        self.assertEqual(len(runs), 1)
+        self.assertTrue(all(outcome is outcomes[0] for outcome in outcomes))
+        self.assertEqual(flight.stats(), {'leaders': 1, 'coalesced': 7, 'timeouts': 0, 'errors': 0, 'in_flight': 0})
+
+    def test_concurrent_callers_share_one_exception(self):
+        flight, runs = SingleFlight(timeout=5), []
+
+        def compute():
+            runs.append(1)
+            time.sleep(0.2)
+            raise ValueError('failed')
+
+        outcomes = self.concurrently(flight, compute)
+        self.assertEqual(len(runs), 1)
+        self.assertTrue(all(isinstance(outcome, ValueError) for outcome in outcomes))
+        self.assertEqual(flight.stats()['errors'], 1)
+
+        # nothing is kept once the computation finished
+        self.assertEqual(flight.do('key', lambda: 2), 2)
+
+    def test_waiter_times_out(self):
+        flight, release = SingleFlight(timeout=0.05), threading.Event()
+        leader = threading.Thread(target=flight.do, args=('key', release.wait))
+        leader.start()
+        while not flight.stats()['in_flight']:
+            time.sleep(0.01)
+        try:
+            with self.assertRaises(SingleFlightTimeout):
+                flight.do('key', lambda: None)
+        finally:
+            release.set()
+            leader.join()
+        self.assertEqual(flight.stats()['timeouts'], 1)
+
+class TestJWKSCache(unittest.TestCase):
+    """This class represents the JWKS cache test case"""
+
+    def setUp(self):
+        self.cache = JWKSCache(max_age=3600)
+        self.fetches = 0
+        def fetch():
+            self.fetches += 1
+            self.cache.keys, self.cache.fetched_at = [{'kid': 'current'}], time.monotonic()
+        self.cache.fetch = fetch
+
+    def fetched_ago(self, seconds):
+        self.cache.fetched_at = time.monotonic() - seconds
+
+    def test_reuse_keys_until_stale(self):
+        self.cache.get('current')
+        self.fetched_ago(10)
+        self.cache.get('current')
+        self.assertEqual(self.fetches, 1)
+
+        self.fetched_ago(3601)
+        self.cache.get('current')
+        self.assertEqual(self.fetches, 2)
+
+    def test_refetch_for_unknown_key_at_most_every_minute(self):
+        self.cache.get('current')
+        self.fetched_ago(10)
+        self.cache.get('rotated')
+        self.assertEqual(self.fetches, 1)
+
+        self.fetched_ago(61)
+        self.cache.get('rotated')
+        self.assertEqual(self.fetches, 2)
+
+class TestAudit(unittest.TestCase):
+    """This class represents the audit log test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+
+        self.headers = {
+            'Content-Type': 'application/json', 
+            'Authorization': token
+        }
+
+    def event(self, occurred_at):
+        return {'occurred_at': occurred_at, 'sub': 'test|audit', 'entity': 'actors', 'entity_key': '0',
+                'op': 'update', 'data': '{}'}
+
+    def test_write_is_audited_with_sub(self):
+        started = datetime.datetime.utcnow()
+        with self.app.test_request_context():
+            g.jwt = {'sub': 'test|writer'}
+            actor = Actor(firstname='Audited', surname='Actor', age=40, gender='Male')
+            actor.add()
+            audit.flush()
+            events = audit.query(entity='actors', key=str(actor.id), sub='test|writer', since=started)
+            actor.delete()
+
+        self.assertEqual([event['op'] for event in events], ['create'])
+        self.assertEqual(events[0]['data']['surname'], 'Actor')
+
+    def test_flush_and_drop_partitions(self):
+        log = audit.AuditLog(self.app)
+        log.add([self.event(datetime.datetime(2001, 1, 15)), self.event(datetime.datetime(2001, 2, 3))])
+        self.assertEqual(log.stats()['buffered'], 2)
+        self.assertEqual(log.flush(), 2)
+
+        with self.app.app_context():
+            events = audit.query(sub='test|audit', until=datetime.datetime(2001, 3, 1))
+            self.assertEqual([event['occurred_at'][:10] for event in events], ['2001-02-03', '2001-01-15'])
+            self.assertEqual(len(audit.query(sub='test|audit', since=datetime.datetime(2001, 2, 1))), 1)
+
+            retention = datetime.timedelta(days=audit.AUDIT_RETENTION_DAYS)
+            self.assertEqual(audit.drop_expired(db.engine, datetime.datetime(2001, 2, 15) + retention), ['audit_2001_01'])
+            self.assertEqual(audit.drop_expired(db.engine, datetime.datetime(2001, 3, 15) + retention), ['audit_2001_02'])
+
+    def test_audit_log(self):
+        response = self.client().get('/audit?sub=test|nobody&limit=5', headers=self.headers)
+        data = json.loads(response.data)
+
+        if accesses['user_type'] != 'executive':
+            self.assertEqual(response.status_code, 403)
+            self.assertEqual(data['message']['code'], 'forbidden_access')
+        else:
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(data['events'], [])
+
+class TestOutbox(unittest.TestCase):
+    """This class represents the webhook outbox test case"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.database_path = os.environ.get('TEST_DATABASE_URL')
+        setup_db(self.app, self.database_path)
+
+        with self.app.app_context():
+            self.db = SQLAlchemy()
+            self.db.init_app(self.app)
+            self.db.create_all()
+
+        # a local endpoint standing in for a webhook receiver
+        self.received = []
+        received = self.received
+        class Receiver(BaseHTTPRequestHandler):
+            def do_POST(self):
+                received.append(json.loads(self.rfile.read(int(self.headers['Content-Length']))))
+                self.send_response(204)
+                self.end_headers()
+            def log_message(self, *args):
+                pass
+        self.server = HTTPServer(('127.0.0.1', 0), Receiver)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.endpoint = f'http://127.0.0.1:{self.server.server_port}/hooks'
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        with self.app.app_context():
+            OutboxEvent.query.filter(OutboxEvent.endpoint == self.endpoint).delete()
+            db.session.commit()
+
+    def test_deliver_outbox_events_in_a_batch(self):
+        with self.app.app_context():
+            for actor_id in (1, 2):
+                payload = json.dumps({'id': f'test-{actor_id}', 'type': 'cast.added', 'movie_id': 1, 'actor_id': actor_id})
+                db.session.add(OutboxEvent(endpoint=self.endpoint, event_type='cast.added', payload=payload))
+            db.session.commit()
+
+        dispatcher = Dispatcher(self.app, threads=1)
+        for future in dispatcher.run_once():
+            future.result()
+
+        with self.app.app_context():
+            statuses = [e.status for e in OutboxEvent.query.filter(OutboxEvent.endpoint == self.endpoint)]
+
+        self.assertEqual(len(self.received), 1)
+        self.assertEqual([event['id'] for event in self.received[0]['events']], ['test-1', 'test-2'])
+        self.assertEqual(statuses, ['delivered', 'delivered'])
+
 if __name__ == "__main__":
     unittest.main()
\ No newline at end of file
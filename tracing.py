@@ -0,0 +1,283 @@
+import os
+import json
+import time
+import queue
+import random
+import threading
+from functools import wraps
+from urllib.request import Request, urlopen
+from flask import request, g, has_request_context, json as flask_json
+from flask.templating import Environment
+from jinja2 import Template
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# where sampled traces go: '' disables tracing, 'file' appends OTLP JSON lines, 'otlp' posts to a collector
+TRACE_EXPORTER = os.environ.get('TRACE_EXPORTER', '')
+TRACE_FILE = os.environ.get('TRACE_FILE', 'traces.jsonl')
+TRACE_OTLP_ENDPOINT = os.environ.get('TRACE_OTLP_ENDPOINT', 'http://localhost:4318/v1/traces')
+# share of requests traced when the caller sent no sampling decision in a traceparent header
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', 0.01))
+TRACE_SERVICE_NAME = os.environ.get('TRACE_SERVICE_NAME', 'casting-agency')
+# traces waiting for export before new ones are dropped
+TRACE_QUEUE_SIZE = 1000
+TRACE_EXPORT_INTERVAL = 5
+
+# OTLP span kinds and status codes
+INTERNAL, SERVER, CLIENT = 1, 2, 3
+STATUS_ERROR = 2
+
+
+## Spans
+class Span:
+    """A span of the current trace, recorded in the OTLP JSON encoding
+    """
+    def __init__(self, trace, name, kind, attributes):
+        self.trace = trace
+        self.name = name
+        self.kind = kind
+        self.attributes = attributes
+        self.span_id = random.getrandbits(64).to_bytes(8, 'big').hex()
+        self.parent_id = trace.stack[-1].span_id if trace.stack else trace.parent_id
+        self.start = time.time_ns()
+        self.end = None
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def __enter__(self):
+        self.trace.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.finish(exc_value)
+
+    def finish(self, error=None):
+        self.end = time.time_ns()
+        if error is not None:
+            self.error = f'{error.__class__.__name__}: {error}'
+        if self.trace.stack and self.trace.stack[-1] is self:
+            self.trace.stack.pop()
+        self.trace.spans.append(self)
+
+    def encode(self):
+        span = {
+            'traceId': self.trace.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': self.kind,
+            'startTimeUnixNano': str(self.start),
+            'endTimeUnixNano': str(self.end),
+            'attributes': [{'key': key, 'value': encode_value(value)} for key, value in self.attributes.items()]
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        if self.error:
+            span['status'] = {'code': STATUS_ERROR, 'message': self.error}
+        return span
+
+class _NoSpan:
+    def set(self, key, value):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+NO_SPAN = _NoSpan()
+
+def encode_value(value):
+    if isinstance(value, bool):
+        return {'boolValue': value}
+    if isinstance(value, int):
+        return {'intValue': str(value)}
+    if isinstance(value, float):
+        return {'doubleValue': value}
+    return {'stringValue': str(value)}
+
+class Trace:
+    def __init__(self, trace_id=None, parent_id=None):
+        self.trace_id = trace_id or random.getrandbits(128).to_bytes(16, 'big').hex()
+        self.parent_id = parent_id
+        self.stack = []
+        self.spans = []
+
+def current_trace():
+    return g.get('trace') if has_request_context() else None
+
+def span(name, kind=INTERNAL, **attributes):
+    """Opens a child span of the current span, or does nothing when the
+    request is not sampled
+    """
+    trace = current_trace()
+    if trace is None:
+        return NO_SPAN
+    return Span(trace, name, kind, attributes)
+
+def traced(name):
+    def traced_decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return f(*args, **kwargs)
+        return wrapper
+    return traced_decorator
+
+
+## Exporters
+class Exporter:
+    """Sends finished traces in OTLP JSON batches from a background thread,
+    dropping traces when the queue is full rather than slowing requests down
+    """
+    def __init__(self, kind=TRACE_EXPORTER, path=TRACE_FILE, endpoint=TRACE_OTLP_ENDPOINT):
+        self.kind = kind
+        self.path = path
+        self.endpoint = endpoint
+        self._queue = queue.Queue(TRACE_QUEUE_SIZE)
+        self._thread = None
+        self._lock = threading.Lock()
+        self.exported = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def submit(self, spans):
+        # started on first use, and again in a forked worker
+        if self._thread is None or not self._thread.is_alive():
+            with self._lock:
+                if self._thread is None or not self._thread.is_alive():
+                    self._thread = threading.Thread(target=self.run, name='trace-exporter', daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            self.dropped += 1
+
+    def payload(self, traces):
+        return {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': TRACE_SERVICE_NAME}}]},
+            'scopeSpans': [{
+                'scope': {'name': 'casting-agency.tracing'},
+                'spans': [span.encode() for spans in traces for span in spans]
+            }]
+        }]}
+
+    def export(self, traces):
+        body = json.dumps(self.payload(traces))
+        if self.kind == 'file':
+            with open(self.path, 'a') as output:
+                output.write(body + '\n')
+        else:
+            request = Request(self.endpoint, data=body.encode(), method='POST',
+                              headers={'Content-Type': 'application/json'})
+            with urlopen(request, timeout=10):
+                pass
+
+    def run(self):
+        while True:
+            traces = [self._queue.get()]
+            time.sleep(TRACE_EXPORT_INTERVAL)
+            while not self._queue.empty():
+                traces.append(self._queue.get_nowait())
+            try:
+                self.export(traces)
+                self.exported += len(traces)
+            except Exception:
+                self.failed += len(traces)
+
+    def stats(self):
+        return {'exporter': self.kind, 'exported': self.exported, 'dropped': self.dropped, 'failed': self.failed}
+
+exporter = Exporter()
+
+
+## Request hooks
+def parse_traceparent(header):
+    """Returns the trace id, parent span id and sampled flag of a W3C traceparent header
+    """
+    try:
+        version, trace_id, parent_id, flags = header.split('-')
+        int(trace_id, 16), int(parent_id, 16)
+        if len(trace_id) != 32 or len(parent_id) != 16:
+            return None
+        return trace_id, parent_id, bool(int(flags, 16) & 1)
+    except (AttributeError, ValueError):
+        return None
+
+def begin():
+    """Decides whether the request is sampled and opens its server span
+    """
+    if not TRACE_EXPORTER:
+        return
+    parent = parse_traceparent(request.headers.get('traceparent'))
+    sampled = parent[2] if parent else random.random() < TRACE_SAMPLE_RATE
+    if not sampled:
+        return
+
+    g.trace = Trace(*parent[:2]) if parent else Trace()
+    g.trace_root = span(f'{request.method} {request.url_rule.rule if request.url_rule else request.path}',
+        SERVER, **{'http.method': request.method, 'http.target': request.full_path.rstrip('?')}).__enter__()
+
+def end(response):
+    trace = g.get('trace')
+    if trace is None:
+        return response
+    g.trace_root.set('http.status_code', response.status_code)
+    if response.status_code >= 500:
+        g.trace_root.error = response.status
+    response.headers['traceparent'] = f'00-{trace.trace_id}-{g.trace_root.span_id}-01'
+    return response
+
+def finish(error):
+    trace = g.pop('trace', None)
+    if trace is None:
+        return
+    while trace.stack:
+        trace.stack[-1].finish(error)
+    exporter.submit(trace.spans)
+
+
+## Instrumentation
+class TracedJSONEncoder(flask_json.JSONEncoder):
+    def encode(self, o):
+        with span('serialize'):
+            return flask_json.JSONEncoder.encode(self, o)
+
+class TracedTemplate(Template):
+    def render(self, *args, **kwargs):
+        with span('template.render', **{'template.name': self.name or ''}):
+            return Template.render(self, *args, **kwargs)
+
+class TracedEnvironment(Environment):
+    template_class = TracedTemplate
+
+def init_app(app):
+    """Traces serialization and template rendering of the app, SQL statements
+    are traced for every engine
+    """
+    if not TRACE_EXPORTER:
+        return
+    app.json_encoder = TracedJSONEncoder
+    app.jinja_environment = TracedEnvironment
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query_span(connection, cursor, statement, parameters, context, executemany):
+    if current_trace() is None:
+        return
+    query_span = span('db.query', CLIENT, **{
+        'db.system': connection.dialect.name,
+        'db.statement': ' '.join(statement.split())[:2000]
+    }).__enter__()
+    connection.info.setdefault('trace_spans', []).append(query_span)
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query_span(connection, cursor, statement, parameters, context, executemany):
+    if connection.info.get('trace_spans'):
+        connection.info['trace_spans'].pop().finish()
+
+@event.listens_for(Engine, 'handle_error')
+def fail_query_span(context):
+    if context.connection is not None and context.connection.info.get('trace_spans'):
+        context.connection.info['trace_spans'].pop().finish(context.original_exception)